@@ -1,9 +1,10 @@
 import streamlit as st
 import time
-import json
-from backend.config import load_topics, get_topic_by_id
-from backend.storage import save_session
-from backend.agents import ProfilerAgent, PersuaderAgent
+import uuid
+from backend.config import load_topics, get_topic_by_id, save_topics
+from backend.storage import save_session_async
+from backend.service import SessionNotFound, get_agent_service
+from backend.telemetry import start_metrics_server
 
 # Page Config
 st.set_page_config(
@@ -164,13 +165,36 @@ def load_css():
         </style>
     """, unsafe_allow_html=True)
 
-# Initialize Agents
-if "profiler" not in st.session_state:
-    st.session_state.profiler = ProfilerAgent()
-if "persuader" not in st.session_state:
-    st.session_state.persuader = PersuaderAgent()
+@st.cache_resource
+def get_service():
+    # In-process agents, or the agent workers in AGENT_WORKER_URLS. Either
+    # way the session state lives in the session log, not in this process.
+    return get_agent_service()
+
+@st.cache_resource
+def get_metrics_server():
+    return start_metrics_server()
+
+agent_service = get_service()
+get_metrics_server()
+
+def restore_session(session_id, state):
+    """Resumes an in-progress chat from its checkpoint log after a restart."""
+    st.session_state.session_id = session_id
+    st.session_state.topic = state["topic"]
+    st.session_state.pre_survey = state["pre_survey"]
+    st.session_state.history = state["history"]
+    st.session_state.profile = state["final_profile"]
+    st.session_state.page = "CHAT"
 
 def init_session():
+    if "session_id" not in st.session_state:
+        resumed = st.query_params.get("session")
+        state = agent_service.state(resumed) if resumed else None
+        if state is not None:
+            restore_session(resumed, state)
+        else:
+            st.session_state.session_id = uuid.uuid4().hex
     if "page" not in st.session_state:
         st.session_state.page = "LANDING"
     if "history" not in st.session_state:
@@ -199,15 +223,21 @@ def set_page(page_name):
     st.rerun()
 
 def save_data():
+    session_id = st.session_state.session_id
+    # Compacts the per-turn checkpoints into the final record
+    if agent_service.finish(session_id, st.session_state.post_survey):
+        return
+    
     session_data = {
-        "session_id": "unknown",
+        "session_id": session_id,
         "topic": st.session_state.topic,
         "pre_survey": st.session_state.pre_survey,
-        "post_survey": st.session_state.post_survey,
         "history": st.session_state.history,
-        "final_profile": st.session_state.profile
+        "final_profile": st.session_state.profile,
+        "post_survey": st.session_state.post_survey
     }
-    save_session(session_data)
+    # Written by the background session writer; no need to wait on the disk
+    save_session_async(session_data)
 
 def render_likert_scale(question, key_prefix=""):
     # Get or initialize the value
@@ -320,29 +350,41 @@ def pre_chat_page():
     for q in st.session_state.topic["questions"]:
         answers[q] = render_likert_scale(q)
     
+    # Every slider change reruns the page; once the answers settle the
+    # service prepares the opening for them in the background
+    agent_service.prefetch(st.session_state.session_id, st.session_state.topic, answers)
+    
     st.markdown("<br>", unsafe_allow_html=True)
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         if st.button("Start Chat", use_container_width=True, type="primary"):
             st.session_state.pre_survey = answers
+            session_id = st.session_state.session_id
             
-            with st.spinner("🧠 Analyzing your responses..."):
-                # Initial profile analysis
-                initial_profile = st.session_state.profiler.analyze_survey(
-                    answers, 
-                    st.session_state.topic["description"]
-                )
-                st.session_state.profile = initial_profile
+            # Served from the Start Chat cache (usually prefetched while the
+            # sliders were still), or streamed from a provisional profile while
+            # the survey is profiled; either way the session is checkpointed
+            with st.chat_message("assistant", avatar="🤖"):
+                placeholder = st.empty()
+                with st.spinner("🧠 Analyzing your responses..."):
+                    try:
+                        result = agent_service.start(
+                            session_id,
+                            st.session_state.topic,
+                            answers,
+                            render=placeholder.write_stream
+                        )
+                    except Exception as e:
+                        # WorkerError from the workers, or the agents' own
+                        # errors when they run in-process
+                        print(f"Start Chat Error: {e}")
+                        st.error("The assistant is unavailable right now. Please try again.")
+                        return
+            st.session_state.profile = result["profile"]
                 
-                # Generate icebreaker
-                opening_msg = st.session_state.persuader.generate_opening(
-                    initial_profile,
-                    st.session_state.topic["description"],
-                    answers
-                )
-                
-                # Add to history
-                st.session_state.history = [{"role": "assistant", "content": opening_msg}]
+            # Add to history
+            st.session_state.history = [{"role": "assistant", "content": result["opening"]}]
+            st.query_params["session"] = session_id
                 
             set_page("CHAT")
 
@@ -371,36 +413,33 @@ def chat_page():
         with st.chat_message("user", avatar="👤"):
             st.write(prompt)
             
-        # Profiler Step
-        with st.status("🧠 Analyzing...", expanded=False):
-            from backend.agents import decide_stage
-            new_profile = st.session_state.profiler.analyze(
-                prompt, 
-                st.session_state.history, 
-                st.session_state.topic["description"]
-            )
-            st.session_state.profile = new_profile
-            st.write("Profile Updated")
-            
-        # Determine conversation stage
-        turn_count = len([m for m in st.session_state.history if m.get("role") == "user"])
-        stage = decide_stage(turn_count, st.session_state.profile, target_stance="pro")
-            
-        # Persuader Step
-        with st.spinner("💭 Thinking..."):
-            reply = st.session_state.persuader.generate_reply(
-                prompt,
-                st.session_state.history,
-                st.session_state.profile,
-                st.session_state.topic["description"],
-                stage=stage,
-                target_stance="pro"
-            )
+        # Profiler and Persuader run side by side; the reply streams in and is
+        # only regenerated if the fresh profile changes the stage or stance.
+        # In fused mode one call returns both the reply and the new profile.
+        with st.chat_message("assistant", avatar="🤖"):
+            placeholder = st.empty()
+            with st.spinner("Thinking..."):
+                try:
+                    result = agent_service.turn(
+                        st.session_state.session_id,
+                        prompt,
+                        render=placeholder.write_stream,
+                        target_stance="pro"
+                    )
+                except SessionNotFound:
+                    # Finished, e.g. from another tab; its log is gone
+                    st.session_state.history.pop()
+                    st.error("This conversation has already ended. Start a new session to keep chatting.")
+                    return
+                except Exception as e:
+                    print(f"Chat Turn Error: {e}")
+                    st.session_state.history.pop()
+                    st.error("The assistant is unavailable right now. Please try again.")
+                    return
+        st.session_state.profile = result["profile"]
             
         # Add bot message to history
-        st.session_state.history.append({"role": "assistant", "content": reply})
-        with st.chat_message("assistant", avatar="🤖"):
-            st.write(reply)
+        st.session_state.history.append({"role": "assistant", "content": result["reply"]})
 
 def post_chat_page():
     st.title("📋 Post-Chat Survey")
@@ -442,6 +481,7 @@ def end_page():
     st.markdown("---")
     if st.button("🔄 Start New Session", type="primary"):
         st.session_state.clear()
+        st.query_params.clear()
         set_page("LANDING")
 
 def admin_page():
@@ -472,8 +512,7 @@ def admin_page():
                     "questions": [q for q in [new_q1, new_q2, new_q3] if q]
                 }
                 topics.append(new_topic)
-                with open("backend/topics.json", "w") as f:
-                    json.dump(topics, f, indent=2)
+                save_topics(topics)
                 st.success("Topic added!")
                 st.rerun()
             else:
@@ -495,15 +534,13 @@ def admin_page():
                     topics[i]["title"] = e_title
                     topics[i]["description"] = e_desc
                     topics[i]["questions"] = [q.strip() for q in e_qs.split("\n") if q.strip()]
-                    with open("backend/topics.json", "w") as f:
-                        json.dump(topics, f, indent=2)
+                    save_topics(topics)
                     st.success("Saved!")
                     st.rerun()
             with col2:
                 if st.button("Delete Topic", key=f"del_{i}", type="primary"):
                     topics.pop(i)
-                    with open("backend/topics.json", "w") as f:
-                        json.dump(topics, f, indent=2)
+                    save_topics(topics)
                     st.success("Deleted!")
                     st.rerun()
 
@@ -0,0 +1,328 @@
+"""
+Process-wide admission control for LLM requests.
+
+Every request, including each retry and hedge, needs a ticket before it is
+sent. A ticket is granted when:
+
+- fewer than LLM_MAX_IN_FLIGHT requests are in flight
+- the requests/min bucket (LLM_RPM) holds one request
+- the tokens/min bucket (LLM_TPM) holds the request's estimated tokens
+
+Waiting requests are served by priority, then in arrival order. In-chat
+replies, fused turns and openings go first, then per-turn profiling, then
+survey analysis, then simulated users. Unused token estimates are refunded
+from the actual usage when the ticket is released. Queue depth, in-flight
+count and waits are exported through the telemetry.
+
+acquire() blocks the calling thread; aacquire() waits on the event loop.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from backend.telemetry import telemetry
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "32"))
+# Provider limits; 0 means unlimited
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+# Completion tokens reserved per request until the actual usage is known
+LLM_COMPLETION_ESTIMATE = int(os.getenv("LLM_COMPLETION_ESTIMATE", "400"))
+
+# Lower goes first
+PRIORITIES = {
+    "generate_reply": 0,
+    "generate_opening": 0,
+    "fused_turn": 0,
+    "analyze": 1,
+    "analyze_survey": 2,
+    "simulate_user": 3,
+}
+DEFAULT_PRIORITY = 1
+
+
+class AdmissionTimeout(Exception):
+    """Raised when no ticket was granted before the request's deadline."""
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute` up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available (0 when it is)."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # Requests larger than the bucket go through once it is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        if self.rate:
+            self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _Waiter:
+    """A queued request. `loop` is set for aacquire, whose event lives on that loop."""
+
+    def __init__(self, method, tokens, loop=None):
+        self.method = method
+        self.tokens = tokens
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else asyncio.Event()
+
+    def wake(self):
+        # Tickets are granted from whichever thread releases one
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+class Ticket:
+    def __init__(self, controller, method, tokens, waited):
+        self.controller = controller
+        self.method = method
+        self.tokens = tokens
+        self.waited = waited
+        self.released = False
+
+    def remaining(self, timeout):
+        """
+        What is left of an attempt's `timeout` after waiting for this ticket.
+        Raises AdmissionTimeout when the wait used all of it.
+        """
+        left = timeout - self.waited
+        if left <= 0:
+            raise AdmissionTimeout(f"no time left for {self.method} after admission")
+        return left
+
+    def release(self, usage=None):
+        """Frees the in-flight slot; `usage` corrects the token estimate."""
+        if not self.released:
+            self.released = True
+            self.controller._release(self, usage)
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT, rpm=LLM_RPM, tpm=LLM_TPM):
+        self.max_in_flight = max_in_flight
+        self.requests = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.in_flight = 0
+        self._queue = []
+        self._depth = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _enqueue(self, waiter):
+        priority = PRIORITIES.get(waiter.method, DEFAULT_PRIORITY)
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        self._depth[waiter.method] = self._depth.get(waiter.method, 0) + 1
+
+    def _dequeue(self, waiter):
+        self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+        heapq.heapify(self._queue)
+        self._depth[waiter.method] -= 1
+
+    def _grant(self):
+        """
+        Grants tickets to the head of the queue while capacity lasts. Returns
+        the seconds until the buckets can serve the head, or None when it
+        waits for an in-flight slot instead.
+        """
+        delay = None
+        while self._queue and self.in_flight < self.max_in_flight:
+            waiter = self._queue[0][2]
+            delay = max(self.requests.wait_time(1), self.token_bucket.wait_time(waiter.tokens))
+            if delay > 0:
+                break
+            heapq.heappop(self._queue)
+            self._depth[waiter.method] -= 1
+            self.requests.take(1)
+            self.token_bucket.take(waiter.tokens)
+            self.in_flight += 1
+            waiter.granted = True
+            waiter.wake()
+            delay = None
+        self._publish()
+        return delay
+
+    def _publish(self):
+        telemetry.gauge("llm_in_flight", self.in_flight)
+        for method, depth in self._depth.items():
+            telemetry.gauge("llm_admission_queue_depth", depth, method=method)
+
+    def _finish_wait(self, waiter, start, deadline):
+        """Called under the lock. Returns the ticket, None while still queued, or raises on timeout."""
+        if waiter.granted:
+            waited = time.monotonic() - start
+            telemetry.count("llm_admission_wait_seconds_total", waited, method=waiter.method)
+            return Ticket(self, waiter.method, waiter.tokens, waited)
+        if time.monotonic() >= deadline:
+            self._dequeue(waiter)
+            self._publish()
+            telemetry.count("llm_admission_timeouts_total", method=waiter.method)
+            raise AdmissionTimeout(f"no capacity for {waiter.method}")
+        return None
+
+    def acquire(self, method, tokens, timeout):
+        """Blocks until a ticket is granted or `timeout` seconds pass."""
+        start = time.monotonic()
+        deadline = start + timeout
+        waiter = _Waiter(method, tokens)
+        with self._lock:
+            self._enqueue(waiter)
+        while True:
+            with self._lock:
+                delay = self._grant()
+                ticket = self._finish_wait(waiter, start, deadline)
+                if ticket:
+                    return ticket
+            remaining = deadline - time.monotonic()
+            waiter.event.wait(min(delay, remaining) if delay else remaining)
+
+    async def aacquire(self, method, tokens, timeout):
+        """Async acquire: waits on the running event loop instead of a thread."""
+        start = time.monotonic()
+        deadline = start + timeout
+        waiter = _Waiter(method, tokens, asyncio.get_running_loop())
+        with self._lock:
+            self._enqueue(waiter)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._grant()
+                    ticket = self._finish_wait(waiter, start, deadline)
+                    if ticket:
+                        return ticket
+                remaining = deadline - time.monotonic()
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), min(delay, remaining) if delay else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # A cancelled hedge: give back the slot, or leave the queue
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._dequeue(waiter)
+                    self._publish()
+            if granted:
+                Ticket(self, method, tokens, 0.0).release()
+            raise
+
+    def _release(self, ticket, usage):
+        with self._lock:
+            self.in_flight -= 1
+            if usage is not None:
+                used = (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+                self.token_bucket.refund(ticket.tokens - used)
+            self._grant()
+
+
+def estimate_request_tokens(messages):
+    """Prompt tokens of the messages plus the completion reserve."""
+    chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return (chars + 3) // 4 + LLM_COMPLETION_ESTIMATE
+
+
+class TicketedStream:
+    """
+    Iterates a stream's chunks and releases its ticket when the stream ends
+    or fails, or when it is closed or garbage collected before that, so a
+    stream dropped unread still frees its slot. The usage reported in the
+    last chunk corrects the token estimate.
+    """
+
+    def __init__(self, stream, ticket):
+        self.stream = stream
+        self.ticket = ticket
+        self.usage = None
+        self._chunks = iter(stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._chunks)
+        except BaseException:
+            self.ticket.release(self.usage)
+            raise
+        self.usage = getattr(chunk, "usage", None) or self.usage
+        return chunk
+
+    def close(self):
+        """Releases the ticket and closes the response."""
+        self.ticket.release(self.usage)
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            close()
+
+    def __del__(self):
+        self.ticket.release(self.usage)
+
+
+class AsyncTicketedStream:
+    """Async counterpart of TicketedStream; aclose() closes it."""
+
+    def __init__(self, stream, ticket):
+        self.stream = stream
+        self.ticket = ticket
+        self.usage = None
+        self._chunks = stream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._chunks.__anext__()
+        except BaseException:
+            self.ticket.release(self.usage)
+            raise
+        self.usage = getattr(chunk, "usage", None) or self.usage
+        return chunk
+
+    async def aclose(self):
+        self.ticket.release(self.usage)
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            await close()
+
+    def __del__(self):
+        self.ticket.release(self.usage)
+
+
+def release_after(stream, ticket):
+    """Wraps a stream so its ticket is released however the stream ends."""
+    return TicketedStream(stream, ticket)
+
+
+def arelease_after(stream, ticket):
+    return AsyncTicketedStream(stream, ticket)
+
+
+admission = AdmissionController()
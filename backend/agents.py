@@ -1,181 +1,784 @@
 import os
 import json
-from openai import OpenAI
+import hashlib
+import time
 from dotenv import load_dotenv
+from backend.compaction import HistoryCompactor, compact_json, estimate_tokens
+from backend.jsonstream import JsonFieldParser
+from backend.admission import admission, arelease_after, estimate_request_tokens, release_after
+from backend.providers import router
+from backend.resilience import call_policy
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-MODEL_NAME = "gpt-5.1"
+# Each call's model comes from the router (see backend/providers.py).
+# MODEL_NAME is the one calls no LLM_ROUTES rule matches go to, START_MODEL
+# names the models behind Start Chat (for its cache keys).
+MODEL_NAME = router.default.name
+START_MODEL = "+".join(dict.fromkeys([
+    router.route("profiler", "analyze_survey").name,
+    router.route("persuader", "generate_opening").name,
+]))
+
+# Incremental profiling re-reads the whole history every N user turns
+PROFILE_FULL_REFRESH_EVERY = int(os.getenv("PROFILE_FULL_REFRESH_EVERY", "5"))
+
+REPLY_FALLBACK = "I see what you mean. Can you tell me a bit more about how that feels for you?"
+
+# Prompt layout: these static instructions go first, as the system message, so
+# every call of a kind shares a byte-identical prefix that the provider can
+# cache. Topic content follows, and per-turn data always comes last.
+PROFILER_INSTRUCTIONS = """You are a careful analyst of communication style and attitudes. You output only JSON.
+You are a psychologist who analyzes communication style and attitude, not clinical traits.
+
+You will receive a topic, the conversation history and the latest user message. Infer,
+and output the fields in this order:
+
+- stance: "pro", "anti", or "mixed" toward the topic
+- change_readiness: 0 to 10 (how open they seem to shifting their view)
+- confidence_in_stance: 0.0 to 1.0
+- style: one of ["emotional", "rational", "sarcastic", "brief", "storytelling"]
+- tone: for example "defensive", "curious", "confident", "frustrated"
+- key_values: 3 to 5 short phrases about what they seem to care about most
+- good_moves: how to talk to them effectively (max 2 sentences)
+- bad_moves: how not to talk to them (max 2 sentences)"""
+
+PROFILER_SUMMARY_FIELD = """- summary: the conversation so far (max 3 sentences)"""
+
+PROFILER_UPDATE_INSTRUCTIONS = """You are a careful analyst of communication style and attitudes. You output only JSON.
+You are a psychologist who analyzes communication style and attitude, not clinical traits.
+
+You will receive a topic, a summary of the conversation so far, the current profile and the newest exchange.
+
+Update the profile with what the newest exchange reveals. Keep fields that
+it says nothing about. Return the same fields as the current profile, in
+this order: stance, change_readiness, confidence_in_stance, style, tone,
+key_values, good_moves, bad_moves.
+
+Also return:
+- summary: the conversation summary updated with the newest exchange (max 3 sentences)
+
+Return ONLY valid JSON."""
+
+SURVEY_INSTRUCTIONS = """You are a helpful assistant that outputs JSON only.
+You are building an initial communication profile based on a survey.
+
+You will receive a topic, the survey answers (0 strongly disagree, 10 strongly agree),
+their average score and the stance derived from it.
+
+Output JSON with:
+- stance: the derived stance
+- confidence_in_stance: 0.0 to 1.0 (high if scores are consistent)
+- style: "neutral" as default
+- tone: "neutral"
+- change_readiness: 0 to 10
+- key_values: 1 to 3 guesses about what they care about
+- good_moves: 1 sentence on how to talk to them
+- bad_moves: 1 sentence on what to avoid
+
+Return ONLY valid JSON."""
+
+OPENING_INSTRUCTIONS = """You are a conversational assistant focused on rapport and exploration.
+You are starting a conversation about the topic below, with a user whose profile and
+average survey score you will receive.
+
+Goal:
+- Build rapport
+- Understand how they think and talk
+- Do not try to change their mind yet
+
+Rules:
+- One or two short sentences
+- Mirror their style if known (brief vs detailed, emotional vs rational)
+- Ask ONE open question about their experience or reasoning
+- Do NOT mention studies, statistics, research, experts, or data
+
+Example patterns:
+- "Sounds like you lean <their stance> on this. What experience made you feel that way?"
+- "I get that this matters to you. When did you first start thinking about <the topic> like this?"
+
+Write the message."""
+
+REPLY_INSTRUCTIONS = """You help people think through their views in a respectful and concise way.
+You are a thoughtful conversational partner helping the user explore their view on the topic below.
+You will receive the topic, the target stance, the conversation, the user profile, the current
+stage and the latest user message.
+
+General rules:
+- Always respect their autonomy, never pressure them
+- Mirror their style: if they are brief, be brief, if emotional, use feelings, if rational, use reasons
+- One or two sentences, maximum about 35 words
+- Ask at most ONE question
+- Refer explicitly to something they just said
+
+Stage guidelines:
+- rapport: validate their feelings or concerns, no arguments, no data, just understanding
+- explore: ask curious questions about why they think that, still no statistics or experts
+- challenge: gently introduce one concrete counterpoint that connects to their values, you may mention one example or one datum, avoid info dumps
+- wrap_up: if they are close to or at the target stance, summarise common ground and support their autonomy, do not push further
+
+Avoid:
+- Saying "studies show", "experts say", "research suggests" more than once in the reply
+- Long lists of reasons
+- Repeating generic phrases like "innovative companies" or "industry leaders"
+
+Now write the next assistant message."""
+
+# Fused mode: one completion does the profiler's and the persuader's job
+FUSED_INSTRUCTIONS = f"""You do two jobs in one response and output only JSON.
+
+Job 1, the profile.
+{PROFILER_INSTRUCTIONS}
+{PROFILER_SUMMARY_FIELD}
+
+Job 2, the reply.
+{REPLY_INSTRUCTIONS}
+
+Output JSON with exactly two keys:
+- profile: every profile field above, updated with the latest user message
+- reply: the next assistant message, written for the current stage you were given
+
+Return ONLY valid JSON."""
+
+# Part of the Start Chat cache key, so editing these prompts retires the
+# cached profiles and openings written from the old ones
+START_PROMPT_VERSION = hashlib.sha256(
+    (SURVEY_INSTRUCTIONS + OPENING_INSTRUCTIONS).encode("utf-8")
+).hexdigest()[:12]
+
+# Schema every profile must match, whichever agent produced it, in the
+# order the profiler is asked to write it: the fields decide_stage reads first
+PROFILE_FIELDS = {
+    "stance": str,
+    "change_readiness": float,
+    "confidence_in_stance": float,
+    "style": str,
+    "tone": str,
+    "key_values": list,
+    "good_moves": str,
+    "bad_moves": str,
+}
+STANCES = ("pro", "anti", "mixed")
+
+
+def new_usage():
+    return {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "uncached_tokens": 0, "completion_tokens": 0}
+
+
+def record_usage(totals, usage):
+    """Adds a response's usage to totals, splitting cached and uncached prompt tokens."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    totals["calls"] += 1
+    totals["prompt_tokens"] += prompt_tokens
+    totals["cached_tokens"] += cached_tokens
+    totals["uncached_tokens"] += prompt_tokens - cached_tokens
+    totals["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+def complete(route, call, **kwargs):
+    """
+    Sends the chat completion for a telemetry call to its route's model
+    under the call policy: method deadline, retries, hedging and the
+    model's circuit breaker.
+    Streams are never hedged. Each attempt waits for an admission ticket,
+    which a stream holds until it is fully read.
+    """
+    tokens = estimate_request_tokens(kwargs["messages"])
 
+    def request(timeout):
+        ticket = admission.acquire(call.method, tokens, timeout)
+        try:
+            response = route.client.chat.completions.create(
+                model=route.model, timeout=ticket.remaining(timeout), **kwargs
+            )
+        except BaseException:
+            ticket.release()
+            raise
+        if kwargs.get("stream"):
+            return release_after(response, ticket)
+        ticket.release(getattr(response, "usage", None))
+        return response
 
-class ProfilerAgent:
-    def __init__(self):
-        self.client = client
+    return call_policy.call(
+        call.method, call.model, request, call=call, hedge=not kwargs.get("stream")
+    )
 
-    def analyze(self, user_message, history, topic_description):
-        prompt = f"""
-        You are a psychologist who analyzes communication style and attitude, not clinical traits.
 
-        Topic: {topic_description}
+async def acomplete(route, call, **kwargs):
+    """
+    Async counterpart of complete, on the provider's AsyncOpenAI client for
+    the running loop. Waiting for admission, backoff and hedges all happen
+    on the loop, so a call holds no thread.
+    """
+    tokens = estimate_request_tokens(kwargs["messages"])
 
-        Conversation history:
-        {json.dumps(history, indent=2)}
+    async def request(timeout):
+        ticket = await admission.aacquire(call.method, tokens, timeout)
+        try:
+            response = await route.async_client().chat.completions.create(
+                model=route.model, timeout=ticket.remaining(timeout), **kwargs
+            )
+        except BaseException:
+            ticket.release()
+            raise
+        if kwargs.get("stream"):
+            return arelease_after(response, ticket)
+        ticket.release(getattr(response, "usage", None))
+        return response
+
+    return await call_policy.acall(
+        call.method, call.model, request, call=call, hedge=not kwargs.get("stream")
+    )
+
+
+def response_text(usage, call, response):
+    """Records a completion's usage on the agent and its call, and returns its text."""
+    record_usage(usage, response.usage)
+    call.add_usage(response.usage)
+    return response.choices[0].message.content.strip()
+
+
+def validate_profile(profile):
+    """Returns the profile if it matches PROFILE_FIELDS, otherwise raises ValueError."""
+    if not isinstance(profile, dict):
+        raise ValueError("profile is not an object")
+    for field, kind in PROFILE_FIELDS.items():
+        value = profile.get(field)
+        if kind is float:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+        elif kind is list:
+            valid = isinstance(value, list) and all(isinstance(v, str) for v in value)
+        else:
+            valid = isinstance(value, str)
+        if not valid:
+            raise ValueError(f"profile field {field} is missing or not a {kind.__name__}")
+    if profile["stance"] not in STANCES:
+        raise ValueError(f"unknown stance {profile['stance']!r}")
+    if not 0 <= profile["confidence_in_stance"] <= 1:
+        raise ValueError("confidence_in_stance out of range")
+    if not 0 <= profile["change_readiness"] <= 10:
+        raise ValueError("change_readiness out of range")
+    if not isinstance(profile.get("summary", ""), str):
+        raise ValueError("summary is not a str")
+    return profile
+
+
+def validate_reply(reply):
+    """Returns the stripped reply, or raises ValueError if it is not usable text."""
+    if not isinstance(reply, str) or not reply.strip():
+        raise ValueError("reply is empty or not a str")
+    return reply.strip()
+
+
+def survey_stance(survey_answers):
+    """Returns the average survey score and the stance derived from it."""
+    scores = list(survey_answers.values())
+    avg_score = sum(scores) / len(scores) if scores else 5
+
+    if avg_score < 4:
+        derived_stance = "anti"
+    elif avg_score < 6:
+        derived_stance = "mixed"
+    else:
+        derived_stance = "pro"
+    return avg_score, derived_stance
+
+
+def provisional_profile(survey_answers):
+    """
+    Local stand-in for analyze_survey, built from the survey alone: the
+    derived stance, confidence from how consistent the answers are and
+    change readiness from how far the average is from the middle.
+    """
+    scores = list(survey_answers.values())
+    avg_score, derived_stance = survey_stance(survey_answers)
+    spread = max(scores) - min(scores) if scores else 9
+    return {
+        "stance": derived_stance,
+        "change_readiness": round(min(max(8 - abs(avg_score - 5.5) * 1.5, 0), 10)),
+        "confidence_in_stance": round(max(1 - spread / 10, 0.1), 2),
+        "style": "neutral",
+        "tone": "neutral",
+        "key_values": [],
+        "good_moves": "Be conversational but direct.",
+        "bad_moves": "Do not overwhelm them with details.",
+    }
+
+
+def latest_exchange(history):
+    """Returns the newest assistant message and user message from a history."""
+    exchange = []
+    for m in reversed(history):
+        if not exchange and m.get("role") == "user":
+            exchange.insert(0, m)
+        elif exchange and m.get("role") == "assistant":
+            exchange.insert(0, m)
+            break
+    return exchange
 
-        Latest user message: "{user_message}"
 
-        Infer:
+class ProfilerAgent:
+    """
+    With incremental=True, analyze only sends the previous profile, its rolling
+    summary and the newest exchange, and re-reads the whole history every
+    `full_refresh_every` user turns to correct drift.
+    """
 
-        - stance: "pro", "anti", or "mixed" toward the topic
-        - confidence_in_stance: 0.0 to 1.0
-        - style: one of ["emotional", "rational", "sarcastic", "brief", "storytelling"]
-        - tone: for example "defensive", "curious", "confident", "frustrated"
-        - change_readiness: 0 to 10 (how open they seem to shifting their view)
-        - key_values: 3 to 5 short phrases about what they seem to care about most
-        - good_moves: how to talk to them effectively (max 2 sentences)
-        - bad_moves: how not to talk to them (max 2 sentences)
+    agent_name = "profiler"
 
-        Return ONLY valid JSON.
+    def __init__(self, incremental=False, full_refresh_every=PROFILE_FULL_REFRESH_EVERY):
+        self.router = router
+        self.incremental = incremental
+        self.full_refresh_every = full_refresh_every
+        self.usage = new_usage()
+
+    def _is_incremental(self, history, previous_profile):
+        if not self.incremental or not previous_profile or "summary" not in previous_profile:
+            return False
+        turn_count = len([m for m in history if m.get("role") == "user"])
+        return turn_count % max(self.full_refresh_every, 1) != 0
+
+    def _plan_analyze(self, user_message, history, topic_description, previous_profile):
+        """Returns the messages for the next profiling call and its fallback profile."""
+        if self._is_incremental(history, previous_profile):
+            return (
+                self._incremental_messages(user_message, history, topic_description, previous_profile),
+                previous_profile,
+            )
+        return self._analyze_messages(user_message, history, topic_description), self._analyze_fallback()
+
+    def _incremental_messages(self, user_message, history, topic_description, previous_profile):
+        profile = {k: v for k, v in previous_profile.items() if k != "summary"}
+
+        prompt = (
+            f"Topic: {topic_description}\n\n"
+            f"Summary of the conversation so far:\n{previous_profile['summary']}\n\n"
+            f"Current profile:\n{compact_json(profile)}\n\n"
+            f"Newest exchange:\n{compact_json(latest_exchange(history))}\n\n"
+            f'Latest user message: "{user_message}"'
+        )
+        return [
+            {"role": "system", "content": PROFILER_UPDATE_INSTRUCTIONS},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _analyze_messages(self, user_message, history, topic_description):
+        fields = [PROFILER_INSTRUCTIONS]
+        if self.incremental:
+            fields.append(PROFILER_SUMMARY_FIELD)
+        instructions = "\n".join(fields) + "\n\nReturn ONLY valid JSON."
+
+        prompt = (
+            f"Topic: {topic_description}\n\n"
+            f"Conversation history:\n{compact_json(history)}\n\n"
+            f'Latest user message: "{user_message}"'
+        )
+        return [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _merge_profile(self, previous_profile, profile):
+        # Incremental updates may leave out fields they did not change
+        if self.incremental and previous_profile:
+            return {**previous_profile, **profile}
+        return profile
+
+    def _analyze_fallback(self):
+        return {
+            "stance": "mixed",
+            "confidence_in_stance": 0.3,
+            "style": "brief",
+            "tone": "neutral",
+            "change_readiness": 5,
+            "key_values": [],
+            "good_moves": "Be concise and respectful.",
+            "bad_moves": "Do not flood them with long arguments.",
+        }
+
+    def _survey_messages(self, survey_answers, topic_description):
+        avg_score, derived_stance = survey_stance(survey_answers)
+
+        prompt = (
+            f"Topic: {topic_description}\n\n"
+            f"Survey answers:\n{compact_json(survey_answers)}\n\n"
+            f"Calculated average score: {avg_score:.1f} out of 10\n"
+            f"Derived stance: {derived_stance}"
+        )
+        return [
+            {"role": "system", "content": SURVEY_INSTRUCTIONS},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _survey_fallback(self, survey_answers):
+        _, derived_stance = survey_stance(survey_answers)
+        return {
+            "stance": derived_stance,
+            "confidence_in_stance": 0.5,
+            "style": "neutral",
+            "tone": "neutral",
+            "change_readiness": 5,
+            "key_values": [],
+            "good_moves": "Be conversational but direct.",
+            "bad_moves": "Do not overwhelm them with details.",
+        }
+
+    def _profile_text(self, route, call, messages, on_fields=None):
         """
-        try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a careful analyst of communication style and attitudes. You output only JSON."
-                    },
-                    {"role": "user", "content": prompt},
-                ],
+        Returns the profile completion. With `on_fields` the completion is
+        streamed, and on_fields gets every top-level field completed so far
+        each time one more arrives.
+        """
+        if on_fields is None:
+            response = complete(
+                route,
+                call,
+                messages=messages,
+                response_format={"type": "json_object"},
+            )
+            return response_text(self.usage, call, response)
+
+        stream = complete(
+            route,
+            call,
+            messages=messages,
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parser = JsonFieldParser()
+        parts = []
+        for chunk in stream:
+            self._profile_chunk(call, chunk, parser, parts, on_fields)
+        return "".join(parts)
+
+    async def _aprofile_text(self, route, call, messages, on_fields=None):
+        """Async counterpart of _profile_text."""
+        if on_fields is None:
+            response = await acomplete(
+                route,
+                call,
+                messages=messages,
                 response_format={"type": "json_object"},
             )
-            text = response.choices[0].message.content.strip()
-            return json.loads(text)
+            return response_text(self.usage, call, response)
+
+        stream = await acomplete(
+            route,
+            call,
+            messages=messages,
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parser = JsonFieldParser()
+        parts = []
+        async for chunk in stream:
+            self._profile_chunk(call, chunk, parser, parts, on_fields)
+        return "".join(parts)
+
+    def _profile_chunk(self, call, chunk, parser, parts, on_fields):
+        if getattr(chunk, "usage", None):
+            record_usage(self.usage, chunk.usage)
+            call.add_usage(chunk.usage)
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return
+        call.first_token()
+        parts.append(chunk.choices[0].delta.content)
+        if parser.feed(parts[-1]):
+            on_fields(dict(parser.fields))
+
+    def analyze(self, user_message, history, topic_description, previous_profile=None, on_fields=None):
+        """
+        Returns the updated profile. `on_fields` streams the completion and
+        receives the fields parsed so far as they arrive (see _profile_text),
+        before they are validated; the returned profile is what counts.
+        """
+        messages, fallback = self._plan_analyze(user_message, history, topic_description, previous_profile)
+        route, call = self.router.start(self.agent_name, "analyze")
+        try:
+            text = self._profile_text(route, call, messages, on_fields).strip()
+            profile = validate_profile(self._merge_profile(previous_profile, json.loads(text)))
+            call.ok()
+            return profile
         except Exception as e:
             print(f"Profiler Error: {e}")
-            return {
-                "stance": "mixed",
-                "confidence_in_stance": 0.3,
-                "style": "brief",
-                "tone": "neutral",
-                "change_readiness": 5,
-                "key_values": [],
-                "good_moves": "Be concise and respectful.",
-                "bad_moves": "Do not flood them with long arguments.",
-            }
-
-    def analyze_survey(self, survey_answers, topic_description):
-        scores = list(survey_answers.values())
-        avg_score = sum(scores) / len(scores) if scores else 5
-
-        if avg_score < 4:
-            derived_stance = "anti"
-        elif avg_score < 6:
-            derived_stance = "mixed"
-        else:
-            derived_stance = "pro"
+            call.fail(e)
+            return fallback
 
-        prompt = f"""
-        You are building an initial communication profile based on a survey.
-
-        Topic: {topic_description}
-
-        Survey answers (0 strongly disagree, 10 strongly agree):
-        {json.dumps(survey_answers, indent=2)}
-
-        Calculated average score: {avg_score:.1f} out of 10
-        Derived stance: {derived_stance}
+    async def aanalyze(self, user_message, history, topic_description, previous_profile=None, on_fields=None):
+        """Async counterpart of analyze."""
+        messages, fallback = self._plan_analyze(user_message, history, topic_description, previous_profile)
+        route, call = self.router.start(self.agent_name, "analyze")
+        try:
+            text = (await self._aprofile_text(route, call, messages, on_fields)).strip()
+            profile = validate_profile(self._merge_profile(previous_profile, json.loads(text)))
+            call.ok()
+            return profile
+        except Exception as e:
+            print(f"Profiler Error: {e}")
+            call.fail(e)
+            return fallback
 
-        Output JSON with:
-        - stance: "{derived_stance}"
-        - confidence_in_stance: 0.0 to 1.0 (high if scores are consistent)
-        - style: "neutral" as default
-        - tone: "neutral"
-        - change_readiness: 0 to 10
-        - key_values: 1 to 3 guesses about what they care about
-        - good_moves: 1 sentence on how to talk to them
-        - bad_moves: 1 sentence on what to avoid
+    def analyze_survey(self, survey_answers, topic_description):
+        route, call = self.router.start(self.agent_name, "analyze_survey")
+        try:
+            response = complete(
+                route,
+                call,
+                messages=self._survey_messages(survey_answers, topic_description),
+                response_format={"type": "json_object"},
+            )
+            profile = validate_profile(json.loads(response_text(self.usage, call, response)))
+            call.ok()
+            return profile
+        except Exception as e:
+            print(f"Profiler Survey Error: {e}")
+            call.fail(e)
+            return self._survey_fallback(survey_answers)
 
-        Return ONLY valid JSON.
-        """
+    async def aanalyze_survey(self, survey_answers, topic_description):
+        """Async counterpart of analyze_survey."""
+        route, call = self.router.start(self.agent_name, "analyze_survey")
         try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that outputs JSON only."
-                    },
-                    {"role": "user", "content": prompt},
-                ],
+            response = await acomplete(
+                route,
+                call,
+                messages=self._survey_messages(survey_answers, topic_description),
                 response_format={"type": "json_object"},
             )
-            text = response.choices[0].message.content.strip()
-            profile = json.loads(text)
+            profile = validate_profile(json.loads(response_text(self.usage, call, response)))
+            call.ok()
             return profile
         except Exception as e:
             print(f"Profiler Survey Error: {e}")
-            return {
-                "stance": derived_stance,
-                "confidence_in_stance": 0.5,
-                "style": "neutral",
-                "tone": "neutral",
-                "change_readiness": 5,
-                "key_values": [],
-                "good_moves": "Be conversational but direct.",
-                "bad_moves": "Do not overwhelm them with details.",
-            }
+            call.fail(e)
+            return self._survey_fallback(survey_answers)
 
 
 class PersuaderAgent:
-    def __init__(self):
-        self.client = client
-
-    def generate_opening(self, profile, topic_description, survey_answers):
-        scores = list(survey_answers.values())
-        avg_score = sum(scores) / len(scores) if scores else 5
-
-        prompt = f"""
-        You are starting a conversation about: {topic_description}
+    agent_name = "persuader"
 
-        User profile:
-        {json.dumps(profile, indent=2)}
-
-        Average survey score: {avg_score:.1f} out of 10
-
-        Goal:
-        - Build rapport
-        - Understand how they think and talk
-        - Do not try to change their mind yet
-
-        Rules:
-        - One or two short sentences
-        - Mirror their style if known (brief vs detailed, emotional vs rational)
-        - Ask ONE open question about their experience or reasoning
-        - Do NOT mention studies, statistics, research, experts, or data
+    def __init__(self):
+        self.router = router
+        # Prompt tokens split into cached and uncached, per agent
+        self.usage = new_usage()
+        # One entry per streamed call: method, ttft, total, fallback
+        self.timings = []
+        self.compactor = HistoryCompactor()
+        # One entry per reply prompt: tokens_before, tokens_after, saved, summarized_messages
+        self.compactions = []
+
+    def _opening_messages(self, profile, topic_description, survey_answers):
+        avg_score, _ = survey_stance(survey_answers)
+
+        prompt = (
+            f"Topic: {topic_description}\n\n"
+            f"User profile:\n{compact_json(profile)}\n\n"
+            f"Average survey score: {avg_score:.1f} out of 10"
+        )
+        return [
+            {"role": "system", "content": OPENING_INSTRUCTIONS},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _opening_fallback(self, topic_description):
+        return f"I would like to hear your thoughts on {topic_description}. What shaped your view on it?"
+
+    def _reply_messages(
+        self,
+        user_message,
+        history,
+        profile,
+        topic_description,
+        stage,
+        target_stance,
+        instructions=REPLY_INSTRUCTIONS,
+    ):
+        """`instructions` is the system prompt sent with it, which counts against the budget."""
+        turn_count = len([m for m in history if m.get("role") == "user"])
+        # The rolling summary goes in the history section when turns are dropped
+        profile_fields = {k: v for k, v in profile.items() if k != "summary"}
+
+        # The history comes before the per-turn fields: it only grows, so
+        # consecutive turns share a longer cacheable prefix
+        def build(history_section):
+            return (
+                f"Topic: {topic_description}\n"
+                f'Target stance: "{target_stance}"\n\n'
+                f"{history_section}\n\n"
+                f"User profile:\n{compact_json(profile_fields)}\n\n"
+                f'Current stage: "{stage}"\n'
+                f"Turn count: {turn_count}\n"
+                f'Latest user message: "{user_message}"'
+            )
 
-        Example patterns:
-        - "Sounds like you lean {profile.get("stance", "mixed")} on this. What experience made you feel that way?"
-        - "I get that this matters to you. When did you first start thinking about {topic_description.lower()} like this?"
+        def history_section(summary_text, recent_text):
+            if summary_text:
+                return (
+                    f"Earlier conversation (summary):\n{summary_text}\n\n"
+                    f"Recent conversation:\n{recent_text}"
+                )
+            return f"Conversation history:\n{recent_text}"
+
+        summary_text, recent_text, stats = self.compactor.compact(
+            history,
+            summary=profile.get("summary"),
+            reserved_tokens=estimate_tokens(instructions) + estimate_tokens(build(history_section(" ", ""))),
+        )
+        self.compactions.append(stats)
+
+        return [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": build(history_section(summary_text, recent_text))},
+        ]
+
+    def _stream(self, method, messages, fallback, stage=None):
+        """
+        Yields the completion token by token and records time-to-first-token
+        and total time in self.timings.
 
-        Write the message.
+        If the stream fails before any text arrives the fallback is yielded
+        instead. If it fails halfway, the fallback follows the partial text so
+        the user still ends up with a question to answer. When the consumer
+        stops reading, the call is recorded as cancelled and the response closed.
         """
+        start = time.perf_counter()
+        timing = {"method": method, "ttft": None, "total": None, "fallback": False}
+        route, call = self.router.start(self.agent_name, method, stage)
+        received = False
+        finished = False
+        stream = None
+        try:
+            stream = complete(
+                route,
+                call,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                token = self._stream_token(call, chunk)
+                if not token:
+                    continue
+                if not received:
+                    timing["ttft"] = time.perf_counter() - start
+                    call.first_token()
+                    received = True
+                yield token
+            if not received:
+                raise ValueError("empty completion")
+            finished = True
+            call.ok()
+        except Exception as e:
+            print(f"Persuader Stream Error ({method}): {e}")
+            finished = True
+            call.fail(e)
+            timing["fallback"] = True
+            if received:
+                yield "\n\n" + fallback
+            else:
+                timing["ttft"] = time.perf_counter() - start
+                yield fallback
+        finally:
+            if not finished:
+                # The consumer stopped reading (GeneratorExit)
+                call.cancel()
+            if stream is not None:
+                stream.close()
+            timing["total"] = time.perf_counter() - start
+            self.timings.append(timing)
+
+    async def _astream(self, method, messages, fallback, stage=None):
+        """Async counterpart of _stream."""
+        start = time.perf_counter()
+        timing = {"method": method, "ttft": None, "total": None, "fallback": False}
+        route, call = self.router.start(self.agent_name, method, stage)
+        received = False
+        finished = False
+        stream = None
+        try:
+            stream = await acomplete(
+                route,
+                call,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                token = self._stream_token(call, chunk)
+                if not token:
+                    continue
+                if not received:
+                    timing["ttft"] = time.perf_counter() - start
+                    call.first_token()
+                    received = True
+                yield token
+            if not received:
+                raise ValueError("empty completion")
+            finished = True
+            call.ok()
+        except Exception as e:
+            print(f"Persuader Stream Error ({method}): {e}")
+            finished = True
+            call.fail(e)
+            timing["fallback"] = True
+            if received:
+                yield "\n\n" + fallback
+            else:
+                timing["ttft"] = time.perf_counter() - start
+                yield fallback
+        finally:
+            if not finished:
+                call.cancel()
+            if stream is not None:
+                await stream.aclose()
+            timing["total"] = time.perf_counter() - start
+            self.timings.append(timing)
+
+    def _stream_token(self, call, chunk):
+        """Records a streamed chunk's usage and returns its text, if any."""
+        if getattr(chunk, "usage", None):
+            record_usage(self.usage, chunk.usage)
+            call.add_usage(chunk.usage)
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.content
 
+    def generate_opening(self, profile, topic_description, survey_answers):
+        route, call = self.router.start(self.agent_name, "generate_opening")
         try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a conversational assistant focused on rapport and exploration."
-                    },
-                    {"role": "user", "content": prompt},
-                ],
+            response = complete(
+                route,
+                call,
+                messages=self._opening_messages(profile, topic_description, survey_answers),
             )
-            return response.choices[0].message.content.strip()
+            opening = response_text(self.usage, call, response)
+            call.ok()
+            return opening
         except Exception as e:
             print(f"Persuader Opening Error: {e}")
-            return f"I would like to hear your thoughts on {topic_description}. What shaped your view on it?"
+            call.fail(e)
+            return self._opening_fallback(topic_description)
+
+    def stream_opening(self, profile, topic_description, survey_answers):
+        """Streaming variant of generate_opening, for st.write_stream."""
+        return self._stream(
+            "generate_opening",
+            self._opening_messages(profile, topic_description, survey_answers),
+            self._opening_fallback(topic_description),
+        )
+
+    def astream_opening(self, profile, topic_description, survey_answers):
+        """Async counterpart of stream_opening: an async generator of tokens."""
+        return self._astream(
+            "generate_opening",
+            self._opening_messages(profile, topic_description, survey_answers),
+            self._opening_fallback(topic_description),
+        )
 
     def generate_reply(
         self,
@@ -189,59 +792,157 @@ class PersuaderAgent:
         """
         stage in {"rapport", "explore", "challenge", "wrap_up"}
         """
+        route, call = self.router.start(self.agent_name, "generate_reply", stage)
+        try:
+            response = complete(
+                route,
+                call,
+                messages=self._reply_messages(
+                    user_message, history, profile, topic_description, stage, target_stance
+                ),
+            )
+            reply = response_text(self.usage, call, response)
+            call.ok()
+            return reply
+        except Exception as e:
+            print(f"Persuader Error: {e}")
+            call.fail(e)
+            return REPLY_FALLBACK
 
-        turn_count = len([m for m in history if m.get("role") == "user"])
-
-        prompt = f"""
-        You are a thoughtful conversational partner helping the user explore their view on: {topic_description}
-
-        User profile:
-        {json.dumps(profile, indent=2)}
-
-        Conversation history:
-        {json.dumps(history, indent=2)}
-
-        Latest user message: "{user_message}"
-        Current stage: "{stage}"
-        Target stance: "{target_stance}"
-        Turn count: {turn_count}
+    async def agenerate_reply(
+        self,
+        user_message,
+        history,
+        profile,
+        topic_description,
+        stage,
+        target_stance="pro",
+    ):
+        """Async counterpart of generate_reply."""
+        route, call = self.router.start(self.agent_name, "generate_reply", stage)
+        try:
+            response = await acomplete(
+                route,
+                call,
+                messages=self._reply_messages(
+                    user_message, history, profile, topic_description, stage, target_stance
+                ),
+            )
+            reply = response_text(self.usage, call, response)
+            call.ok()
+            return reply
+        except Exception as e:
+            print(f"Persuader Error: {e}")
+            call.fail(e)
+            return REPLY_FALLBACK
 
-        General rules:
-        - Always respect their autonomy, never pressure them
-        - Mirror their style: if they are brief, be brief, if emotional, use feelings, if rational, use reasons
-        - One or two sentences, maximum about 35 words
-        - Ask at most ONE question
-        - Refer explicitly to something they just said
+    def stream_reply(
+        self,
+        user_message,
+        history,
+        profile,
+        topic_description,
+        stage,
+        target_stance="pro",
+    ):
+        """Streaming variant of generate_reply, for st.write_stream."""
+        return self._stream(
+            "generate_reply",
+            self._reply_messages(
+                user_message, history, profile, topic_description, stage, target_stance
+            ),
+            REPLY_FALLBACK,
+            stage,
+        )
+
+    def astream_reply(
+        self,
+        user_message,
+        history,
+        profile,
+        topic_description,
+        stage,
+        target_stance="pro",
+    ):
+        """Async counterpart of stream_reply: an async generator of tokens."""
+        return self._astream(
+            "generate_reply",
+            self._reply_messages(
+                user_message, history, profile, topic_description, stage, target_stance
+            ),
+            REPLY_FALLBACK,
+            stage,
+        )
+
+
+class FusedAgent(PersuaderAgent):
+    """
+    Profiler and Persuader in one JSON completion. It returns the updated
+    profile and the reply to the latest message, so the history is sent once.
+    The caller picks the stage from the previous profile, and both outputs
+    are validated with the same checks as the separate agents.
+    """
 
-        Stage guidelines:
-        - rapport: validate their feelings or concerns, no arguments, no data, just understanding
-        - explore: ask curious questions about why they think that, still no statistics or experts
-        - challenge: gently introduce one concrete counterpoint that connects to their values, you may mention one example or one datum, avoid info dumps
-        - wrap_up: if they are close to or at the target stance, summarise common ground and support their autonomy, do not push further
+    agent_name = "fused"
 
-        Avoid:
-        - Saying "studies show", "experts say", "research suggests" more than once in the reply
-        - Long lists of reasons
-        - Repeating generic phrases like "innovative companies" or "industry leaders"
+    def _fused_messages(self, user_message, history, profile, topic_description, stage, target_stance):
+        return self._reply_messages(
+            user_message, history, profile, topic_description, stage, target_stance,
+            instructions=FUSED_INSTRUCTIONS,
+        )
 
-        Now write the next assistant message.
+    def turn(self, user_message, history, profile, topic_description, stage, target_stance="pro"):
         """
-
+        Returns (reply, new_profile). An unusable reply falls back to
+        REPLY_FALLBACK and an invalid profile keeps the previous one.
+        """
+        route, call = self.router.start(self.agent_name, "fused_turn", stage)
         try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You help people think through their views in a respectful and concise way."
-                    },
-                    {"role": "user", "content": prompt},
-                ],
+            response = complete(
+                route,
+                call,
+                messages=self._fused_messages(
+                    user_message, history, profile, topic_description, stage, target_stance
+                ),
+                response_format={"type": "json_object"},
             )
-            return response.choices[0].message.content.strip()
+            output = json.loads(response_text(self.usage, call, response))
+            reply = validate_reply(output.get("reply"))
+            call.ok()
         except Exception as e:
-            print(f"Persuader Error: {e}")
-            return "I see what you mean. Can you tell me a bit more about how that feels for you?"
+            print(f"Fused Agent Error: {e}")
+            call.fail(e)
+            return REPLY_FALLBACK, profile
+        return reply, self._turn_profile(output, profile)
+
+    async def aturn(self, user_message, history, profile, topic_description, stage, target_stance="pro"):
+        """Async counterpart of turn."""
+        route, call = self.router.start(self.agent_name, "fused_turn", stage)
+        try:
+            response = await acomplete(
+                route,
+                call,
+                messages=self._fused_messages(
+                    user_message, history, profile, topic_description, stage, target_stance
+                ),
+                response_format={"type": "json_object"},
+            )
+            output = json.loads(response_text(self.usage, call, response))
+            reply = validate_reply(output.get("reply"))
+            call.ok()
+        except Exception as e:
+            print(f"Fused Agent Error: {e}")
+            call.fail(e)
+            return REPLY_FALLBACK, profile
+        return reply, self._turn_profile(output, profile)
+
+    def _turn_profile(self, output, profile):
+        """The updated profile from a fused completion, or the previous one if it is invalid."""
+        try:
+            return validate_profile({**profile, **output.get("profile", {})})
+        except (TypeError, ValueError) as e:
+            print(f"Fused Agent Profile Error: {e}")
+            return profile
 
 
 def decide_stage(turn_count, current_profile, target_stance="pro"):
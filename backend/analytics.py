@@ -0,0 +1,286 @@
+"""
+Pre/post survey analytics over every stored session.
+
+Sessions are streamed from the session store into flat NumPy arrays (one row
+per session and question) and all statistics are computed on those arrays.
+The arrays are cached in data/analytics_cache.npz together with the store's
+change cursor (file mtimes, JSONL offset or SQLite rowid), so reruns only
+read sessions written since the last run, including late writes and
+re-saves, whose rows replace the session's earlier ones.
+Sessions from backend.simulate are left out unless --simulated is given, in
+which case only they are read (cached in analytics_cache_simulated.npz).
+
+    python -m backend.analytics --bootstrap 2000
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from backend.storage import DATA_DIR, get_store
+
+ANALYTICS_CACHE = os.path.join(DATA_DIR, "analytics_cache.npz")
+SIMULATED_CACHE = os.path.join(DATA_DIR, "analytics_cache_simulated.npz")
+# Largest resample matrix drawn at once by bootstrap_ci
+BOOTSTRAP_CHUNK_ELEMENTS = 4_000_000
+
+COLUMNS = ["session", "item", "stance", "style", "pre", "post"]
+VOCABS = ["sessions", "items", "stances", "styles"]
+
+
+class SurveyFrame:
+    """
+    Columnar pre/post data. Integer columns index into the vocabularies:
+    `items` holds (topic id, question) pairs, `sessions` the session ids.
+    """
+
+    def __init__(self):
+        self.columns = {name: [] for name in COLUMNS}
+        self.vocabs = {name: [] for name in VOCABS}
+        self._lookup = {name: {} for name in VOCABS}
+        # {"store": store class name, "position": its changes() cursor}
+        self.cursor = None
+
+    def _code(self, vocab, value):
+        lookup = self._lookup[vocab]
+        if value not in lookup:
+            lookup[value] = len(self.vocabs[vocab])
+            self.vocabs[vocab].append(value)
+        return lookup[value]
+
+    def _drop_session(self, session):
+        keep = [i for i, s in enumerate(self.columns["session"]) if s != session]
+        for name in COLUMNS:
+            self.columns[name] = [self.columns[name][i] for i in keep]
+
+    def add_session(self, record):
+        """
+        Adds a session's rows, replacing those of an earlier save of it.
+        Returns True if the frame changed.
+        """
+        pre = record.get("pre_survey") or {}
+        post = record.get("post_survey") or {}
+        topic = record.get("topic") or {}
+        topic_id = topic.get("id") if isinstance(topic, dict) else topic
+        profile = record.get("final_profile") or {}
+        session_id = record.get("session_id")
+        answered = [q for q in pre if q in post]
+        replaced = session_id in self._lookup["sessions"]
+        if replaced:
+            self._drop_session(self._lookup["sessions"][session_id])
+        if not answered:
+            return replaced
+
+        session = self._code("sessions", session_id)
+        stance = self._code("stances", profile.get("stance", "unknown"))
+        style = self._code("styles", profile.get("style", "unknown"))
+        for question in answered:
+            self.columns["session"].append(session)
+            self.columns["item"].append(self._code("items", f"{topic_id}\t{question}"))
+            self.columns["stance"].append(stance)
+            self.columns["style"].append(style)
+            self.columns["pre"].append(pre[question])
+            self.columns["post"].append(post[question])
+        return True
+
+    def arrays(self):
+        arrays = {name: np.asarray(values) for name, values in self.columns.items()}
+        for name in ["session", "item", "stance", "style"]:
+            arrays[name] = arrays[name].astype(np.int64)
+        for name in ["pre", "post"]:
+            arrays[name] = arrays[name].astype(np.float64)
+        return arrays
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            cursor=np.asarray(json.dumps(self.cursor)),
+            **self.arrays(),
+            **{f"vocab_{name}": np.asarray(values, dtype=str) for name, values in self.vocabs.items()},
+        )
+
+    @classmethod
+    def load(cls, path):
+        frame = cls()
+        with np.load(path) as data:
+            for name in COLUMNS:
+                frame.columns[name] = data[name].tolist()
+            for name in VOCABS:
+                frame.vocabs[name] = data[f"vocab_{name}"].tolist()
+                frame._lookup[name] = {v: i for i, v in enumerate(frame.vocabs[name])}
+            # Caches from before the cursor are rebuilt by load_frame
+            frame.cursor = json.loads(str(data["cursor"])) if "cursor" in data else None
+        return frame
+
+
+def load_frame(store=None, cache_path=ANALYTICS_CACHE, refresh=False, simulated=False):
+    """
+    Loads the cached frame and adds the sessions written to the store since
+    its cursor. Reads either real or simulated sessions, never both.
+    Returns the frame and the number of sessions added or replaced.
+    """
+    store = store or get_store()
+    kind = type(store).__name__
+    frame = SurveyFrame.load(cache_path) if os.path.exists(cache_path) and not refresh else None
+    if frame is None or (frame.cursor or {}).get("store") != kind:
+        # A cursor is only meaningful for the store that issued it
+        frame = SurveyFrame()
+    previous = frame.cursor["position"] if frame.cursor else None
+
+    added = 0
+    position, records = store.changes(previous)
+    for record in records:
+        if bool(record.get("simulated")) != simulated:
+            continue
+        if frame.add_session(record):
+            added += 1
+    frame.cursor = {"store": kind, "position": position}
+
+    if added or position != previous or not os.path.exists(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        frame.save(cache_path)
+    return frame, added
+
+
+def group_stats(values, groups, n_groups):
+    """Per-group count, mean and sample standard deviation, via bincount."""
+    counts = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    sums = np.bincount(groups, weights=values, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        squares = np.bincount(groups, weights=(values - means[groups]) ** 2, minlength=n_groups)
+        variances = squares / (counts - 1)
+    return counts, means, np.sqrt(variances)
+
+
+def effect_size(means, sds):
+    """Standardized mean change (Cohen's d_z); NaN when there is no spread."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(sds > 0, means / sds, np.nan)
+
+
+def bootstrap_ci(values, groups, n_groups, n_boot=2000, alpha=0.05, seed=0):
+    """
+    Percentile bootstrap CI of each group's mean, resampling within groups.
+    Returns (low, high) arrays; groups with fewer than 2 rows get NaN.
+    """
+    rng = np.random.default_rng(seed)
+    low = np.full(n_groups, np.nan)
+    high = np.full(n_groups, np.nan)
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(n_groups + 1))
+    for g in range(n_groups):
+        sample = values[order[bounds[g]:bounds[g + 1]]]
+        if sample.size < 2:
+            continue
+        # Resample in chunks to bound memory on large groups
+        chunk = max(1, BOOTSTRAP_CHUNK_ELEMENTS // sample.size)
+        means = np.concatenate([
+            sample[rng.integers(0, sample.size, size=(min(chunk, n_boot - start), sample.size))].mean(axis=1)
+            for start in range(0, n_boot, chunk)
+        ])
+        low[g], high[g] = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return low, high
+
+
+def summarize(frame, n_boot=2000, seed=0):
+    """Per-question, per-topic and per-stance/style opinion shift statistics."""
+    a = frame.arrays()
+    if a["pre"].size == 0:
+        return {"questions": [], "topics": [], "by_stance": [], "by_style": []}
+    delta = a["post"] - a["pre"]
+    items = [item.split("\t", 1) for item in frame.vocabs["items"]]
+
+    # Per question
+    n_items = len(items)
+    counts, mean_delta, sd_delta = group_stats(delta, a["item"], n_items)
+    _, mean_pre, _ = group_stats(a["pre"], a["item"], n_items)
+    _, mean_post, _ = group_stats(a["post"], a["item"], n_items)
+    low, high = bootstrap_ci(delta, a["item"], n_items, n_boot=n_boot, seed=seed)
+    effect = effect_size(mean_delta, sd_delta)
+    questions = [
+        {
+            "topic": items[i][0],
+            "question": items[i][1],
+            "n": int(counts[i]),
+            "mean_pre": float(mean_pre[i]),
+            "mean_post": float(mean_post[i]),
+            "mean_delta": float(mean_delta[i]),
+            "effect_size": float(effect[i]),
+            "ci_low": float(low[i]),
+            "ci_high": float(high[i]),
+        }
+        for i in range(n_items)
+    ]
+
+    # Per session mean shift, then per topic / stance / style
+    n_sessions = len(frame.vocabs["sessions"])
+    _, session_delta, _ = group_stats(delta, a["session"], n_sessions)
+    sessions, first_row = np.unique(a["session"], return_index=True)
+    session_delta = session_delta[sessions]
+    topic_names = sorted({topic for topic, _ in items})
+    topic_codes = np.asarray([topic_names.index(items[i][0]) for i in range(n_items)])
+    session_topic = topic_codes[a["item"][first_row]]
+    session_stance = a["stance"][first_row]
+    session_style = a["style"][first_row]
+
+    def breakdown(codes, names):
+        n = len(names)
+        counts, means, sds = group_stats(session_delta, codes, n)
+        low, high = bootstrap_ci(session_delta, codes, n, n_boot=n_boot, seed=seed)
+        effect = effect_size(means, sds)
+        return [
+            {
+                "group": names[g],
+                "sessions": int(counts[g]),
+                "mean_delta": float(means[g]),
+                "effect_size": float(effect[g]),
+                "ci_low": float(low[g]),
+                "ci_high": float(high[g]),
+            }
+            for g in range(n) if counts[g]
+        ]
+
+    return {
+        "questions": questions,
+        "topics": breakdown(session_topic, topic_names),
+        "by_stance": breakdown(session_stance, frame.vocabs["stances"]),
+        "by_style": breakdown(session_style, frame.vocabs["styles"]),
+    }
+
+
+def print_report(summary):
+    print(f"{'topic / question':<60}{'n':>6}{'delta':>8}{'d':>7}{'95% CI':>18}")
+    for q in summary["questions"]:
+        label = f"{q['topic']}: {q['question']}"[:58]
+        print(f"{label:<60}{q['n']:>6}{q['mean_delta']:>+8.2f}{q['effect_size']:>7.2f}"
+              f"   [{q['ci_low']:+.2f}, {q['ci_high']:+.2f}]")
+    for title, key in [("Topic", "topics"), ("Final stance", "by_stance"), ("Final style", "by_style")]:
+        print(f"\n{title:<60}{'n':>6}{'delta':>8}{'d':>7}{'95% CI':>18}")
+        for row in summary[key]:
+            print(f"{row['group']:<60}{row['sessions']:>6}{row['mean_delta']:>+8.2f}"
+                  f"{row['effect_size']:>7.2f}   [{row['ci_low']:+.2f}, {row['ci_high']:+.2f}]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre/post survey opinion shift analytics")
+    parser.add_argument("--bootstrap", type=int, default=2000, help="bootstrap resamples")
+    parser.add_argument("--refresh", action="store_true", help="ignore the cached arrays")
+    parser.add_argument("--json", help="also write the summary to this file")
+    parser.add_argument("--simulated", action="store_true",
+                        help="analyze backend.simulate sessions instead of real ones")
+    args = parser.parse_args()
+
+    cache_path = SIMULATED_CACHE if args.simulated else ANALYTICS_CACHE
+    frame, added = load_frame(cache_path=cache_path, refresh=args.refresh, simulated=args.simulated)
+    print(f"{len(frame.vocabs['sessions'])} sessions ({added} new)\n")
+    summary = summarize(frame, n_boot=args.bootstrap)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
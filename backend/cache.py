@@ -0,0 +1,203 @@
+"""
+Persistent cache for the "Start Chat" responses.
+
+analyze_survey and generate_opening only depend on the topic and the survey
+answers, so their outputs are cached per (topic id, topic version, answer
+vector, model, prompt version). Several variants are kept per key and served
+in rotation. Live traffic tops keys up to CACHE_VARIANTS in the background
+(see AgentService), and the warm command fills them offline.
+
+Warm up the cache offline with:
+
+    python -m backend.cache warm --variants 2
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from backend.agents import START_PROMPT_VERSION
+from backend.config import load_topics, topic_version
+from backend.storage import DATA_DIR
+
+CACHE_FILE = os.path.join(DATA_DIR, "response_cache.db")
+CACHE_MAX_KEYS = int(os.getenv("CACHE_MAX_KEYS", "20000"))
+CACHE_VARIANTS = int(os.getenv("CACHE_VARIANTS", "3"))
+
+SLIDER_VALUES = range(1, 11)
+
+
+def answer_vector(topic, survey_answers):
+    """Survey answers in the topic's question order."""
+    return [survey_answers.get(q) for q in topic["questions"]]
+
+
+def cache_key(topic, survey_answers, model):
+    content = json.dumps([
+        topic["id"],
+        topic_version(topic),
+        answer_vector(topic, survey_answers),
+        model,
+        START_PROMPT_VERSION,
+    ])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_FILE, max_keys=CACHE_MAX_KEYS, variants=CACHE_VARIANTS):
+        self.path = path
+        self.max_keys = max_keys
+        self.variants = variants
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_keys ("
+                "key TEXT PRIMARY KEY, last_used REAL, next_variant INTEGER DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_variants ("
+                "key TEXT, variant INTEGER, profile TEXT, opening TEXT, created REAL, "
+                "PRIMARY KEY (key, variant))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache_keys (last_used)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, topic, survey_answers, model):
+        """
+        Returns (profile, opening) for the next variant in rotation,
+        or None on a miss.
+        """
+        key = cache_key(topic, survey_answers, model)
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT next_variant FROM cache_keys WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            rows = conn.execute(
+                "SELECT profile, opening FROM cache_variants WHERE key = ? ORDER BY variant",
+                (key,),
+            ).fetchall()
+            if not rows:
+                return None
+            profile, opening = rows[row[0] % len(rows)]
+            conn.execute(
+                "UPDATE cache_keys SET last_used = ?, next_variant = ? WHERE key = ?",
+                (time.time(), (row[0] + 1) % len(rows), key),
+            )
+        return json.loads(profile), opening
+
+    def count(self, topic, survey_answers, model):
+        """Number of variants stored for these answers."""
+        key = cache_key(topic, survey_answers, model)
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM cache_variants WHERE key = ?", (key,)
+            ).fetchone()[0]
+
+    def put(self, topic, survey_answers, model, profile, opening):
+        """Stores a variant, replacing the oldest one once the key is full."""
+        key = cache_key(topic, survey_answers, model)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO cache_keys (key, last_used) VALUES (?, ?)",
+                (key, now),
+            )
+            variants = [r[0] for r in conn.execute(
+                "SELECT variant FROM cache_variants WHERE key = ? ORDER BY created",
+                (key,),
+            )]
+            if len(variants) < self.variants:
+                variant = len(variants)
+            else:
+                variant = variants[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_variants VALUES (?, ?, ?, ?, ?)",
+                (key, variant, json.dumps(profile), opening, now),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        # Drop least recently used keys beyond max_keys
+        stale = conn.execute(
+            "SELECT key FROM cache_keys ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+            (self.max_keys,),
+        ).fetchall()
+        for (key,) in stale:
+            conn.execute("DELETE FROM cache_variants WHERE key = ?", (key,))
+            conn.execute("DELETE FROM cache_keys WHERE key = ?", (key,))
+
+
+def generate_start(profiler, persuader, topic, survey_answers):
+    """
+    Runs the uncached Start Chat calls. Returns (profile, opening), or None
+    when either agent fell back to its canned output, which must not be cached.
+    """
+    description = topic["description"]
+    profile = profiler.analyze_survey(survey_answers, description)
+    opening = persuader.generate_opening(profile, description, survey_answers)
+    if profile == profiler._survey_fallback(survey_answers):
+        return None
+    if opening == persuader._opening_fallback(description):
+        return None
+    return profile, opening
+
+
+def warm(topics, variants=CACHE_VARIANTS, workers=4, limit=None):
+    """Fills the cache for every answer vector of the given topics."""
+    from backend.agents import START_MODEL, ProfilerAgent, PersuaderAgent
+
+    cache = ResponseCache(variants=variants)
+    profiler = ProfilerAgent()
+    persuader = PersuaderAgent()
+
+    jobs = []
+    for topic in topics:
+        for values in itertools.product(SLIDER_VALUES, repeat=len(topic["questions"])):
+            answers = dict(zip(topic["questions"], values))
+            missing = variants - cache.count(topic, answers, START_MODEL)
+            jobs.extend([(topic, answers)] * max(missing, 0))
+    if limit is not None:
+        jobs = jobs[:limit]
+    print(f"Warming {len(jobs)} cache entries...")
+
+    def run(job):
+        topic, answers = job
+        result = generate_start(profiler, persuader, topic, answers)
+        if result is not None:
+            cache.put(topic, answers, START_MODEL, *result)
+        return result is not None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stored = sum(pool.map(run, jobs))
+    print(f"Stored {stored} of {len(jobs)} entries.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start Chat response cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    warm_parser = sub.add_parser("warm", help="fill the cache offline")
+    warm_parser.add_argument("--topic", help="only warm this topic id")
+    warm_parser.add_argument("--variants", type=int, default=CACHE_VARIANTS)
+    warm_parser.add_argument("--workers", type=int, default=4)
+    warm_parser.add_argument("--limit", type=int, help="stop after this many LLM pairs")
+    args = parser.parse_args()
+
+    topics = load_topics()
+    if args.topic:
+        topics = [t for t in topics if t["id"] == args.topic]
+    warm(topics, variants=args.variants, workers=args.workers, limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import json
+
+# Token budget for the whole reply prompt and number of user/assistant
+# exchanges that are always kept verbatim
+REPLY_TOKEN_BUDGET = int(os.getenv("REPLY_TOKEN_BUDGET", "3000"))
+REPLY_KEEP_TURNS = int(os.getenv("REPLY_KEEP_TURNS", "4"))
+
+# Longest excerpt kept per message in the local summary
+SUMMARY_EXCERPT_CHARS = 120
+
+
+def estimate_tokens(text):
+    """Rough local token count (about 4 characters per token for English)."""
+    return (len(text) + 3) // 4
+
+
+def compact_json(data):
+    """Serializes data without indentation or padding whitespace."""
+    return json.dumps(data, separators=(",", ":"))
+
+
+def _excerpt(message):
+    content = " ".join(message.get("content", "").split())
+    for end in (". ", "? ", "! "):
+        if end in content:
+            content = content[:content.index(end) + 1]
+            break
+    if len(content) > SUMMARY_EXCERPT_CHARS:
+        content = content[:SUMMARY_EXCERPT_CHARS - 3].rstrip() + "..."
+    return f"{message.get('role', 'user')}: {content}"
+
+
+class HistoryCompactor:
+    """
+    Fits a conversation history into a token budget.
+
+    The last `keep_turns` exchanges stay verbatim; older messages are replaced
+    by a summary. Without an external summary (e.g. the incremental profiler's
+    rolling summary), a local one is built from the first sentence of each old
+    message. The excerpts are cached for as long as the older messages only
+    grow, as they do while compact() moves the split forward or when the
+    compactor is reused within one conversation.
+    """
+
+    def __init__(self, budget=REPLY_TOKEN_BUDGET, keep_turns=REPLY_KEEP_TURNS):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        # The messages the cached lines summarize, compared by content
+        self._summarized = []
+        self._summary_lines = []
+
+    def _local_summary(self, older):
+        if older[:len(self._summarized)] != self._summarized:
+            # Not a continuation of the cached messages (e.g. another conversation)
+            self._summarized = []
+            self._summary_lines = []
+        for message in older[len(self._summarized):]:
+            self._summary_lines.append(_excerpt(message))
+        self._summarized = list(older)
+        return "\n".join(self._summary_lines)
+
+    def compact(self, history, summary=None, reserved_tokens=0):
+        """
+        Returns (summary_text, history_text, stats).
+
+        `reserved_tokens` is the size of the rest of the prompt. summary_text is
+        empty when nothing had to be dropped. stats reports the estimated
+        tokens before and after compaction and how many were saved.
+        """
+        tokens_before = estimate_tokens(json.dumps(history, indent=2))
+        available = max(self.budget - reserved_tokens, 0)
+
+        split = max(len(history) - 2 * self.keep_turns, 0)
+        summary_text = ""
+        while True:
+            recent_text = compact_json(history[split:])
+            if split:
+                summary_text = summary or self._local_summary(history[:split])
+            used = estimate_tokens(recent_text) + estimate_tokens(summary_text)
+            # Always keep the newest exchange, even over budget
+            if used <= available or split >= len(history) - 2:
+                break
+            split += 1
+
+        if estimate_tokens(summary_text) + estimate_tokens(recent_text) > available:
+            max_chars = max(available - estimate_tokens(recent_text), 0) * 4
+            summary_text = summary_text[-max_chars:] if max_chars else ""
+            if "\n" in summary_text:
+                # Drop the line that was cut in half
+                summary_text = summary_text.split("\n", 1)[1]
+
+        tokens_after = estimate_tokens(recent_text) + estimate_tokens(summary_text)
+        stats = {
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "saved": tokens_before - tokens_after,
+            "summarized_messages": split,
+        }
+        return summary_text, recent_text, stats
@@ -1,20 +1,116 @@
+import copy
+import hashlib
 import json
 import os
+import stat
+import tempfile
+import threading
+import time
 
 TOPICS_FILE = os.path.join(os.path.dirname(__file__), "topics.json")
+# How often (seconds) the registry stats topics.json for changes by other processes
+TOPICS_CHECK_INTERVAL = float(os.getenv("TOPICS_CHECK_INTERVAL", "1.0"))
+
+
+class TopicRegistry:
+    """
+    In-memory topic list with an id index.
+
+    The file is only re-read when its mtime or size changes, and that is
+    checked at most every `check_interval` seconds, so other server processes
+    pick up admin edits without a restart. Writes go to a temp file that is
+    renamed over topics.json with the same permissions, so readers never see
+    a half-written file.
+    """
+
+    def __init__(self, path=TOPICS_FILE, check_interval=TOPICS_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._topics = []
+        self._index = {}
+        self._stamp = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        stamp = self._file_stamp()
+        if stamp == self._stamp and not force:
+            return
+        topics = []
+        if stamp is not None:
+            with open(self.path, "r") as f:
+                topics = json.load(f)
+        self._topics = topics
+        self._index = {topic["id"]: topic for topic in topics}
+        self._stamp = stamp
+        self.version += 1
+
+    def topics(self):
+        """Returns a copy of all topics, safe to modify."""
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._topics)
+
+    def get(self, topic_id):
+        with self._lock:
+            self._refresh()
+            topic = self._index.get(topic_id)
+            return copy.deepcopy(topic) if topic is not None else None
+
+    def save(self, topics):
+        """Atomically replaces the topics file and the cached index."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".topics-", suffix=".json")
+            try:
+                # mkstemp creates the file 0600; keep the permissions of the one it replaces
+                try:
+                    mode = stat.S_IMODE(os.stat(self.path).st_mode)
+                except FileNotFoundError:
+                    mode = 0o644
+                os.fchmod(fd, mode)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(topics, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._refresh(force=True)
+
+
+_registry = TopicRegistry()
 
 def load_topics():
     """Loads topics from the JSON configuration file."""
-    if not os.path.exists(TOPICS_FILE):
-        return []
-    
-    with open(TOPICS_FILE, "r") as f:
-        return json.load(f)
+    return _registry.topics()
 
 def get_topic_by_id(topic_id):
     """Retrieves a specific topic by its ID."""
-    topics = load_topics()
-    for topic in topics:
-        if topic["id"] == topic_id:
-            return topic
-    return None
+    return _registry.get(topic_id)
+
+def save_topics(topics):
+    """Writes the topics back to the JSON configuration file."""
+    _registry.save(topics)
+
+def topic_version(topic):
+    """Short hash of the topic fields that prompts depend on."""
+    content = json.dumps(
+        [topic.get("description", ""), topic.get("questions", [])],
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
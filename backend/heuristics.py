@@ -0,0 +1,111 @@
+import re
+
+from backend.agents import ProfilerAgent, PROFILE_FULL_REFRESH_EVERY
+
+# Messages longer than this are treated as substantive and always go to the LLM
+FAST_PATH_MAX_WORDS = 6
+FAST_PATH_MIN_CONFIDENCE = 0.6
+
+AGREE = {"ok", "okay", "k", "yes", "yeah", "yep", "sure", "true", "fair", "agreed",
+         "right", "exactly", "good point", "makes sense", "i agree", "fair enough"}
+DISAGREE = {"no", "nope", "nah", "disagree", "wrong", "never", "not really",
+            "i disagree", "no way", "not true"}
+UNSURE = {"idk", "i dont know", "i don't know", "dunno", "not sure", "maybe",
+          "i guess", "hmm", "depends", "it depends", "idk it depends", "perhaps"}
+# Cues that the short message carries more than it seems. Words and phrases
+# match whole words ("but" not in "button"); punctuation matches anywhere.
+ESCALATE_CUES = ("because", "but", "why", "lol", "/s", "yeah right")
+ESCALATE_MARKS = ("?", "!")
+_ESCALATE_PATTERN = re.compile(r"(?<![\w/])(?:" + "|".join(map(re.escape, ESCALATE_CUES)) + r")(?!\w)")
+
+
+def _normalize(text):
+    text = text.lower().strip()
+    text = re.sub(r"[^\w\s'?!/]", " ", text)
+    return " ".join(text.split())
+
+
+def estimate_profile(user_message, previous_profile):
+    """
+    Estimates the updated profile from lexical features of a short message.
+
+    Returns (profile, confidence). The stance is kept; agreement or
+    disagreement nudges change_readiness and confidence_in_stance, and the
+    style becomes "brief".
+    """
+    text = _normalize(user_message)
+    words = text.split()
+    profile = dict(previous_profile)
+    profile["style"] = "brief"
+
+    if _ESCALATE_PATTERN.search(text) or any(mark in text for mark in ESCALATE_MARKS):
+        return profile, 0.2
+
+    stripped = text.rstrip(".")
+    readiness = profile.get("change_readiness", 5)
+    confidence_in_stance = profile.get("confidence_in_stance", 0.5)
+
+    if stripped in AGREE:
+        profile["tone"] = "agreeable"
+        profile["change_readiness"] = min(readiness + 1, 10)
+        profile["confidence_in_stance"] = round(max(confidence_in_stance - 0.05, 0.0), 2)
+        return profile, 0.8
+    if stripped in DISAGREE:
+        profile["tone"] = "defensive"
+        profile["change_readiness"] = max(readiness - 1, 0)
+        profile["confidence_in_stance"] = round(min(confidence_in_stance + 0.05, 1.0), 2)
+        return profile, 0.8
+    if stripped in UNSURE:
+        profile["tone"] = "uncertain"
+        return profile, 0.75
+
+    # Short but not a known phrase
+    return profile, 0.5 if len(words) <= 2 else 0.3
+
+
+class FastPathProfilerAgent(ProfilerAgent):
+    """
+    ProfilerAgent that answers trivial turns ("ok", "idk") from local lexical
+    features and the previous profile, and only calls the LLM when the message
+    is substantive or the estimate is not confident enough.
+
+    `counters` records how often each path was taken.
+    """
+
+    def __init__(
+        self,
+        incremental=False,
+        full_refresh_every=PROFILE_FULL_REFRESH_EVERY,
+        max_words=FAST_PATH_MAX_WORDS,
+        min_confidence=FAST_PATH_MIN_CONFIDENCE,
+    ):
+        super().__init__(incremental=incremental, full_refresh_every=full_refresh_every)
+        self.max_words = max_words
+        self.min_confidence = min_confidence
+        self.counters = {"fast": 0, "llm_substantive": 0, "llm_low_confidence": 0, "llm_no_profile": 0}
+
+    def _fast_profile(self, user_message, previous_profile):
+        """The local estimate when it is good enough, otherwise None (the LLM is needed)."""
+        if not previous_profile:
+            self.counters["llm_no_profile"] += 1
+        elif len(user_message.split()) > self.max_words:
+            self.counters["llm_substantive"] += 1
+        else:
+            profile, confidence = estimate_profile(user_message, previous_profile)
+            if confidence >= self.min_confidence:
+                self.counters["fast"] += 1
+                return profile
+            self.counters["llm_low_confidence"] += 1
+        return None
+
+    def analyze(self, user_message, history, topic_description, previous_profile=None, on_fields=None):
+        profile = self._fast_profile(user_message, previous_profile)
+        if profile is not None:
+            return profile
+        return super().analyze(user_message, history, topic_description, previous_profile, on_fields)
+
+    async def aanalyze(self, user_message, history, topic_description, previous_profile=None, on_fields=None):
+        profile = self._fast_profile(user_message, previous_profile)
+        if profile is not None:
+            return profile
+        return await super().aanalyze(user_message, history, topic_description, previous_profile, on_fields)
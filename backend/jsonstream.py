@@ -0,0 +1,61 @@
+"""
+Incremental parsing of a JSON object that arrives in pieces, e.g. a streamed
+json_object completion.
+"""
+import json
+
+
+class JsonFieldParser:
+    """
+    Feed it the text of one JSON object chunk by chunk. feed() returns the
+    top-level fields completed by that chunk; `fields` holds every field
+    completed so far. A field is complete once the comma or closing brace
+    after its value arrives, so its value is final. Malformed members are
+    skipped and left to the json.loads of the full text.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None
+
+    def feed(self, text):
+        self._buffer += text
+        completed = {}
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = self._pos + 1
+            elif ch in "}]" or (ch == "," and self._depth == 1):
+                if self._depth == 1 and self._member_start is not None:
+                    completed.update(self._parse_member(self._buffer[self._member_start:self._pos]))
+                    self._member_start = self._pos + 1
+                if ch != ",":
+                    self._depth -= 1
+            self._pos += 1
+        self.fields.update(completed)
+        return completed
+
+    @staticmethod
+    def _parse_member(text):
+        if not text.strip():
+            return {}
+        try:
+            return json.loads("{" + text + "}")
+        except ValueError:
+            return {}
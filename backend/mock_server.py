@@ -0,0 +1,236 @@
+"""
+Local stand-in for the OpenAI chat-completions API.
+
+Serves POST /v1/chat/completions with canned replies, JSON profiles for
+json_object requests (profile plus reply for fused calls) and server-sent
+events for stream=True. Latency and
+error rate are configurable so load tests can model a slow or flaky provider.
+
+    python -m backend.mock_server --port 8008 --latency lognormal:-0.5,0.4 --error-rate 0.02
+
+Point the agents at it with OPENAI_BASE_URL=http://127.0.0.1:8008/v1.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_REPLIES = [
+    "That makes sense. What experience shaped that view for you?",
+    "I hear you. Which part of this matters most to you?",
+    "Fair point. Some people see it differently because of cost; how does that sit with you?",
+    "It sounds like you value fairness here. Where do you think the balance lies?",
+]
+
+MOCK_PROFILE = {
+    "stance": "mixed",
+    "change_readiness": 5,
+    "confidence_in_stance": 0.5,
+    "style": "rational",
+    "tone": "curious",
+    "key_values": ["fairness", "practicality", "health"],
+    "good_moves": "Use concrete examples and stay calm.",
+    "bad_moves": "Do not lecture or pile on statistics.",
+    "summary": "The user is weighing practical concerns against their values.",
+}
+
+
+def parse_latency(spec):
+    """
+    Parses a latency spec into a sampler returning seconds:
+    "fixed:0.5", "uniform:0.2,1.5" or "lognormal:mu,sigma".
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    latency = staticmethod(lambda: 0.0)
+    token_delay = 0.0
+    error_rate = 0.0
+    error_status = 500
+    seen_prefixes = set()
+    prefix_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(max(self.latency(), 0.0))
+
+        if random.random() < self.error_rate:
+            self._send_json(self.error_status, {
+                "error": {"message": "mock upstream error", "type": "server_error"}
+            })
+            return
+
+        messages = request.get("messages", [])
+        system = messages[0].get("content", "") if messages else ""
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            if system.startswith("You do two jobs"):
+                # Fused profiler + persuader call
+                content = json.dumps({"profile": MOCK_PROFILE, "reply": random.choice(MOCK_REPLIES)})
+            else:
+                content = json.dumps(MOCK_PROFILE)
+        else:
+            content = random.choice(MOCK_REPLIES)
+
+        prompt_text = " ".join(str(m.get("content", "")) for m in messages)
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt_text),
+            "completion_tokens": estimate_tokens(content),
+            "total_tokens": estimate_tokens(prompt_text) + estimate_tokens(content),
+            "prompt_tokens_details": {"cached_tokens": self._cached_tokens(messages)},
+        }
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self._stream(completion_id, model, content, usage if include_usage else None)
+            return
+
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _cached_tokens(self, messages):
+        """Simulates prefix caching: a system message seen before counts as cached."""
+        if not messages or messages[0].get("role") != "system":
+            return 0
+        prefix = messages[0].get("content", "")
+        with self.prefix_lock:
+            seen = prefix in self.seen_prefixes
+            self.seen_prefixes.add(prefix)
+        return estimate_tokens(prefix) if seen else 0
+
+    def _stream(self, completion_id, model, content, usage=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            token = word if i == 0 else " " + word
+            self._send_event({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            })
+            time.sleep(self.token_delay)
+        self._send_event({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        })
+        if usage is not None:
+            self._send_event({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            })
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def make_server(host="127.0.0.1", port=8008, latency="fixed:0", token_delay=0.0,
+                error_rate=0.0, error_status=500):
+    """Builds a mock server with its own handler settings."""
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {
+        "latency": staticmethod(parse_latency(latency)),
+        "token_delay": token_delay,
+        "error_rate": error_rate,
+        "error_status": error_status,
+        "seen_prefixes": set(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(**kwargs):
+    """Starts a mock server on a daemon thread and returns it."""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat-completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--latency", default="fixed:0",
+                        help='fixed:S, uniform:LO,HI or lognormal:MU,SIGMA (seconds)')
+    parser.add_argument("--token-delay", type=float, default=0.0,
+                        help="seconds between streamed tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    server = make_server(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    print(f"Mock LLM listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+import asyncio
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.admission import LLM_MAX_IN_FLIGHT
+from backend.agents import STANCES, decide_stage
+from backend.telemetry import telemetry
+
+# "separate" (Profiler and Persuader calls), "fused" (one FusedAgent call per
+# turn) or "ab" (each session gets one of the two, by session id)
+AGENT_MODE = os.getenv("AGENT_MODE", "separate")
+
+# Stream inline profiling and start the reply as soon as the profile fields
+# decide_stage reads (stance, change_readiness) have arrived
+PROFILE_STREAMING = os.getenv("PROFILE_STREAMING", "1") == "1"
+# Longest wait for those fields before drafting from the previous profile
+PROFILE_EARLY_WAIT = float(os.getenv("PROFILE_EARLY_WAIT", "1.0"))
+
+# Shared by every session in the server process: inline and deferred
+# profiling and Start Chat's analyze_survey. Admission control already caps
+# the requests in flight, so the pool defaults to that cap and profiler
+# calls never queue here behind each other before they can be admitted.
+TURN_POOL_SIZE = int(os.getenv("TURN_POOL_SIZE", str(max(LLM_MAX_IN_FLIGHT, 8))))
+_executor = ThreadPoolExecutor(max_workers=TURN_POOL_SIZE, thread_name_prefix="turn")
+
+
+def count_user_turns(history):
+    """Counts the user messages in a conversation history."""
+    return len([m for m in history if m.get("role") == "user"])
+
+
+def needs_regeneration(old_profile, new_profile, turn_count, stage, target_stance="pro"):
+    """
+    Returns True when a fresh profile would have changed the reply: either the
+    stage picked by decide_stage or the inferred stance is different.
+    """
+    new_stage = decide_stage(turn_count, new_profile, target_stance=target_stance)
+    if new_stage != stage:
+        return True
+    return new_profile.get("stance", "mixed") != old_profile.get("stance", "mixed")
+
+
+def agent_mode_for(session_id, mode=AGENT_MODE):
+    """Returns "separate" or "fused" for a session; stable across restarts in "ab" mode."""
+    if mode != "ab":
+        return mode
+    digest = hashlib.sha256(session_id.encode("utf-8")).digest()
+    return "fused" if digest[0] % 2 else "separate"
+
+
+def start_profiling(profiler, user_message, history, topic_description, profile=None, on_fields=None):
+    """Runs ProfilerAgent.analyze in the background and returns its future."""
+    kwargs = {"on_fields": on_fields} if on_fields is not None else {}
+    return _executor.submit(
+        profiler.analyze,
+        user_message,
+        list(history),
+        topic_description,
+        previous_profile=profile,
+        **kwargs,
+    )
+
+
+def astart_profiling(profiler, user_message, history, topic_description, profile=None, on_fields=None):
+    """Async counterpart of start_profiling: runs aanalyze as a task on the running loop."""
+    kwargs = {"on_fields": on_fields} if on_fields is not None else {}
+    return asyncio.ensure_future(profiler.aanalyze(
+        user_message,
+        list(history),
+        topic_description,
+        previous_profile=profile,
+        **kwargs,
+    ))
+
+
+class StageFields:
+    """
+    on_fields callback for a streamed profile. `ready` is set once stance
+    and change_readiness have arrived with valid values, or when profiling
+    ends without them.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.ready = threading.Event()
+
+    def __call__(self, fields):
+        readiness = fields.get("change_readiness")
+        if (fields.get("stance") in STANCES and isinstance(readiness, (int, float))
+                and not isinstance(readiness, bool) and 0 <= readiness <= 10):
+            self.fields = {"stance": fields["stance"], "change_readiness": readiness}
+            self.ready.set()
+
+
+class AsyncStageFields(StageFields):
+    """StageFields for aanalyze, which calls it on the event loop."""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = asyncio.Event()
+
+
+def _draft_profile(profile, profile_future, stage_fields):
+    """
+    The profile to draft the reply from: the finished new profile, the
+    previous one updated with the streamed stage fields, or the previous
+    one when neither arrives within PROFILE_EARLY_WAIT.
+    """
+    stage_fields.ready.wait(PROFILE_EARLY_WAIT)
+    return _pick_draft(profile, profile_future, stage_fields)
+
+
+async def _adraft_profile(profile, profile_task, stage_fields):
+    try:
+        await asyncio.wait_for(stage_fields.ready.wait(), PROFILE_EARLY_WAIT)
+    except asyncio.TimeoutError:
+        pass
+    return _pick_draft(profile, profile_task, stage_fields)
+
+
+def _pick_draft(profile, profile_future, stage_fields):
+    if profile_future.done():
+        outcome, draft = "complete", profile_future.result()
+    elif stage_fields.fields:
+        outcome, draft = "early", {**profile, **stage_fields.fields}
+    else:
+        outcome, draft = "timeout", profile
+    telemetry.count("profile_early_fields_total", outcome=outcome)
+    return draft
+
+
+def _turn(profiler, write_reply, user_message, history, profile, topic_description, target_stance,
+          scheduler=None):
+    turn_count = count_user_turns(history)
+    if scheduler is not None:
+        profile = scheduler.resolve(profile)
+        decision, estimate = scheduler.plan(turn_count, profile, user_message, target_stance)
+        if decision != "inline":
+            current = estimate if decision == "skip" else profile
+            stage = decide_stage(turn_count, current, target_stance=target_stance)
+            reply = write_reply(current, stage)
+            if decision == "defer":
+                # Starts once the reply is out; resolve() picks it up next turn
+                scheduler.defer(start_profiling(profiler, user_message, history, topic_description, profile))
+            return {
+                "reply": reply,
+                "profile": current,
+                "stage": stage,
+                "regenerated": False,
+                "profiling": decision,
+            }
+
+    if PROFILE_STREAMING:
+        stage_fields = StageFields()
+        profile_future = start_profiling(profiler, user_message, history, topic_description, profile,
+                                         on_fields=stage_fields)
+        # Fast-path and failed profiling never stream the fields
+        profile_future.add_done_callback(lambda _: stage_fields.ready.set())
+        draft = _draft_profile(profile, profile_future, stage_fields)
+    else:
+        profile_future = start_profiling(profiler, user_message, history, topic_description, profile)
+        draft = profile
+
+    stage = decide_stage(turn_count, draft, target_stance=target_stance)
+    reply = write_reply(draft, stage)
+    new_profile = profile_future.result()
+    if scheduler is not None:
+        scheduler.observe(profile, new_profile)
+
+    regenerated = False
+    if needs_regeneration(draft, new_profile, turn_count, stage, target_stance):
+        stage = decide_stage(turn_count, new_profile, target_stance=target_stance)
+        reply = write_reply(new_profile, stage)
+        regenerated = True
+
+    return {
+        "reply": reply,
+        "profile": new_profile,
+        "stage": stage,
+        "regenerated": regenerated,
+        "profiling": "inline",
+    }
+
+
+async def _aturn(profiler, write_reply, user_message, history, profile, topic_description, target_stance,
+                 scheduler=None):
+    """Async counterpart of _turn; `write_reply` is a coroutine function."""
+    turn_count = count_user_turns(history)
+    if scheduler is not None:
+        if scheduler.pending is not None:
+            # resolve() reads it without waiting
+            await asyncio.wait([scheduler.pending])
+        profile = scheduler.resolve(profile)
+        decision, estimate = scheduler.plan(turn_count, profile, user_message, target_stance)
+        if decision != "inline":
+            current = estimate if decision == "skip" else profile
+            stage = decide_stage(turn_count, current, target_stance=target_stance)
+            reply = await write_reply(current, stage)
+            if decision == "defer":
+                scheduler.defer(astart_profiling(profiler, user_message, history, topic_description, profile))
+            return {
+                "reply": reply,
+                "profile": current,
+                "stage": stage,
+                "regenerated": False,
+                "profiling": decision,
+            }
+
+    if PROFILE_STREAMING:
+        stage_fields = AsyncStageFields()
+        profile_task = astart_profiling(profiler, user_message, history, topic_description, profile,
+                                        on_fields=stage_fields)
+        profile_task.add_done_callback(lambda _: stage_fields.ready.set())
+        draft = await _adraft_profile(profile, profile_task, stage_fields)
+    else:
+        profile_task = astart_profiling(profiler, user_message, history, topic_description, profile)
+        draft = profile
+
+    stage = decide_stage(turn_count, draft, target_stance=target_stance)
+    try:
+        reply = await write_reply(draft, stage)
+        new_profile = await profile_task
+    finally:
+        # Nothing else awaits it if the reply failed
+        profile_task.cancel()
+    if scheduler is not None:
+        scheduler.observe(profile, new_profile)
+
+    regenerated = False
+    if needs_regeneration(draft, new_profile, turn_count, stage, target_stance):
+        stage = decide_stage(turn_count, new_profile, target_stance=target_stance)
+        reply = await write_reply(new_profile, stage)
+        regenerated = True
+
+    return {
+        "reply": reply,
+        "profile": new_profile,
+        "stage": stage,
+        "regenerated": regenerated,
+        "profiling": "inline",
+    }
+
+
+def run_turn(
+    profiler,
+    persuader,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    target_stance="pro",
+    scheduler=None,
+):
+    """
+    Runs one chat turn with the Profiler and Persuader in parallel.
+
+    The reply is drafted straight away from the previous profile while the
+    profiler analyzes the new message. The draft is only regenerated when the
+    fresh profile changes the stage or the stance. With PROFILE_STREAMING the
+    profile is streamed and the draft waits (up to PROFILE_EARLY_WAIT) for its
+    stance and change_readiness, which the profiler writes first, so the
+    stage is usually decided from fresh values and nothing is regenerated.
+
+    With a ProfilingScheduler the profiler may instead run after the reply
+    (its profile arrives on the next turn) or be skipped for this turn.
+
+    `history` must already contain the latest user message.
+    Returns a dict with "reply", "profile", "stage", "regenerated" and
+    "profiling" (inline, defer or skip).
+    """
+    def write_reply(current_profile, stage):
+        return persuader.generate_reply(
+            user_message,
+            history,
+            current_profile,
+            topic_description,
+            stage=stage,
+            target_stance=target_stance,
+        )
+
+    return _turn(profiler, write_reply, user_message, history, profile, topic_description,
+                 target_stance, scheduler)
+
+
+def stream_turn(
+    profiler,
+    persuader,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    render,
+    target_stance="pro",
+    scheduler=None,
+):
+    """
+    Streaming counterpart of run_turn.
+
+    `render` receives a token generator and must return the full text, e.g. a
+    placeholder's write_stream. It is called a second time, with the
+    regenerated reply, if the fresh profile changes the stage or the stance.
+    """
+    def write_reply(current_profile, stage):
+        return render(persuader.stream_reply(
+            user_message,
+            history,
+            current_profile,
+            topic_description,
+            stage=stage,
+            target_stance=target_stance,
+        ))
+
+    return _turn(profiler, write_reply, user_message, history, profile, topic_description,
+                 target_stance, scheduler)
+
+
+async def arun_turn(
+    profiler,
+    persuader,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    target_stance="pro",
+    scheduler=None,
+):
+    """Async counterpart of run_turn, for the event loop of an async worker."""
+    async def write_reply(current_profile, stage):
+        return await persuader.agenerate_reply(
+            user_message,
+            history,
+            current_profile,
+            topic_description,
+            stage=stage,
+            target_stance=target_stance,
+        )
+
+    return await _aturn(profiler, write_reply, user_message, history, profile, topic_description,
+                        target_stance, scheduler)
+
+
+async def astream_turn(
+    profiler,
+    persuader,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    render,
+    target_stance="pro",
+    scheduler=None,
+):
+    """
+    Async counterpart of stream_turn. `render` is a coroutine function that
+    consumes an async generator of tokens and returns the full text.
+    """
+    async def write_reply(current_profile, stage):
+        return await render(persuader.astream_reply(
+            user_message,
+            history,
+            current_profile,
+            topic_description,
+            stage=stage,
+            target_stance=target_stance,
+        ))
+
+    return await _aturn(profiler, write_reply, user_message, history, profile, topic_description,
+                        target_stance, scheduler)
+
+
+async def _single(text):
+    yield text
+
+
+def fused_turn(
+    fused,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    render=None,
+    target_stance="pro",
+):
+    """
+    Fused counterpart of run_turn and stream_turn: one FusedAgent call returns
+    both the reply and the new profile. The stage is decided from the previous
+    profile, so there is nothing to regenerate.
+
+    `render`, if given, receives the finished reply as a one-item stream.
+    Returns the same keys as run_turn; profiling is always inline.
+    """
+    turn_count = count_user_turns(history)
+    stage = decide_stage(turn_count, profile, target_stance=target_stance)
+    reply, new_profile = fused.turn(
+        user_message, history, profile, topic_description, stage, target_stance=target_stance
+    )
+    if render is not None:
+        reply = render(iter([reply]))
+    return {
+        "reply": reply,
+        "profile": new_profile,
+        "stage": stage,
+        "regenerated": False,
+        "profiling": "inline",
+    }
+
+
+async def afused_turn(
+    fused,
+    user_message,
+    history,
+    profile,
+    topic_description,
+    render=None,
+    target_stance="pro",
+):
+    """Async counterpart of fused_turn; `render` is as in astream_turn."""
+    turn_count = count_user_turns(history)
+    stage = decide_stage(turn_count, profile, target_stance=target_stance)
+    reply, new_profile = await fused.aturn(
+        user_message, history, profile, topic_description, stage, target_stance=target_stance
+    )
+    if render is not None:
+        reply = await render(_single(reply))
+    return {
+        "reply": reply,
+        "profile": new_profile,
+        "stage": stage,
+        "regenerated": False,
+        "profiling": "inline",
+    }
@@ -0,0 +1,413 @@
+"""
+LLM providers and per-call model routing.
+
+Every agent call is routed to a model by (agent, method, stage). Models are
+written "provider:model"; a bare model name means OpenAI:
+
+    openai   api.openai.com, or OPENAI_BASE_URL (OPENAI_API_KEY)
+    gemini   Gemini's OpenAI-compatible endpoint (GEMINI_API_KEY)
+    local    any OpenAI-compatible server at LOCAL_LLM_BASE_URL, e.g. Ollama,
+             vLLM or backend.mock_server
+
+LLM_ROUTES is a ";"-separated list of PATTERN=MODEL rules, tried in order.
+PATTERN is agent.method.stage with fnmatch wildcards; missing trailing parts
+match anything. Calls no rule matches go to LLM_DEFAULT_MODEL:
+
+    LLM_ROUTES=profiler.*=gpt-5.1-mini;*.analyze_survey=gemini:gemini-2.5-flash;persuader.generate_reply.challenge=gpt-5.1
+
+Calls are recorded per route (the model label) with their latency, tokens
+and cost (see LLM_PRICES in backend.telemetry). To tune the rules:
+
+    python -m backend.providers routes
+    python -m backend.providers report data/llm_trace.jsonl
+
+The router is adaptive. It keeps rolling p50/p95 latency and error rates
+per model and SLO class, where the class is the stage of a reply or the
+method of other calls. Latency is the time to first token for streamed calls
+and the wall time otherwise. Once a model's p95 passes the class's SLO
+(LLM_SLO) or its error rate passes LLM_ROUTER_MAX_ERROR_RATE, that class's
+calls move to the model's fallback (LLM_FALLBACKS), provided the fallback is
+not slower. One call every LLM_ROUTER_PROBE_INTERVAL seconds still goes to
+the primary. Once those probes meet LLM_ROUTER_RECOVERY times the SLO, the
+calls move back. Every switch is printed and counted in
+llm_route_switches_total.
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from fnmatch import fnmatchcase
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from backend.telemetry import start_call, telemetry
+
+load_dotenv()
+
+LLM_DEFAULT_MODEL = os.getenv("LLM_DEFAULT_MODEL", "gpt-5.1")
+LLM_ROUTES = os.getenv("LLM_ROUTES", "")
+
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/openai/")
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL", "http://127.0.0.1:11434/v1")
+
+# Adaptive routing: "model=fallback" pairs, p95 latency SLOs in seconds per
+# stage or method, and when a model counts as degraded or recovered
+LLM_ADAPTIVE_ROUTING = os.getenv("LLM_ADAPTIVE_ROUTING", "1") == "1"
+LLM_FALLBACKS = os.getenv("LLM_FALLBACKS", "")
+LLM_SLO = os.getenv(
+    "LLM_SLO",
+    "rapport=3;explore=3;challenge=6;wrap_up=6;analyze=6;generate_opening=6;analyze_survey=15",
+)
+LLM_SLO_DEFAULT = float(os.getenv("LLM_SLO_DEFAULT", "10"))
+LLM_ROUTER_WINDOW = float(os.getenv("LLM_ROUTER_WINDOW", "60"))
+LLM_ROUTER_MIN_SAMPLES = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5"))
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.2"))
+LLM_ROUTER_RECOVERY = float(os.getenv("LLM_ROUTER_RECOVERY", "0.8"))
+LLM_ROUTER_PROBE_INTERVAL = float(os.getenv("LLM_ROUTER_PROBE_INTERVAL", "5"))
+
+# Connection pool of each provider's client, shared by every session in the process
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+# Agents, methods and stages, for listing the routes
+CALL_SITES = [
+    ("profiler", "analyze", None),
+    ("profiler", "analyze_survey", None),
+    ("persuader", "generate_opening", None),
+    *[("persuader", "generate_reply", stage) for stage in ("rapport", "explore", "challenge", "wrap_up")],
+    *[("fused", "fused_turn", stage) for stage in ("rapport", "explore", "challenge", "wrap_up")],
+    ("synthetic_user", "simulate_user", None),
+]
+
+
+def _pool_limits():
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+class Provider:
+    """One OpenAI-compatible API. Clients are created on first use."""
+
+    def __init__(self, name, base_url=None, api_key=None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        The provider's OpenAI client. It is thread-safe, so every session
+        thread in the process shares its pooled keep-alive connections.
+        """
+        with self._lock:
+            if self._client is None:
+                # Retries are done by the call policy in backend/resilience.py
+                self._client = OpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    timeout=LLM_TIMEOUT,
+                    max_retries=0,
+                    http_client=httpx.Client(limits=_pool_limits(), timeout=LLM_TIMEOUT),
+                )
+            return self._client
+
+    def async_client(self):
+        """
+        The provider's AsyncOpenAI client for the running event loop, on a
+        pool of the same size. Its connections belong to that loop, so every
+        session served by the loop shares them and each loop gets its own.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = AsyncOpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    timeout=LLM_TIMEOUT,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(limits=_pool_limits(), timeout=LLM_TIMEOUT),
+                )
+            return client
+
+
+PROVIDERS = {
+    # base_url None lets the SDK read OPENAI_BASE_URL
+    "openai": Provider("openai", None, os.getenv("OPENAI_API_KEY")),
+    "gemini": Provider("gemini", GEMINI_BASE_URL, os.getenv("GEMINI_API_KEY")),
+    "local": Provider("local", LOCAL_LLM_BASE_URL, os.getenv("LOCAL_LLM_API_KEY", "local")),
+}
+
+
+class Route:
+    """A model on a provider. `name` labels its calls in the telemetry."""
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+
+    @property
+    def name(self):
+        if self.provider.name == "openai":
+            return self.model
+        return f"{self.provider.name}:{self.model}"
+
+    @property
+    def client(self):
+        return self.provider.client
+
+    def async_client(self):
+        return self.provider.async_client()
+
+    def __repr__(self):
+        return f"Route({self.name})"
+
+
+def parse_model(spec):
+    """Turns "provider:model" (or a bare OpenAI model name) into a Route."""
+    provider, _, model = spec.strip().partition(":")
+    if not model:
+        provider, model = "openai", provider
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider {provider!r} in {spec!r}")
+    return Route(PROVIDERS[provider], model)
+
+
+def _pairs(text):
+    """Splits "a=b;c=d" into [("a", "b"), ("c", "d")]."""
+    pairs = []
+    for entry in text.split(";"):
+        if entry.strip():
+            key, _, value = entry.partition("=")
+            pairs.append((key.strip(), value.strip()))
+    return pairs
+
+
+def parse_rules(text):
+    """Parses LLM_ROUTES into [(pattern, Route)]."""
+    rules = []
+    for pattern, spec in _pairs(text):
+        parts = pattern.split(".")
+        parts += ["*"] * (3 - len(parts))
+        rules.append((".".join(parts), parse_model(spec)))
+    return rules
+
+
+class Router:
+    """Picks the Route for each call from the first matching rule."""
+
+    def __init__(self, rules=LLM_ROUTES, default=LLM_DEFAULT_MODEL):
+        self.rules = parse_rules(rules)
+        self.default = parse_model(default)
+
+    def route(self, agent, method, stage=None):
+        key = f"{agent}.{method}.{stage or '-'}"
+        for pattern, route in self.rules:
+            if fnmatchcase(key, pattern):
+                return route
+        return self.default
+
+    def start(self, agent, method, stage=None):
+        """Routes a call and starts its telemetry. Returns (route, call)."""
+        route = self.route(agent, method, stage)
+        return route, start_call(agent, method, route.name, stage)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p / 100 * len(values)), len(values) - 1)] if values else None
+
+
+class RollingStats:
+    """Latency and outcome of recent calls per key, over a time window."""
+
+    def __init__(self, window=LLM_ROUTER_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._samples = defaultdict(lambda: deque(maxlen=1000))
+        self._lock = threading.Lock()
+
+    def observe(self, key, latency, ok):
+        with self._lock:
+            self._samples[key].append((self.clock(), latency, ok))
+
+    def summary(self, key, since=None):
+        """
+        {"samples", "p50", "p95", "error_rate"} of the key's calls in the
+        window (and after `since`). The percentiles are over successful calls.
+        """
+        start = self.clock() - self.window
+        if since is not None:
+            start = max(start, since)
+        with self._lock:
+            samples = [s for s in self._samples.get(key, ()) if s[0] >= start]
+        latencies = [latency for _, latency, ok in samples if ok]
+        return {
+            "samples": len(samples),
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "error_rate": 1 - len(latencies) / len(samples) if samples else 0.0,
+        }
+
+
+class AdaptiveRouter(Router):
+    """
+    Router that moves an SLO class's calls from a model to its fallback
+    while the model misses the SLO, and back once it recovers.
+    """
+
+    def __init__(self, rules=LLM_ROUTES, default=LLM_DEFAULT_MODEL, fallbacks=LLM_FALLBACKS,
+                 slos=LLM_SLO, enabled=LLM_ADAPTIVE_ROUTING, clock=time.monotonic):
+        super().__init__(rules, default)
+        self.fallbacks = {parse_model(model).name: parse_model(spec) for model, spec in _pairs(fallbacks)}
+        self.slos = {key: float(value) for key, value in _pairs(slos)}
+        self.enabled = enabled
+        self.clock = clock
+        self.stats = RollingStats(clock=clock)
+        # {(model, SLO class): when its calls moved to the fallback}
+        self._degraded = {}
+        self._last_probe = {}
+        self._lock = threading.Lock()
+
+    def slo_class(self, method, stage=None):
+        return stage if stage in self.slos else method
+
+    def slo(self, slo_class):
+        return self.slos.get(slo_class, LLM_SLO_DEFAULT)
+
+    def observe(self, event):
+        """Telemetry listener: adds a finished call to its model's stats."""
+        if event.get("outcome") == "cancelled":
+            # Abandoned by the caller; says nothing about the model
+            return
+        latency = event["ttft"] if event.get("ttft") is not None else event.get("duration", 0.0)
+        slo_class = self.slo_class(event["method"], event.get("stage") or None)
+        key = (event["model"], slo_class)
+        self.stats.observe(key, latency, event.get("outcome") == "ok")
+        summary = self.stats.summary(key)
+        for quantile in ("p50", "p95"):
+            if summary[quantile] is not None:
+                telemetry.gauge("llm_model_latency_seconds", summary[quantile],
+                                model=event["model"], slo=slo_class, quantile=quantile)
+        telemetry.gauge("llm_model_error_rate", summary["error_rate"], model=event["model"], slo=slo_class)
+
+    def _misses_slo(self, summary, slo):
+        return summary["samples"] >= LLM_ROUTER_MIN_SAMPLES and (
+            summary["error_rate"] > LLM_ROUTER_MAX_ERROR_RATE
+            or (summary["p95"] is not None and summary["p95"] > slo)
+        )
+
+    def _switch(self, primary, slo_class, to, summary, slo):
+        p95 = f"{summary['p95']:.2f}s" if summary["p95"] is not None else "n/a"
+        detail = f"p95 {p95}, SLO {slo:.2f}s, errors {summary['error_rate']:.0%}"
+        if to == primary:
+            print(f"LLM router: {slo_class} calls moved back to {primary} ({detail} on probes)")
+        else:
+            print(f"LLM router: {slo_class} calls moved from {primary} to {to} ({detail})")
+        telemetry.count("llm_route_switches_total", model=primary, slo=slo_class, to=to)
+        telemetry.gauge("llm_route_fallback", 0 if to == primary else 1, model=primary, slo=slo_class)
+
+    def route(self, agent, method, stage=None):
+        primary = super().route(agent, method, stage)
+        fallback = self.fallbacks.get(primary.name)
+        if not self.enabled or fallback is None:
+            return primary
+        slo_class = self.slo_class(method, stage)
+        slo = self.slo(slo_class)
+        key = (primary.name, slo_class)
+        now = self.clock()
+        with self._lock:
+            switched_at = self._degraded.get(key)
+            if switched_at is None:
+                summary = self.stats.summary(key)
+                if not self._misses_slo(summary, slo):
+                    return primary
+                alternative = self.stats.summary((fallback.name, slo_class))
+                if alternative["samples"] >= LLM_ROUTER_MIN_SAMPLES and (
+                        self._misses_slo(alternative, slo)
+                        or (summary["p95"] is not None and alternative["p95"] is not None
+                            and alternative["p95"] >= summary["p95"])):
+                    # No better off on the fallback
+                    return primary
+                self._degraded[key] = now
+                self._switch(primary.name, slo_class, fallback.name, summary, slo)
+                return fallback
+
+            # Only probes reached the primary since the switch
+            probes = self.stats.summary(key, since=switched_at)
+            if (probes["samples"] >= LLM_ROUTER_MIN_SAMPLES
+                    and probes["error_rate"] <= LLM_ROUTER_MAX_ERROR_RATE
+                    and probes["p95"] is not None and probes["p95"] <= slo * LLM_ROUTER_RECOVERY):
+                del self._degraded[key]
+                self._last_probe.pop(key, None)
+                self._switch(primary.name, slo_class, primary.name, probes, slo)
+                return primary
+            if now - self._last_probe.get(key, switched_at) >= LLM_ROUTER_PROBE_INTERVAL:
+                self._last_probe[key] = now
+                return primary
+            return fallback
+
+
+router = AdaptiveRouter()
+telemetry.add_listener(router.observe)
+
+
+def report(path):
+    """Per route (agent, method, stage, model) latency, error rate and cost from a trace."""
+    groups = defaultdict(list)
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                key = (event["agent"], event["method"], event.get("stage") or "-", event["model"])
+                groups[key].append(event)
+
+    print(f"{'agent':<15}{'method':<18}{'stage':<11}{'model':<28}{'calls':>7}{'err%':>7}"
+          f"{'p50':>8}{'p95':>8}{'ttft50':>8}{'$/call':>10}{'$ total':>10}")
+    for key, events in sorted(groups.items()):
+        durations = [e.get("duration", 0.0) for e in events]
+        ttfts = [e["ttft"] for e in events if e.get("ttft") is not None]
+        errors = sum(e.get("outcome") in ("fallback", "error") for e in events)
+        cost = sum(e.get("cost", 0.0) for e in events)
+        ttft = _percentile(ttfts, 50)
+        print(f"{key[0]:<15}{key[1]:<18}{key[2]:<11}{key[3]:<28}{len(events):>7}"
+              f"{100 * errors / len(events):>7.1f}{_percentile(durations, 50):>8.2f}"
+              f"{_percentile(durations, 95):>8.2f}{ttft if ttft is not None else float('nan'):>8.2f}"
+              f"{cost / len(events):>10.5f}{cost:>10.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM providers and routing")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("routes", help="show the model each agent call is routed to")
+    report_parser = sub.add_parser("report", help="latency, errors and cost per route from a trace")
+    report_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "routes":
+        for agent, method, stage in CALL_SITES:
+            route = router.route(agent, method, stage)
+            fallback = router.fallbacks.get(route.name)
+            slo_class = router.slo_class(method, stage)
+            print(f"{agent}.{method}.{stage or '-'} -> {route.name}"
+                  + (f" (fallback {fallback.name} above p95 {router.slo(slo_class):g}s)" if fallback else ""))
+    elif args.command == "report":
+        report(args.path)
+
+
+if __name__ == "__main__":
+    main()
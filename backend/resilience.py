@@ -0,0 +1,348 @@
+"""
+Call policy for LLM requests: per-method deadlines, jittered exponential
+retries, hedged requests and a circuit breaker per model.
+
+A request is a function of the remaining time budget that sends one request
+and returns the response. CallPolicy.call runs it under the policy:
+
+- every attempt gets the time left until the method's deadline as timeout
+- retryable failures (timeouts, dropped connections, 408/409/429, 5xx) are
+  retried with full-jitter exponential backoff while the deadline allows
+- once a method has enough samples, an attempt still running at its p95
+  latency gets a duplicate (hedged) request, and the first answer wins.
+  Only non-streamed attempts are sampled (a stream returns at its headers)
+  and hedged. The losing request is cancelled if it has not started and
+  closed when it finishes. Attempts run inline when the hedge pool is busy.
+- after CIRCUIT_FAILURE_THRESHOLD consecutive provider failures the model's
+  breaker opens and calls raise CircuitOpenError at once, so the agents
+  return their local fallback without waiting. After CIRCUIT_RESET_TIMEOUT
+  seconds one probe request is let through to close it again.
+
+CallPolicy.acall is the same policy for coroutine requests. Its hedges are
+tasks on the event loop, and the losing one is cancelled, which closes its
+connection.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from backend.admission import AdmissionTimeout
+from backend.telemetry import telemetry
+
+# Seconds from the start of a call until it gives up, retries included
+DEADLINES = {
+    "analyze": float(os.getenv("LLM_DEADLINE_ANALYZE", "20")),
+    "analyze_survey": float(os.getenv("LLM_DEADLINE_ANALYZE_SURVEY", "30")),
+    "generate_opening": float(os.getenv("LLM_DEADLINE_OPENING", "20")),
+    "generate_reply": float(os.getenv("LLM_DEADLINE_REPLY", "20")),
+    "fused_turn": float(os.getenv("LLM_DEADLINE_FUSED", "25")),
+}
+DEFAULT_DEADLINE = float(os.getenv("LLM_DEADLINE_DEFAULT", "30"))
+
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.25"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "4"))
+
+# Hedging starts once a method has this many successful latency samples
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+# Threads running hedgeable attempts; a hedged attempt takes two
+LLM_HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "32"))
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+_hedge_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+
+
+def _discard(future):
+    """Done-callback for a losing hedge: releases whatever it returned."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the model's breaker is open."""
+
+
+def is_retryable(error):
+    """True for failures that say the provider is slow or degraded."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or name.endswith(
+        ("TimeoutError", "ConnectionError", "TimeoutException", "ConnectError")
+    )
+
+
+class CircuitBreaker:
+    """closed -> open after consecutive failures -> half_open probe -> closed."""
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let exactly one probe through
+                self._set_state("half_open")
+                return True
+            return self.state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_skipped(self):
+        """The attempt says nothing about the provider's health; a pending probe may run again."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                telemetry.gauge("llm_circuit_open", 1, model=self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != "open":
+                    self._set_state("open")
+
+    def _set_state(self, state):
+        if state == "open":
+            print(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+        self.state = state
+        telemetry.gauge("llm_circuit_open", 1 if state == "open" else 0, model=self.name)
+
+
+class LatencyTracker:
+    """Rolling window of successful attempt latencies per method."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, seconds):
+        with self._lock:
+            self._samples.setdefault(method, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, method, p, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples.get(method, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(int(p / 100 * len(samples)), len(samples) - 1)]
+
+
+class CallPolicy:
+    def __init__(self, deadlines=None, retries=LLM_RETRIES, backoff_base=LLM_BACKOFF_BASE,
+                 backoff_max=LLM_BACKOFF_MAX, hedge=LLM_HEDGE,
+                 hedge_min_samples=LLM_HEDGE_MIN_SAMPLES):
+        self.deadlines = deadlines or DEADLINES
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.latency = LatencyTracker()
+        self._breakers = {}
+        self._hedge_busy = 0
+        self._lock = threading.Lock()
+
+    def breaker(self, model):
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model)
+            return self._breakers[model]
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def hedge_delay(self, method, breaker):
+        """Seconds after which to hedge, or None when hedging is off for this attempt."""
+        if not self.hedge or breaker.state != "closed":
+            return None
+        return self.latency.percentile(method, 95, self.hedge_min_samples)
+
+    def _start_attempt(self, method, model, deadline):
+        breaker = self.breaker(model)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{method} deadline exceeded")
+        if not breaker.allow():
+            telemetry.count("llm_circuit_rejections_total", model=model)
+            raise CircuitOpenError(f"circuit open for {model}")
+        return breaker, remaining
+
+    def _after_failure(self, error, breaker, attempt, deadline, call):
+        """Returns the backoff delay before the next attempt, or re-raises."""
+        if isinstance(error, AdmissionTimeout):
+            # Queued locally until the deadline; says nothing about the provider
+            breaker.record_skipped()
+            raise error
+        retryable = is_retryable(error)
+        if retryable:
+            breaker.record_failure()
+        else:
+            # The request itself was bad (4xx); says nothing about the
+            # provider's health, so it neither closes nor trips the breaker
+            breaker.record_skipped()
+        delay = self.backoff(attempt)
+        if not retryable or attempt >= self.retries or time.monotonic() + delay >= deadline:
+            raise error
+        if call is not None:
+            call.retried()
+        return delay
+
+    def call(self, method, model, request, call=None, hedge=True):
+        """
+        Runs request(timeout) under the policy and returns its response.
+        `call` is the telemetry LLMCall, which counts the retries.
+        """
+        deadline = time.monotonic() + self.deadlines.get(method, DEFAULT_DEADLINE)
+        attempt = 0
+        while True:
+            breaker, remaining = self._start_attempt(method, model, deadline)
+            start = time.monotonic()
+            try:
+                response = self._attempt(method, request, remaining, breaker, hedge)
+            except Exception as e:
+                delay = self._after_failure(e, breaker, attempt, deadline, call)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            if hedge:
+                # Streams (never hedged) return at their headers
+                self.latency.observe(method, time.monotonic() - start)
+            return response
+
+    async def acall(self, method, model, request, call=None, hedge=True):
+        """Async call: awaits request(timeout) under the same policy."""
+        deadline = time.monotonic() + self.deadlines.get(method, DEFAULT_DEADLINE)
+        attempt = 0
+        while True:
+            breaker, remaining = self._start_attempt(method, model, deadline)
+            start = time.monotonic()
+            try:
+                response = await self._aattempt(method, request, remaining, breaker, hedge)
+            except Exception as e:
+                delay = self._after_failure(e, breaker, attempt, deadline, call)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            if hedge:
+                self.latency.observe(method, time.monotonic() - start)
+            return response
+
+    async def _aattempt(self, method, request, remaining, breaker, hedge):
+        hedge_after = self.hedge_delay(method, breaker) if hedge else None
+        if hedge_after is None or hedge_after >= remaining:
+            return await request(remaining)
+
+        end = time.monotonic() + remaining
+        pending = {asyncio.ensure_future(request(remaining))}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                telemetry.count("llm_hedged_requests_total", method=method)
+                pending.add(asyncio.ensure_future(request(end - time.monotonic())))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(end - time.monotonic(), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"{method} deadline exceeded")
+                # exception() on every finished task, so none goes unretrieved
+                outcomes = {task: task.exception() for task in done}
+                for task, exception in outcomes.items():
+                    if exception is None:
+                        return task.result()
+                    error = exception
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _submit(self, request, timeout):
+        future = _hedge_executor.submit(request, timeout)
+
+        def release(_):
+            with self._lock:
+                self._hedge_busy -= 1
+
+        future.add_done_callback(release)
+        return future
+
+    def _attempt(self, method, request, remaining, breaker, hedge):
+        hedge_after = self.hedge_delay(method, breaker) if hedge else None
+        if hedge_after is None or hedge_after >= remaining:
+            return request(remaining)
+        with self._lock:
+            # Room for the primary and its hedge, so losers cannot starve calls
+            if self._hedge_busy + 2 > LLM_HEDGE_WORKERS:
+                hedge_after = None
+            else:
+                self._hedge_busy += 2
+        if hedge_after is None:
+            return request(remaining)
+
+        end = time.monotonic() + remaining
+        primary = self._submit(request, remaining)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            with self._lock:
+                # The hedge slot was never used
+                self._hedge_busy -= 1
+            return primary.result()
+
+        telemetry.count("llm_hedged_requests_total", method=method)
+        pending = {primary, self._submit(request, end - time.monotonic())}
+        try:
+            error = None
+            while pending:
+                done, pending = wait(pending, timeout=max(end - time.monotonic(), 0),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"{method} deadline exceeded")
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            # A running sync request cannot be interrupted; it ends at its
+            # timeout at the latest and its response is closed
+            for future in pending:
+                future.cancel()
+                future.add_done_callback(_discard)
+
+
+call_policy = CallPolicy()
@@ -0,0 +1,115 @@
+import os
+
+from backend.agents import STANCES, decide_stage
+from backend.heuristics import FAST_PATH_MIN_CONFIDENCE, estimate_profile
+from backend.telemetry import telemetry
+
+# Let a ProfilingScheduler decide per turn whether the profiler runs
+ADAPTIVE_PROFILING = os.getenv("ADAPTIVE_PROFILING", "1") == "1"
+# Drift above this (see profile_drift) counts as a real profile change
+PROFILE_DRIFT_THRESHOLD = float(os.getenv("PROFILE_DRIFT_THRESHOLD", "0.3"))
+# Never skip profiling more than this many turns in a row
+PROFILE_MAX_SKIPS = int(os.getenv("PROFILE_MAX_SKIPS", "2"))
+# Weight of the newest observation in the rolling drift average
+DRIFT_SMOOTHING = 0.5
+
+# Extreme profiles used to test whether decide_stage looks at the profile
+_PROBE_PROFILES = [{"stance": s, "change_readiness": r} for s in STANCES for r in (0, 10)]
+
+
+def profile_drift(old, new):
+    """
+    How far a profile moved: 1 for a stance change, plus the change in
+    change_readiness (as a fraction of its 0-10 range) and in confidence.
+    """
+    drift = 0.0 if old.get("stance") == new.get("stance") else 1.0
+    drift += abs(new.get("change_readiness", 5) - old.get("change_readiness", 5)) / 10
+    drift += abs(new.get("confidence_in_stance", 0.5) - old.get("confidence_in_stance", 0.5))
+    return drift
+
+
+def stage_depends_on_profile(turn_count, target_stance="pro"):
+    """True when decide_stage can pick different stages for this turn depending on the profile."""
+    stages = {decide_stage(turn_count, p, target_stance=target_stance) for p in _PROBE_PROFILES}
+    return len(stages) > 1
+
+
+class ProfilingScheduler:
+    """
+    Decides per turn when the profiler runs:
+
+    - inline: alongside the reply, which is regenerated if the fresh profile
+      changes the stage or stance (run_turn's usual path). Used when this
+      turn's stage depends on the profile and the message may move it.
+    - defer: in the background after the reply is written. The result is
+      picked up by resolve() at the start of the next turn.
+    - skip: not at all. The local lexical estimate is used instead. Only for
+      confident estimates on a profile that has been stable, and at most
+      `max_skips` turns in a row.
+
+    Keep one scheduler per session, or rebuild it each turn with
+    from_dict(to_dict()) of the previous turn.
+    """
+
+    def __init__(self, drift_threshold=PROFILE_DRIFT_THRESHOLD, max_skips=PROFILE_MAX_SKIPS):
+        self.drift_threshold = drift_threshold
+        self.max_skips = max_skips
+        self.pending = None
+        self.skipped = 0
+        # Rolling average drift between consecutive LLM profiles
+        self.recent_drift = 0.0
+        self.counters = {"inline": 0, "defer": 0, "skip": 0}
+
+    def to_dict(self):
+        """The state carried between turns, for schedulers rebuilt per request."""
+        return {"skipped": self.skipped, "recent_drift": self.recent_drift, "counters": dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, state, **kwargs):
+        scheduler = cls(**kwargs)
+        if state:
+            scheduler.skipped = state.get("skipped", 0)
+            scheduler.recent_drift = state.get("recent_drift", 0.0)
+            scheduler.counters.update(state.get("counters", {}))
+        return scheduler
+
+    def observe(self, old_profile, new_profile):
+        drift = profile_drift(old_profile, new_profile)
+        self.recent_drift += DRIFT_SMOOTHING * (drift - self.recent_drift)
+
+    def resolve(self, profile):
+        """Waits for deferred profiling, if any, and returns the newest profile."""
+        if self.pending is None:
+            return profile
+        future, self.pending = self.pending, None
+        new_profile = future.result()
+        self.observe(profile, new_profile)
+        return new_profile
+
+    def defer(self, future):
+        self.pending = future
+
+    def plan(self, turn_count, profile, user_message, target_stance="pro"):
+        """Returns ("inline" | "defer" | "skip", estimated profile)."""
+        estimate, confidence = estimate_profile(user_message, profile)
+        confident = confidence >= FAST_PATH_MIN_CONFIDENCE
+        stable = self.recent_drift < self.drift_threshold
+
+        if stage_depends_on_profile(turn_count, target_stance):
+            stage = decide_stage(turn_count, profile, target_stance=target_stance)
+            estimated_stage = decide_stage(turn_count, estimate, target_stance=target_stance)
+            if not (confident and stable) or estimated_stage != stage:
+                decision = "inline"
+            elif self.skipped < self.max_skips and profile_drift(profile, estimate) < self.drift_threshold:
+                decision = "skip"
+            else:
+                decision = "defer"
+        elif confident and stable and self.skipped < self.max_skips:
+            decision = "skip"
+        else:
+            decision = "defer"
+
+        self.skipped = self.skipped + 1 if decision == "skip" else 0
+        self.counters[decision] += 1
+        telemetry.count("profiling_decisions_total", decision=decision)
+        return decision, estimate
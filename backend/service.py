@@ -0,0 +1,403 @@
+"""
+The agent side of a chat session, behind a small request/response API.
+
+AgentService runs Start Chat, chat turns and the final save for any session.
+It keeps no session state between requests: each request replays the
+session's SessionLog, builds fresh agents, runs the pipeline and appends its
+results (messages, profile, stage, scheduler state, usage) to the log. Any
+process sharing the log directory can therefore serve any request, so the
+Streamlit frontends only hold what they display and the agent work can run
+in separate worker processes (see backend.worker).
+
+Start Chat is pipelined: the opening streams from a provisional profile
+built locally from the survey while analyze_survey runs, and the LLM profile
+replaces it in the log once it arrives. While the user is still on the
+survey page, prefetch() computes the profile and opening for the current
+answers once the sliders have been still for START_PREFETCH_DELAY seconds,
+so Start Chat is usually served from the cache. Cache hits top their key up
+to CACHE_VARIANTS openings in the background.
+
+Every request method has an async counterpart (astart, aturn, afinish)
+that waits on the event loop instead of a thread; the worker serves those.
+
+get_agent_service() returns the in-process service, or a client for the
+workers listed in AGENT_WORKER_URLS.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+
+from backend.agents import FusedAgent, PersuaderAgent, START_MODEL, provisional_profile
+from backend.cache import ResponseCache, cache_key, generate_start
+from backend.heuristics import FastPathProfilerAgent
+from backend.pipeline import (_executor, afused_turn, agent_mode_for, arun_turn, astream_turn,
+                              count_user_turns, fused_turn, run_turn, stream_turn)
+from backend.scheduler import ADAPTIVE_PROFILING, ProfilingScheduler
+from backend.storage import SessionLog
+from backend.telemetry import telemetry
+
+# Comma-separated agent worker URLs; empty runs the agents in-process
+AGENT_WORKER_URLS = os.getenv("AGENT_WORKER_URLS", "")
+# Prefetch Start Chat once the survey answers stop changing for this long
+START_PREFETCH = os.getenv("START_PREFETCH", "1") == "1"
+START_PREFETCH_DELAY = float(os.getenv("START_PREFETCH_DELAY", "1.0"))
+
+
+class SessionNotFound(KeyError):
+    """Raised for requests on a session that has no live log."""
+
+
+class AgentService:
+    def __init__(self, log=None, cache=None):
+        self.log = log or SessionLog()
+        self.cache = cache or ResponseCache()
+        # Deferred profiling started by this process:
+        # {session_id: (profile before it, future)}.
+        # The future appends the profile to the log itself, so another
+        # process serving the next turn still sees it once it lands.
+        self._deferred = {}
+        # Debounce timers per session and running prefetches per cache key
+        self._prefetch_timers = {}
+        self._prefetching = {}
+        self._lock = threading.Lock()
+
+    def _agents(self):
+        return FastPathProfilerAgent(incremental=True), PersuaderAgent(), FusedAgent()
+
+    def _save_stats(self, session_id, profiler, persuader, fused):
+        self.log.append(
+            session_id,
+            "stats",
+            usage={"profiler": profiler.usage, "persuader": persuader.usage, "fused": fused.usage},
+            timings=persuader.timings + fused.timings,
+            compactions=persuader.compactions + fused.compactions,
+            profiler_paths=profiler.counters,
+        )
+
+    def _wait_deferred(self, session_id):
+        """
+        Waits for this process's deferred profiling of the session, if any,
+        and returns (profile before it, deferred profile), or None.
+        """
+        with self._lock:
+            pending = self._deferred.pop(session_id, None)
+        if pending is None:
+            return None
+        previous, future = pending
+        try:
+            return previous, future.result()
+        except Exception:
+            return None
+
+    async def _await_deferred(self, session_id):
+        """_wait_deferred without blocking the event loop."""
+        with self._lock:
+            pending = self._deferred.pop(session_id, None)
+        if pending is None:
+            return None
+        previous, future = pending
+        try:
+            return previous, await asyncio.wrap_future(future)
+        except Exception:
+            return None
+
+    def _track_deferred(self, session_id, future, checkpoint, previous=None):
+        """
+        Runs checkpoint(profile) when a background profiling future is done;
+        it appends the profile to the log. The session's next request waits
+        for it. `previous` is the profile it replaces, for the scheduler.
+        """
+        done = Future()
+
+        def finish(f):
+            try:
+                done.set_result(checkpoint(f.result()))
+            except Exception as e:
+                print(f"Profile Checkpoint Error: {e}")
+                done.set_exception(e)
+
+        with self._lock:
+            self._deferred[session_id] = (previous, done)
+        future.add_done_callback(finish)
+
+    def state(self, session_id):
+        """The session as replayed from its log, or None."""
+        return self.log.replay(session_id)
+
+    def prefetch(self, session_id, topic, pre_survey):
+        """
+        Called on every change of the survey answers. Once they have not
+        changed for START_PREFETCH_DELAY seconds, the profile and opening
+        for them are generated into the Start Chat cache.
+        """
+        if not START_PREFETCH:
+            return
+        with self._lock:
+            timer = self._prefetch_timers.pop(session_id, None)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(START_PREFETCH_DELAY, self._prefetch,
+                                    args=(session_id, topic, dict(pre_survey)))
+            timer.daemon = True
+            self._prefetch_timers[session_id] = timer
+        timer.start()
+
+    def _prefetch(self, session_id, topic, pre_survey):
+        with self._lock:
+            if self._prefetch_timers.get(session_id) is threading.current_thread():
+                del self._prefetch_timers[session_id]
+        self._top_up(topic, pre_survey)
+
+    def _top_up(self, topic, pre_survey):
+        """
+        Generates one more Start Chat variant for these answers unless the
+        key already holds CACHE_VARIANTS of them or one is being generated.
+        """
+        key = cache_key(topic, pre_survey, START_MODEL)
+        with self._lock:
+            if key in self._prefetching or self.cache.count(topic, pre_survey, START_MODEL) >= self.cache.variants:
+                return
+            future = self._prefetching[key] = Future()
+        telemetry.count("start_prefetch_total")
+        profiler, persuader, _ = self._agents()
+        try:
+            result = generate_start(profiler, persuader, topic, pre_survey)
+            if result:
+                self.cache.put(topic, pre_survey, START_MODEL, *result)
+        except Exception as e:
+            print(f"Start Prefetch Error: {e}")
+        finally:
+            with self._lock:
+                del self._prefetching[key]
+            future.set_result(None)
+
+    def _claim_start(self, session_id, topic, pre_survey):
+        """
+        Cancels the session's pending prefetch. Returns the running prefetch
+        of these answers when Start Chat should wait for it, or None.
+        """
+        with self._lock:
+            timer = self._prefetch_timers.pop(session_id, None)
+            prefetching = self._prefetching.get(cache_key(topic, pre_survey, START_MODEL))
+        if timer is not None:
+            timer.cancel()
+        if prefetching is not None and not self.cache.count(topic, pre_survey, START_MODEL):
+            # Already halfway there; cheaper than starting over
+            return prefetching
+        return None
+
+    def _start_cached(self, session_id, topic, pre_survey, cached, agents):
+        if START_PREFETCH:
+            # Rotation needs CACHE_VARIANTS openings per key
+            _executor.submit(self._top_up, topic, pre_survey)
+        profile, opening = cached
+        self.log.append(session_id, "start", topic=topic, pre_survey=pre_survey)
+        self.log.append(session_id, "profile", profile=profile, turn=0)
+        self.log.append(session_id, "message", role="assistant", content=opening)
+        self._save_stats(session_id, *agents)
+        telemetry.count("start_chat_total", source="cache")
+        return {"profile": profile, "opening": opening, "source": "cache"}
+
+    def _start_pipelined(self, session_id, topic, pre_survey, profile, opening, survey_future, agents):
+        """Logs a pipelined start; the survey profile replaces `profile` once it arrives."""
+        profiler, persuader, _ = agents
+        self.log.append(session_id, "start", topic=topic, pre_survey=pre_survey)
+        self.log.append(session_id, "profile", profile=profile, turn=0)
+        self.log.append(session_id, "message", role="assistant", content=opening)
+
+        def checkpoint(survey_profile):
+            merged = {**profile, **survey_profile}
+            self.log.append(session_id, "profile", profile=merged, turn=0)
+            self._save_stats(session_id, *agents)
+            # Canned fallbacks are not worth caching
+            if survey_profile != profiler._survey_fallback(pre_survey) and not persuader.timings[-1]["fallback"]:
+                self.cache.put(topic, pre_survey, START_MODEL, merged, opening)
+            return merged
+
+        self._track_deferred(session_id, survey_future, checkpoint)
+        telemetry.count("start_chat_total", source="pipelined")
+        return {"profile": profile, "opening": opening, "source": "pipelined"}
+
+    def start(self, session_id, topic, pre_survey, render=None):
+        """
+        Writes the opening message and profiles the pre-chat survey.
+        `render` consumes the streamed opening and returns its text, like
+        st.write_stream. Returns {"profile", "opening", "source"}, where
+        source is "cache" or "pipelined" and profile is the one the opening
+        was written from.
+        """
+        prefetching = self._claim_start(session_id, topic, pre_survey)
+        if prefetching is not None:
+            prefetching.result()
+
+        agents = profiler, persuader, _ = self._agents()
+        cached = self.cache.get(topic, pre_survey, START_MODEL)
+        if cached:
+            return self._start_cached(session_id, topic, pre_survey, cached, agents)
+
+        # The opening only needs the survey stance, so it streams from a
+        # local profile while analyze_survey runs
+        description = topic["description"]
+        survey_future = _executor.submit(profiler.analyze_survey, pre_survey, description)
+        profile = provisional_profile(pre_survey)
+        stream = persuader.stream_opening(profile, description, pre_survey)
+        opening = render(stream) if render else "".join(stream)
+        return self._start_pipelined(session_id, topic, pre_survey, profile, opening, survey_future, agents)
+
+    async def astart(self, session_id, topic, pre_survey, render=None):
+        """
+        Async counterpart of start, for the async worker. `render` is a
+        coroutine function that consumes an async generator of tokens.
+        """
+        prefetching = self._claim_start(session_id, topic, pre_survey)
+        if prefetching is not None:
+            await asyncio.wrap_future(prefetching)
+
+        agents = profiler, persuader, _ = self._agents()
+        cached = self.cache.get(topic, pre_survey, START_MODEL)
+        if cached:
+            return await asyncio.to_thread(self._start_cached, session_id, topic, pre_survey, cached, agents)
+
+        description = topic["description"]
+        survey_task = asyncio.ensure_future(profiler.aanalyze_survey(pre_survey, description))
+        profile = provisional_profile(pre_survey)
+        stream = persuader.astream_opening(profile, description, pre_survey)
+        opening = await render(stream) if render else "".join([token async for token in stream])
+        # Tracking the task has to happen on its loop
+        return self._start_pipelined(session_id, topic, pre_survey, profile, opening, survey_task, agents)
+
+    def _turn_context(self, session_id, message, deferred):
+        """
+        Replays the session for a turn. Returns (state, history with the
+        user message, turn number, agent mode, scheduler or None).
+        """
+        state = self.log.replay(session_id)
+        if state is None or state.get("finalized"):
+            raise SessionNotFound(session_id)
+
+        # The user message is logged together with the reply, so a turn that
+        # fails leaves no unanswered message to replay
+        history = state["history"] + [{"role": "user", "content": message}]
+        mode = agent_mode_for(session_id)
+        scheduler = None
+        if mode != "fused":
+            scheduler = ProfilingScheduler.from_dict(state.get("scheduler")) if ADAPTIVE_PROFILING else None
+            if scheduler is not None and deferred is not None and deferred[0] is not None:
+                # What resolve() would have observed in a long-lived scheduler.
+                # Profiles deferred on another worker are used but not observed.
+                scheduler.observe(*deferred)
+        return state, history, count_user_turns(history), mode, scheduler
+
+    def _record_turn(self, session_id, message, turn, result, scheduler, agents):
+        if scheduler is not None:
+            self.log.append(session_id, "scheduler", state=scheduler.to_dict())
+        self.log.append(session_id, "message", role="user", content=message)
+        self.log.append(session_id, "profile", profile=result["profile"], turn=turn)
+        self.log.append(session_id, "stage", stage=result["stage"])
+        self.log.append(session_id, "message", role="assistant", content=result["reply"])
+        self._save_stats(session_id, *agents)
+
+    def _track_turn_deferred(self, session_id, turn, result, scheduler):
+        if scheduler is not None and scheduler.pending is not None:
+            def checkpoint(profile):
+                self.log.append(session_id, "profile", profile=profile, turn=turn)
+                return profile
+
+            # After this turn's profile record, which the deferred one replaces
+            self._track_deferred(session_id, scheduler.pending, checkpoint, result["profile"])
+
+    def turn(self, session_id, message, render=None, target_stance="pro"):
+        """
+        Answers one user message. `render` is called once per streamed reply
+        attempt (see stream_turn). Returns the pipeline result plus the
+        session's agent_mode.
+        """
+        # Lands in the log before it is replayed
+        deferred = self._wait_deferred(session_id)
+        # Another worker's turn for this session waits until this one is logged
+        with self.log.lock(session_id) as live:
+            if not live:
+                raise SessionNotFound(session_id)
+            state, history, turn, mode, scheduler = self._turn_context(session_id, message, deferred)
+            description = state["topic"]["description"]
+            agents = profiler, persuader, fused = self._agents()
+
+            if mode == "fused":
+                result = fused_turn(fused, message, history, state["final_profile"], description,
+                                    render=render, target_stance=target_stance)
+            elif render is not None:
+                result = stream_turn(profiler, persuader, message, history, state["final_profile"],
+                                     description, render=render, target_stance=target_stance,
+                                     scheduler=scheduler)
+            else:
+                result = run_turn(profiler, persuader, message, history, state["final_profile"],
+                                  description, target_stance=target_stance, scheduler=scheduler)
+
+            self._record_turn(session_id, message, turn, result, scheduler, agents)
+        self._track_turn_deferred(session_id, turn, result, scheduler)
+        return {**result, "agent_mode": mode}
+
+    async def aturn(self, session_id, message, render=None, target_stance="pro"):
+        """Async counterpart of turn; `render` is as in astart."""
+        deferred = await self._await_deferred(session_id)
+        lock = self.log.lock(session_id)
+        if not await asyncio.to_thread(lock.acquire):
+            raise SessionNotFound(session_id)
+        try:
+            state, history, turn, mode, scheduler = await asyncio.to_thread(
+                self._turn_context, session_id, message, deferred)
+            description = state["topic"]["description"]
+            agents = profiler, persuader, fused = self._agents()
+
+            if mode == "fused":
+                result = await afused_turn(fused, message, history, state["final_profile"], description,
+                                           render=render, target_stance=target_stance)
+            elif render is not None:
+                result = await astream_turn(profiler, persuader, message, history, state["final_profile"],
+                                            description, render=render, target_stance=target_stance,
+                                            scheduler=scheduler)
+            else:
+                result = await arun_turn(profiler, persuader, message, history, state["final_profile"],
+                                         description, target_stance=target_stance, scheduler=scheduler)
+
+            await asyncio.to_thread(self._record_turn, session_id, message, turn, result, scheduler, agents)
+        finally:
+            lock.release()
+        self._track_turn_deferred(session_id, turn, result, scheduler)
+        return {**result, "agent_mode": mode}
+
+    def _finalize(self, session_id, post_survey):
+        def extra(record):
+            scheduler = record.get("scheduler")
+            return {
+                "post_survey": post_survey,
+                "agent_mode": agent_mode_for(session_id),
+                "profiling_plan": scheduler["counters"] if scheduler else None,
+            }
+
+        return self.log.finalize(session_id, extra) is not None
+
+    def finish(self, session_id, post_survey):
+        """
+        Queues the session with its post-chat survey on the background
+        session writer, once however often it is called. Returns False for
+        unknown sessions.
+        """
+        # Profiling deferred on the last turn
+        self._wait_deferred(session_id)
+        return self._finalize(session_id, post_survey)
+
+    async def afinish(self, session_id, post_survey):
+        """Async counterpart of finish."""
+        await self._await_deferred(session_id)
+        return await asyncio.to_thread(self._finalize, session_id, post_survey)
+
+
+def get_agent_service(urls=AGENT_WORKER_URLS):
+    """The in-process AgentService, or a WorkerClient when worker URLs are set."""
+    urls = [url.strip() for url in urls.split(",") if url.strip()]
+    if not urls:
+        return AgentService()
+    from backend.worker import WorkerClient
+    return WorkerClient(urls)
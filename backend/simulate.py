@@ -0,0 +1,348 @@
+"""
+Headless batch simulation: synthetic users talk to the real Profiler and
+Persuader loop for every topic in topics.json.
+
+Each synthetic user has a persona (stance, style, openness) that sets its
+survey answers, how it writes and how far its post survey moves. Sessions run
+through pipeline.run_turn (or fused_turn with --agent-mode), exactly like a
+chat turn in the app, and the transcripts are saved through the configured session store with
+"simulated": true.
+
+Work is fanned out over `--workers` processes, each running `--concurrency`
+sessions on threads. Workers send finished transcripts back to this process,
+which is the only one writing to the store. Against the mock server nothing
+leaves the machine:
+
+    python -m backend.simulate --sessions-per-topic 200 --turns 8 --workers 4 --concurrency 16 --start-mock
+"""
+import argparse
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import get_context
+
+PERSONAS = [
+    {"stance": "pro", "style": "rational", "openness": 0.3},
+    {"stance": "pro", "style": "brief", "openness": 0.5},
+    {"stance": "anti", "style": "emotional", "openness": 0.2},
+    {"stance": "anti", "style": "sarcastic", "openness": 0.1},
+    {"stance": "anti", "style": "rational", "openness": 0.6},
+    {"stance": "mixed", "style": "storytelling", "openness": 0.7},
+    {"stance": "mixed", "style": "brief", "openness": 0.5},
+]
+
+TEMPLATE_MESSAGES = {
+    "rational": [
+        "What evidence is there that this actually works?",
+        "I see the argument, but the costs seem higher than the benefits.",
+        "That is a fair point, though it depends on how it is implemented.",
+    ],
+    "brief": ["ok", "idk, it depends", "maybe", "not really", "fair enough"],
+    "emotional": [
+        "This honestly makes me worried for people like my parents.",
+        "I just feel like nobody asks regular people what they want.",
+        "It frustrates me when people pretend this is simple.",
+    ],
+    "sarcastic": [
+        "Sure, because that always works out great.",
+        "yeah right",
+        "Oh good, another expert telling me what to think.",
+    ],
+    "storytelling": [
+        "When I was in college a friend of mine went through exactly this.",
+        "My neighbor tried it last year and it went better than I expected.",
+        "At my old job we had a similar debate and nobody changed their mind.",
+    ],
+}
+
+SURVEY_CENTER = {"pro": 8, "mixed": 5, "anti": 3}
+
+USER_SIM_INSTRUCTIONS = """You are role-playing a participant in a conversation about a debated topic.
+Stay in character. Reply with a single chat message of 1 to 3 sentences and nothing else.
+Match the given style. The more open the persona, the more willing it is to concede good points."""
+
+
+class SyntheticUser:
+    """
+    A simulated participant. With an agent it writes its messages with the
+    LLM in character; otherwise it picks lines for its style.
+    """
+
+    def __init__(self, persona, rng, agent=None):
+        self.persona = persona
+        self.rng = rng
+        self.agent = agent
+
+    def survey(self, topic):
+        center = SURVEY_CENTER[self.persona["stance"]]
+        return {q: min(10, max(1, round(self.rng.gauss(center, 1.5)))) for q in topic["questions"]}
+
+    def reply(self, history, topic):
+        fallback = self.rng.choice(TEMPLATE_MESSAGES[self.persona["style"]])
+        if self.agent is None:
+            return fallback
+        return self.agent.reply(self.persona, history, topic["description"], fallback)
+
+    def post_survey(self, pre_survey, stages, target_stance="pro"):
+        """Moves toward the target stance with openness and the challenge turns seen."""
+        direction = 1 if target_stance == "pro" else -1
+        pressure = self.persona["openness"] * (1 + stages.count("challenge")) / 2
+        return {
+            q: min(10, max(1, round(score + direction * self.rng.gauss(pressure, 1.0))))
+            for q, score in pre_survey.items()
+        }
+
+
+class SyntheticUserAgent:
+    """Writes synthetic user messages with the LLM, through the shared call policy."""
+
+    agent_name = "synthetic_user"
+
+    def __init__(self):
+        from backend.agents import new_usage
+        from backend.providers import router
+
+        self.router = router
+        self.usage = new_usage()
+
+    def reply(self, persona, history, topic_description, fallback):
+        from backend.agents import complete, record_usage
+        from backend.compaction import compact_json
+
+        # The user sees the conversation from the other side
+        flipped = [
+            {"role": "user" if m["role"] == "assistant" else "assistant", "content": m["content"]}
+            for m in history
+        ]
+        prompt = (
+            f"Topic: {topic_description}\n\n"
+            f"Persona:\n{compact_json(persona)}\n\n"
+            f"Conversation so far (you are the assistant):\n{compact_json(flipped)}"
+        )
+        route, call = self.router.start(self.agent_name, "simulate_user")
+        try:
+            response = complete(
+                route,
+                call,
+                messages=[
+                    {"role": "system", "content": USER_SIM_INSTRUCTIONS},
+                    {"role": "user", "content": prompt},
+                ],
+            )
+            record_usage(self.usage, response.usage)
+            call.add_usage(response.usage)
+            message = response.choices[0].message.content.strip()
+            call.ok()
+            return message
+        except Exception as e:
+            print(f"Synthetic User Error: {e}")
+            call.fail(e)
+            return fallback
+
+
+def simulate_session(topic, persona, turns, seed, llm_users=False, fast_path=False,
+                     agent_mode="separate", adaptive=False, target_stance="pro"):
+    """Runs one full conversation and returns its session record."""
+    from backend.agents import FusedAgent, PersuaderAgent, ProfilerAgent, MODEL_NAME
+    from backend.heuristics import FastPathProfilerAgent
+    from backend.pipeline import agent_mode_for, fused_turn, run_turn
+    from backend.scheduler import ProfilingScheduler
+
+    rng = random.Random(seed)
+    user = SyntheticUser(persona, rng, SyntheticUserAgent() if llm_users else None)
+    if fast_path:
+        profiler = FastPathProfilerAgent(incremental=True)
+    else:
+        profiler = ProfilerAgent(incremental=True)
+    persuader = PersuaderAgent()
+    fused = FusedAgent()
+    scheduler = ProfilingScheduler() if adaptive else None
+    session_id = f"sim_{uuid.uuid4().hex}"
+    agent_mode = agent_mode_for(session_id, agent_mode)
+    description = topic["description"]
+
+    pre_survey = user.survey(topic)
+    profile = profiler.analyze_survey(pre_survey, description)
+    initial_profile = profile
+    opening = persuader.generate_opening(profile, description, pre_survey)
+    history = [{"role": "assistant", "content": opening}]
+    stages = []
+    regenerations = 0
+
+    for _ in range(turns):
+        message = user.reply(history, topic)
+        history.append({"role": "user", "content": message})
+        if agent_mode == "fused":
+            result = fused_turn(fused, message, history, profile, description,
+                                target_stance=target_stance)
+        else:
+            result = run_turn(profiler, persuader, message, history, profile, description,
+                              target_stance=target_stance, scheduler=scheduler)
+        profile = result["profile"]
+        stages.append(result["stage"])
+        regenerations += result["regenerated"]
+        history.append({"role": "assistant", "content": result["reply"]})
+    if scheduler is not None:
+        profile = scheduler.resolve(profile)
+
+    return {
+        "session_id": session_id,
+        "simulated": True,
+        "agent_mode": agent_mode,
+        "persona": persona,
+        "seed": seed,
+        "topic": topic,
+        "model": MODEL_NAME,
+        "pre_survey": pre_survey,
+        "post_survey": user.post_survey(pre_survey, stages, target_stance),
+        "initial_profile": initial_profile,
+        "history": history,
+        "final_profile": profile,
+        "stages": stages,
+        "regenerations": regenerations,
+        "profiling_plan": scheduler.counters if scheduler is not None else None,
+        "usage": {"profiler": profiler.usage, "persuader": persuader.usage, "fused": fused.usage},
+    }
+
+
+def run_batch(jobs, turns, concurrency, llm_users=False, fast_path=False, agent_mode="separate",
+              adaptive=False):
+    """Runs a batch of (topic, persona, seed) jobs on threads. Used by the worker processes."""
+    records = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(simulate_session, topic, persona, turns, seed, llm_users, fast_path,
+                        agent_mode, adaptive)
+            for topic, persona, seed in jobs
+        ]
+        for future in futures:
+            try:
+                records.append(future.result())
+            except Exception as e:
+                print(f"Simulation Error: {e}")
+    return records
+
+
+def report(records, failed, elapsed):
+    from backend.agents import REPLY_FALLBACK
+
+    turns = sum(len(r["stages"]) for r in records)
+    print(f"\n{len(records)} sessions, {turns} turns in {elapsed:.1f}s "
+          f"({len(records) / elapsed:.2f} sessions/s, {turns / elapsed:.2f} turns/s)")
+    if failed:
+        print(f"{failed} sessions failed")
+    if not records:
+        return
+
+    stages = Counter(stage for r in records for stage in r["stages"])
+    print("Stages: " + ", ".join(f"{s}={n}" for s, n in stages.most_common()))
+    regenerated = sum(r["regenerations"] for r in records)
+    fallbacks = sum(
+        1 for r in records for m in r["history"]
+        if m["role"] == "assistant" and m["content"] == REPLY_FALLBACK
+    )
+    print(f"Regenerated replies: {regenerated / max(turns, 1):.1%}, fallback replies: {fallbacks / max(turns, 1):.1%}")
+
+    plans = Counter()
+    for r in records:
+        plans.update(r["profiling_plan"] or {})
+    if plans:
+        print("Profiling: " + ", ".join(f"{d}={n}" for d, n in sorted(plans.items())))
+
+    modes = Counter(r["agent_mode"] for r in records)
+    if len(modes) > 1:
+        print("Agent modes: " + ", ".join(f"{m}={n}" for m, n in sorted(modes.items())))
+
+    by_topic = {}
+    for r in records:
+        deltas = [r["post_survey"][q] - r["pre_survey"][q] for q in r["pre_survey"]]
+        by_topic.setdefault(r["topic"]["id"], []).append(sum(deltas) / len(deltas))
+    for topic_id, deltas in sorted(by_topic.items()):
+        print(f"  {topic_id:<24}{len(deltas):>6} sessions  mean shift {sum(deltas) / len(deltas):+.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch conversations with synthetic users")
+    parser.add_argument("--sessions-per-topic", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--topic", action="append", help="topic id (repeatable, default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes (0 runs everything in this process)")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions in flight per worker")
+    parser.add_argument("--llm-users", action="store_true",
+                        help="write synthetic user messages with the LLM instead of templates")
+    parser.add_argument("--fast-path", action="store_true", help="use the heuristic fast-path profiler")
+    parser.add_argument("--agent-mode", choices=["separate", "fused", "ab"], default="separate",
+                        help="separate agents, the fused agent, or half of the sessions each")
+    parser.add_argument("--adaptive-profiling", action="store_true",
+                        help="let a ProfilingScheduler skip or defer profiling per turn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-url", help="OpenAI-compatible endpoint, e.g. http://127.0.0.1:8008/v1")
+    parser.add_argument("--start-mock", action="store_true",
+                        help="start the mock server in this process on --base-url's port")
+    parser.add_argument("--latency", default="lognormal:-1.0,0.5", help="mock latency (with --start-mock)")
+    parser.add_argument("--dry-run", action="store_true", help="do not save the transcripts")
+    args = parser.parse_args()
+
+    if args.start_mock:
+        args.base_url = args.base_url or "http://127.0.0.1:8008/v1"
+        from urllib.parse import urlparse
+        from backend.mock_server import start_in_background
+        url = urlparse(args.base_url)
+        start_in_background(host=url.hostname, port=url.port, latency=args.latency)
+    # Every provider, so no route leaves the endpoint. Read when
+    # backend.providers creates the clients; workers inherit it.
+    if args.base_url:
+        for provider in ("OPENAI", "GEMINI", "LOCAL_LLM"):
+            os.environ[f"{provider}_BASE_URL"] = args.base_url
+            os.environ.setdefault(f"{provider}_API_KEY", "simulation")
+
+    from backend.config import load_topics
+    from backend.storage import get_store
+
+    topics = [t for t in load_topics() if not args.topic or t["id"] in args.topic]
+    rng = random.Random(args.seed)
+    jobs = [
+        (topic, rng.choice(PERSONAS), rng.getrandbits(32))
+        for topic in topics
+        for _ in range(args.sessions_per_topic)
+    ]
+    batches = [jobs[i:i + args.concurrency] for i in range(0, len(jobs), args.concurrency)]
+    store = None if args.dry_run else get_store()
+
+    records = []
+    start = time.perf_counter()
+
+    def collect(batch_records):
+        for record in batch_records:
+            if store is not None:
+                store.save(record)
+            records.append(record)
+        print(f"\r{len(records)}/{len(jobs)} sessions", end="", flush=True)
+
+    if args.workers == 0:
+        for batch in batches:
+            collect(run_batch(batch, args.turns, args.concurrency, args.llm_users, args.fast_path,
+                              args.agent_mode, args.adaptive_profiling))
+    else:
+        # spawn: workers must not inherit this process's threads or open store
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context("spawn")) as pool:
+            futures = [
+                pool.submit(run_batch, batch, args.turns, args.concurrency, args.llm_users,
+                            args.fast_path, args.agent_mode, args.adaptive_profiling)
+                for batch in batches
+            ]
+            for future in as_completed(futures):
+                collect(future.result())
+    elapsed = time.perf_counter() - start
+
+    if store is not None:
+        store.close()
+    report(records, len(jobs) - len(records), elapsed)
+
+
+if __name__ == "__main__":
+    main()
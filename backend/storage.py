@@ -1,25 +1,746 @@
+import argparse
+import atexit
+import fcntl
+import glob
 import json
 import os
-import time
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import closing, contextmanager
 from datetime import datetime
 
+from backend.telemetry import telemetry
+
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 
+# "json" (one file per session), "jsonl" (append-only log) or "sqlite"
+SESSION_STORE = os.getenv("SESSION_STORE", "json")
+# Batched stores flush and fsync at least this often (seconds) or per batch
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "2"))
+STORE_BATCH_SIZE = int(os.getenv("STORE_BATCH_SIZE", "50"))
+# Sessions waiting for the background writer before save_session_async blocks
+STORE_WRITE_QUEUE = int(os.getenv("STORE_WRITE_QUEUE", "1000"))
+
 def ensure_data_dir():
     """Ensures the data directory exists."""
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
 
+def _prepare(session_data):
+    """Returns a copy with a real session id and a saved_at timestamp."""
+    record = dict(session_data)
+    if record.get("session_id") in (None, "", "unknown"):
+        record["session_id"] = uuid.uuid4().hex
+    record.setdefault("saved_at", datetime.now().isoformat(timespec="seconds"))
+    return record
+
+def _topic_id(record):
+    topic = record.get("topic")
+    if isinstance(topic, dict):
+        return topic.get("id")
+    return topic
+
+def _filename_time(filepath):
+    """saved_at-style timestamp from a session_YYYYmmdd_HHMMSS_<id>.json name, or ""."""
+    stamp = "_".join(os.path.basename(filepath).split("_")[1:3])
+    try:
+        return datetime.strptime(stamp, "%Y%m%d_%H%M%S").isoformat(timespec="seconds")
+    except ValueError:
+        return ""
+
+@contextmanager
+def _file_lock(f):
+    """Exclusive flock on an open file, held across processes."""
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _matches(meta, topic_id, since, until):
+    if topic_id is not None and meta["topic_id"] != topic_id:
+        return False
+    if since is not None and meta["saved_at"] < since:
+        return False
+    if until is not None and meta["saved_at"] >= until:
+        return False
+    return True
+
+
+class JsonFileStore:
+    """One pretty-printed JSON file per session (the original layout)."""
+
+    def __init__(self, directory=DATA_DIR):
+        self.directory = directory
+
+    def save(self, session_data):
+        os.makedirs(self.directory, exist_ok=True)
+        record = _prepare(session_data)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"session_{timestamp}_{record['session_id']}.json"
+        filepath = os.path.join(self.directory, filename)
+
+        with open(filepath, "w") as f:
+            json.dump(record, f, indent=2)
+
+        return record["session_id"]
+
+    def iter_sessions(self, topic_id=None, since=None, until=None):
+        for _, record in self._iter_files(topic_id, since, until):
+            yield record
+
+    def _iter_files(self, topic_id=None, since=None, until=None):
+        """
+        Yields (filepath, record) of the matching sessions. Files named
+        before `since` are skipped unread: save() names them after setting
+        saved_at, so the name is never older than the record.
+        """
+        for filepath in sorted(glob.glob(os.path.join(self.directory, "session_*.json"))):
+            named_at = _filename_time(filepath)
+            if since is not None and named_at and named_at < since:
+                continue
+            record = self._read(filepath)
+            meta = {"topic_id": _topic_id(record), "saved_at": record["saved_at"]}
+            if _matches(meta, topic_id, since, until):
+                yield filepath, record
+
+    def _read(self, filepath):
+        with open(filepath, "r") as f:
+            record = json.load(f)
+        if "saved_at" not in record:
+            # Older files only carry the timestamp in their name
+            record["saved_at"] = _filename_time(filepath)
+        return record
+
+    def changes(self, cursor=None):
+        """
+        Returns (cursor, records): the sessions written since `cursor` (all
+        of them for None) and the cursor to pass next time, valid once the
+        records have been consumed. The cursor maps file names to their
+        mtime, so late and rewritten files are found whatever their saved_at.
+        """
+        seen = dict(cursor or {})
+        changed = []
+        for filepath in sorted(glob.glob(os.path.join(self.directory, "session_*.json"))):
+            name = os.path.basename(filepath)
+            try:
+                mtime = os.stat(filepath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if seen.get(name) != mtime:
+                seen[name] = mtime
+                changed.append(filepath)
+
+        def records():
+            for filepath in changed:
+                try:
+                    yield self._read(filepath)
+                except (OSError, ValueError):
+                    # Still being written; read it again next time
+                    seen.pop(os.path.basename(filepath), None)
+
+        return seen, records()
+
+    def get_session(self, session_id):
+        for filepath in glob.glob(os.path.join(self.directory, f"session_*_{session_id}.json")):
+            with open(filepath, "r") as f:
+                return json.load(f)
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _BatchedStore:
+    """
+    Buffers saves in memory and writes them in batches, from a background
+    thread every `flush_interval` seconds or as soon as `batch_size` are queued.
+    """
+
+    def __init__(self, flush_interval=STORE_FLUSH_INTERVAL, batch_size=STORE_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="store-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, session_data):
+        record = _prepare(session_data)
+        with self._lock:
+            self._pending.append(record)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        return record["session_id"]
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if batch:
+                self._write_batch(batch)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Storage Flush Error: {e}")
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+class JsonlStore(_BatchedStore):
+    """
+    Append-only JSONL log of sessions with a sidecar index
+    (session id, topic id, saved_at, byte offset) for lookups.
+    """
+
+    def __init__(self, directory=DATA_DIR, **kwargs):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "sessions.jsonl")
+        self.index_path = os.path.join(directory, "sessions.idx.jsonl")
+        super().__init__(**kwargs)
+
+    def _write_batch(self, batch):
+        index_lines = []
+        # Worker processes may share these files: the offsets and the index
+        # lines are only right if nobody else appends in between
+        with open(self.path, "ab") as f, _file_lock(f):
+            f.seek(0, os.SEEK_END)
+            for record in batch:
+                offset = f.tell()
+                f.write((json.dumps(record) + "\n").encode("utf-8"))
+                index_lines.append(json.dumps({
+                    "session_id": record["session_id"],
+                    "topic_id": _topic_id(record),
+                    "saved_at": record["saved_at"],
+                    "offset": offset,
+                }) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            with open(self.index_path, "a") as index:
+                index.writelines(index_lines)
+                index.flush()
+                os.fsync(index.fileno())
+
+    def _index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        entries = []
+        with open(self.index_path, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn line from a crash mid-write
+                    continue
+        return entries
+
+    def _read_at(self, f, offset):
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    def _read_entries(self, entries):
+        if not entries:
+            return
+        with open(self.path, "rb") as f:
+            for entry in entries:
+                yield self._read_at(f, entry["offset"])
+
+    def iter_sessions(self, topic_id=None, since=None, until=None):
+        self.flush()
+        yield from self._read_entries([e for e in self._index() if _matches(e, topic_id, since, until)])
+
+    def changes(self, cursor=None):
+        """
+        Returns (cursor, records): the sessions appended since `cursor` (all
+        of them for None) and the cursor to pass next time, the offset of
+        the last one. Appends are locked, so offsets grow in write order.
+        """
+        self.flush()
+        entries = [e for e in self._index() if cursor is None or e["offset"] > cursor]
+        position = max((e["offset"] for e in entries), default=cursor)
+        return position, self._read_entries(entries)
+
+    def session_ids(self):
+        self.flush()
+        return {entry["session_id"] for entry in self._index()}
+
+    def get_session(self, session_id):
+        self.flush()
+        # Latest write wins
+        for entry in reversed(self._index()):
+            if entry["session_id"] == session_id:
+                with open(self.path, "rb") as f:
+                    return self._read_at(f, entry["offset"])
+        return None
+
+
+class SqliteStore(_BatchedStore):
+    """Sessions in SQLite, indexed by session id, topic id and saved_at."""
+
+    def __init__(self, directory=DATA_DIR, **kwargs):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "sessions.db")
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, topic_id TEXT, saved_at TEXT, data TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_topic ON sessions (topic_id, saved_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_saved_at ON sessions (saved_at)")
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _write_batch(self, batch):
+        rows = [
+            (r["session_id"], _topic_id(r), r["saved_at"], json.dumps(r))
+            for r in batch
+        ]
+        # An explicit rowid past the current maximum: plain INSERT OR REPLACE
+        # may reuse the replaced row's rowid, and changes() relies on rowids
+        # growing with every write
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (rowid, session_id, topic_id, saved_at, data) "
+                "VALUES ((SELECT IFNULL(MAX(rowid), 0) + 1 FROM sessions), ?, ?, ?, ?)",
+                rows,
+            )
+
+    def iter_sessions(self, topic_id=None, since=None, until=None):
+        self.flush()
+        query = "SELECT data FROM sessions WHERE 1=1"
+        params = []
+        if topic_id is not None:
+            query += " AND topic_id = ?"
+            params.append(topic_id)
+        if since is not None:
+            query += " AND saved_at >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND saved_at < ?"
+            params.append(until)
+        query += " ORDER BY saved_at"
+        with closing(self._connect()) as conn:
+            for (data,) in conn.execute(query, params):
+                yield json.loads(data)
+
+    def changes(self, cursor=None):
+        """
+        Returns (cursor, records): the sessions written since `cursor` (all
+        of them for None) and the cursor to pass next time, the last rowid.
+        """
+        self.flush()
+        with closing(self._connect()) as conn:
+            position = conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM sessions").fetchone()[0]
+
+        def records():
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT data FROM sessions WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+                    (cursor or 0, position),
+                )
+                for (data,) in rows:
+                    yield json.loads(data)
+
+        return position, records()
+
+    def session_ids(self):
+        self.flush()
+        with closing(self._connect()) as conn:
+            return {row[0] for row in conn.execute("SELECT session_id FROM sessions")}
+
+    def get_session(self, session_id):
+        self.flush()
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+STORES = {
+    "json": JsonFileStore,
+    "jsonl": JsonlStore,
+    "sqlite": SqliteStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Returns the process-wide session store selected by SESSION_STORE."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = STORES[SESSION_STORE]()
+        return _store
+
 def save_session(session_data):
-    """Saves the full session data to a JSON file."""
-    ensure_data_dir()
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    session_id = session_data.get("session_id", "unknown")
-    filename = f"session_{timestamp}_{session_id}.json"
-    filepath = os.path.join(DATA_DIR, filename)
-    
-    with open(filepath, "w") as f:
-        json.dump(session_data, f, indent=2)
-    
-    return filepath
+    """
+    Saves the full session data to the configured store.
+    Returns the session id it was saved under.
+    """
+    return get_store().save(session_data)
+
+class SessionWriter:
+    """
+    Saves sessions to the store from one background thread, so callers get
+    a Future back instead of waiting on the disk.
+
+    At most `max_pending` sessions are queued; beyond that submit() blocks
+    until the writer catches up. A save for a session that is still queued
+    replaces the queued record and shares its future, so bursts of saves for
+    one session cost one write. The queue is drained at interpreter exit,
+    and its size is exported as the session_write_backlog gauge.
+    """
+
+    def __init__(self, store=None, max_pending=STORE_WRITE_QUEUE):
+        self._store = store
+        self.max_pending = max_pending
+        # {session_id: (record, future)} in submission order
+        self._pending = OrderedDict()
+        self._writing = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def store(self):
+        return self._store or get_store()
+
+    def backlog(self):
+        with self._cond:
+            return len(self._pending) + self._writing
+
+    def _publish(self):
+        telemetry.gauge("session_write_backlog", len(self._pending) + self._writing)
+
+    def submit(self, session_data):
+        """Queues a save. The future resolves to the store's return value."""
+        record = _prepare(session_data)
+        session_id = record["session_id"]
+        with self._cond:
+            if not self._closed and session_id in self._pending:
+                _, future = self._pending[session_id]
+                self._pending[session_id] = (record, future)
+                telemetry.count("session_writes_coalesced_total")
+                return future
+            while not self._closed and len(self._pending) >= self.max_pending:
+                self._cond.wait()
+            future = Future()
+            if not self._closed:
+                self._pending[session_id] = (record, future)
+                self._publish()
+                self._cond.notify_all()
+                return future
+        # Saves after shutdown are written directly
+        self._write(record, future)
+        return future
+
+    def _write(self, record, future):
+        try:
+            future.set_result(self.store.save(record))
+        except Exception as e:
+            print(f"Session Writer Error: {e}")
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                _, (record, future) = self._pending.popitem(last=False)
+                self._writing += 1
+                self._cond.notify_all()
+            self._write(record, future)
+            with self._cond:
+                self._writing -= 1
+                self._publish()
+                self._cond.notify_all()
+
+    def flush(self):
+        """Blocks until every queued session is written and the store flushed."""
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+        self.store.flush()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.store.flush()
+
+
+_writer = None
+
+def get_writer():
+    """Returns the process-wide SessionWriter."""
+    global _writer
+    with _store_lock:
+        if _writer is None:
+            _writer = SessionWriter()
+        return _writer
+
+def save_session_async(session_data):
+    """Queues the session on the background writer and returns a Future."""
+    return get_writer().submit(session_data)
+
+def _add_stats(state, entry):
+    for agent, usage in entry.get("usage", {}).items():
+        totals = state["usage"].setdefault(agent, {})
+        for key, value in usage.items():
+            totals[key] = totals.get(key, 0) + value
+    state["timings"] += entry.get("timings", [])
+    state["compactions"] += entry.get("compactions", [])
+    for path, count in entry.get("profiler_paths", {}).items():
+        state["profiler_paths"][path] = state["profiler_paths"].get(path, 0) + count
+
+
+class SessionLock:
+    """
+    Exclusive flock on a session's log, held across processes for one
+    request's replay and appends. acquire() returns False when the log does
+    not exist: the session never started, or it was finalized and removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        while True:
+            try:
+                f = open(self.path, "r")
+            except FileNotFoundError:
+                return False
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(os.fstat(f.fileno()), current):
+                self._file = f
+                return True
+            # Removed while we waited
+            f.close()
+
+    def release(self):
+        if self._file is not None:
+            # Closing drops the flock
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SessionLog:
+    """
+    Write-ahead log of live sessions, one append-only JSONL file per session.
+
+    Every turn appends small records (a message, a profile update or a stage
+    decision) instead of rewriting the transcript. finalize() compacts the log
+    into the final session record; replay() rebuilds an in-progress session
+    after a restart, or on whichever agent worker serves its next request.
+
+    Profile records may carry the user turn they describe, so a profile
+    computed late (deferred profiling) never replaces a newer one. "stats"
+    records add up per-request usage and timings; the last "scheduler"
+    record holds the ProfilingScheduler state. A "finalized" record marks a
+    log whose session was queued on the writer but not yet removed.
+
+    Requests that replay and append, like a chat turn, hold lock() so that
+    their records are not interleaved with another worker's.
+    """
+
+    def __init__(self, directory=os.path.join(DATA_DIR, "live"), writer=None):
+        self.directory = directory
+        # None uses the process-wide session writer
+        self.writer = writer
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.log")
+
+    def append(self, session_id, kind, **fields):
+        """Appends one record and fsyncs it."""
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"t": datetime.now().isoformat(timespec="seconds"), "type": kind, **fields}
+        with open(self._path(session_id), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def exists(self, session_id):
+        return os.path.exists(self._path(session_id))
+
+    def lock(self, session_id):
+        return SessionLock(self._path(session_id))
+
+    def replay(self, session_id):
+        """Rebuilds the session state from its log, or returns None."""
+        if not self.exists(session_id):
+            return None
+        state = {
+            "session_id": session_id,
+            "topic": None,
+            "pre_survey": {},
+            "history": [],
+            "final_profile": {},
+            "stages": [],
+            "usage": {},
+            "timings": [],
+            "compactions": [],
+            "profiler_paths": {},
+        }
+        profile_turn = -1
+        with open(self._path(session_id), "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    continue
+                kind = entry["type"]
+                if kind == "start":
+                    state["topic"] = entry["topic"]
+                    state["pre_survey"] = entry["pre_survey"]
+                elif kind == "message":
+                    state["history"].append({"role": entry["role"], "content": entry["content"]})
+                elif kind == "profile":
+                    turn = entry.get("turn")
+                    if turn is None or turn >= profile_turn:
+                        state["final_profile"] = entry["profile"]
+                        profile_turn = profile_turn if turn is None else turn
+                elif kind == "stage":
+                    state["stages"].append(entry["stage"])
+                elif kind == "stats":
+                    _add_stats(state, entry)
+                elif kind == "scheduler":
+                    state["scheduler"] = entry["state"]
+                elif kind == "finalized":
+                    state["finalized"] = True
+        return state
+
+    def finalize(self, session_id, extra=None, status="complete"):
+        """
+        Compacts the log into a session record and queues it on the session
+        writer. The log is removed once the record is written. `extra` holds
+        fields to add, or is a function of the replayed record returning them.
+
+        A session is queued once: repeated or concurrent calls from any
+        process find the "finalized" marker under the session lock and get a
+        resolved future. Returns the writer's future, or None for unknown
+        sessions.
+        """
+        with self.lock(session_id) as live:
+            if not live:
+                return None
+            record = self.replay(session_id)
+            if record.pop("finalized", False):
+                done = Future()
+                done.set_result(None)
+                return done
+            if callable(extra):
+                extra = extra(record)
+            record.pop("scheduler", None)
+            record.update(extra or {})
+            record["status"] = status
+            future = (self.writer or get_writer()).submit(record)
+            self.append(session_id, "finalized")
+        future.add_done_callback(lambda f: f.exception() is None and self._remove(session_id))
+        return future
+
+    def _remove(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            # Removed by hand, or the record was written twice
+            pass
+
+    def live_sessions(self):
+        """Ids of sessions that have a log but were never finalized."""
+        if not os.path.isdir(self.directory):
+            return []
+        return [name[:-len(".log")] for name in os.listdir(self.directory) if name.endswith(".log")]
+
+    def recover_stale(self, max_age):
+        """Finalizes logs untouched for max_age seconds as incomplete sessions."""
+        recovered = 0
+        now = datetime.now().timestamp()
+        for session_id in self.live_sessions():
+            if now - os.path.getmtime(self._path(session_id)) >= max_age:
+                self.finalize(session_id, status="incomplete")
+                recovered += 1
+        return recovered
+
+
+def migrate(target, directory=DATA_DIR):
+    """
+    Imports the data/session_*.json files into another store. Sessions the
+    store already has are skipped, so it can be re-run after new saves.
+    """
+    source = JsonFileStore(directory)
+    store = STORES[target](directory)
+    existing = store.session_ids()
+    count = skipped = 0
+    for filepath, record in source._iter_files():
+        if record.get("session_id") in (None, "", "unknown"):
+            # Same id on every run, from the file it came from
+            record["session_id"] = uuid.uuid5(uuid.NAMESPACE_URL, os.path.basename(filepath)).hex
+        if record["session_id"] in existing:
+            skipped += 1
+            continue
+        store.save(record)
+        existing.add(record["session_id"])
+        count += 1
+    store.close()
+    print(f"Imported {count} sessions into {store.path} ({skipped} already there)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session storage tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = sub.add_parser("migrate", help="import data/*.json into another store")
+    migrate_parser.add_argument("--to", choices=["jsonl", "sqlite"], required=True)
+    recover_parser = sub.add_parser("recover", help="save abandoned live sessions as incomplete")
+    recover_parser.add_argument("--max-age", type=float, default=3600,
+                                help="seconds since the last checkpoint")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.to)
+    elif args.command == "recover":
+        recovered = SessionLog().recover_stale(args.max_age)
+        get_writer().close()
+        get_store().close()
+        print(f"Recovered {recovered} sessions")
+
+
+if __name__ == "__main__":
+    main()
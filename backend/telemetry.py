@@ -0,0 +1,372 @@
+"""
+Process-wide telemetry for LLM calls.
+
+Every chat.completions call the agents make is recorded as one event: wall
+time, time to first token (streams), prompt/cached/completion tokens, cost,
+retries, model, agent, method, stage and outcome:
+
+    ok        the completion was used
+    fallback  a response arrived but was unusable (bad JSON, empty or cut-off
+              stream), so the user got the hard-coded fallback
+    error     the request itself failed, so the user got the fallback
+    cancelled the consumer stopped reading a stream before it ended
+
+Events feed in-memory counters and latency histograms, exposed in the
+Prometheus text format on METRICS_PORT, and are appended to LLM_TRACE_FILE
+as JSON lines when it is set. A trace can be replayed into fresh metrics:
+
+    python -m backend.telemetry replay data/llm_trace.jsonl
+    python -m backend.telemetry replay data/llm_trace.jsonl --port 9464
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Append one JSON line per LLM call here (empty disables the trace)
+LLM_TRACE_FILE = os.getenv("LLM_TRACE_FILE", "")
+# Serve /metrics on this port from the app process (0 disables it)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# USD per million tokens by model, as used in the model label:
+# "gpt-5.1=1.25/10;gemini:gemini-2.5-flash=0.30/2.50/0.075" is
+# input/output[/cached input]; cached input defaults to the input price
+LLM_PRICES = os.getenv("LLM_PRICES", "")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+LABELS = ("agent", "method", "stage", "model")
+
+
+def parse_prices(text):
+    """Parses LLM_PRICES into {model: (input, output, cached input)}."""
+    prices = {}
+    for entry in text.split(";"):
+        if not entry.strip():
+            continue
+        model, _, values = entry.rpartition("=")
+        try:
+            parts = [float(v) for v in values.split("/")]
+            prices[model.strip()] = (parts[0], parts[1], parts[2] if len(parts) > 2 else parts[0])
+        except (ValueError, IndexError):
+            print(f"Telemetry Price Error: cannot parse {entry!r}")
+    return prices
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class LLMCall:
+    """
+    One in-flight call. Create it with Telemetry.start right before the
+    request, then end it with ok() or fail(e) exactly once.
+    """
+
+    def __init__(self, telemetry, agent, method, model, stage=None):
+        self.telemetry = telemetry
+        self.event = {
+            "agent": agent,
+            "method": method,
+            "stage": stage or "",
+            "model": model,
+            "retries": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+            "ttft": None,
+        }
+        self.responded = False
+        self._start = time.perf_counter()
+
+    @property
+    def method(self):
+        return self.event["method"]
+
+    @property
+    def model(self):
+        return self.event["model"]
+
+    def retried(self):
+        self.event["retries"] += 1
+
+    def add_usage(self, usage):
+        self.responded = True
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.event["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+        self.event["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+        self.event["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def first_token(self):
+        self.responded = True
+        if self.event["ttft"] is None:
+            self.event["ttft"] = time.perf_counter() - self._start
+
+    def ok(self):
+        self._finish("ok")
+
+    def cancel(self):
+        self._finish("cancelled")
+
+    def fail(self, error):
+        self.event["error"] = f"{type(error).__name__}: {error}"
+        self._finish("fallback" if self.responded else "error")
+
+    def _finish(self, outcome):
+        self.event["outcome"] = outcome
+        self.event["duration"] = time.perf_counter() - self._start
+        self.event["ts"] = datetime.now().isoformat()
+        self.telemetry.record(self.event)
+
+
+class Telemetry:
+    def __init__(self, trace_path=LLM_TRACE_FILE, prices=LLM_PRICES):
+        self.trace_path = trace_path
+        self.prices = parse_prices(prices)
+        self._lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.cost = defaultdict(float)
+        self.retries = defaultdict(int)
+        self.duration = defaultdict(Histogram)
+        self.ttft = defaultdict(Histogram)
+        # Other components' metrics: {(name, sorted label pairs): value}
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        # Called with every recorded call event, e.g. by the adaptive router
+        self.listeners = []
+
+    def start(self, agent, method, model, stage=None):
+        return LLMCall(self, agent, method, model, stage)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def count(self, name, amount=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def price(self, event):
+        """USD cost of a call's tokens, or None when its model has no price."""
+        prices = self.prices.get(event.get("model"))
+        if prices is None:
+            return None
+        cached = event.get("cached_tokens", 0)
+        return (
+            (event.get("prompt_tokens", 0) - cached) * prices[0]
+            + cached * prices[2]
+            + event.get("completion_tokens", 0) * prices[1]
+        ) / 1e6
+
+    def record(self, event, trace=True):
+        labels = tuple(event.get(name) or "" for name in LABELS)
+        outcome = event.get("outcome", "ok")
+        if event.get("cost") is None:
+            cost = self.price(event)
+            if cost is not None:
+                event["cost"] = cost
+        with self._lock:
+            self.calls[labels + (outcome,)] += 1
+            self.duration[labels + (outcome,)].observe(event.get("duration", 0.0))
+            if event.get("ttft") is not None:
+                self.ttft[labels].observe(event["ttft"])
+            for kind in ("prompt", "cached", "completion"):
+                self.tokens[labels + (kind,)] += event.get(f"{kind}_tokens", 0)
+            self.cost[labels] += event.get("cost", 0.0)
+            self.retries[labels] += event.get("retries", 0)
+            if trace and self.trace_path:
+                self._write_trace(event)
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"Telemetry Listener Error: {e}")
+
+    def _write_trace(self, event):
+        try:
+            directory = os.path.dirname(self.trace_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(event) + "\n")
+        except OSError as e:
+            print(f"Telemetry Trace Error: {e}")
+
+    def replay(self, path):
+        """Feeds a JSONL trace into these metrics. Returns the number of events."""
+        count = 0
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    self.record(json.loads(line), trace=False)
+                    count += 1
+        return count
+
+    def prometheus_text(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP llm_calls_total LLM calls by outcome (ok, fallback, error, cancelled).",
+                "# TYPE llm_calls_total counter",
+            ]
+            for key, value in sorted(self.calls.items()):
+                lines.append(f"llm_calls_total{_labels(key, 'outcome')} {value}")
+
+            lines += [
+                "# HELP llm_tokens_total Prompt, cached prompt and completion tokens.",
+                "# TYPE llm_tokens_total counter",
+            ]
+            for key, value in sorted(self.tokens.items()):
+                lines.append(f"llm_tokens_total{_labels(key, 'kind')} {value}")
+
+            lines += [
+                "# HELP llm_cost_usd_total Cost of LLM calls at LLM_PRICES.",
+                "# TYPE llm_cost_usd_total counter",
+            ]
+            for key, value in sorted(self.cost.items()):
+                lines.append(f"llm_cost_usd_total{_labels(key)} {value:.6f}")
+
+            lines += [
+                "# HELP llm_retries_total Retried LLM requests.",
+                "# TYPE llm_retries_total counter",
+            ]
+            for key, value in sorted(self.retries.items()):
+                lines.append(f"llm_retries_total{_labels(key)} {value}")
+
+            lines += _histogram_lines(
+                "llm_call_duration_seconds", "Wall time of LLM calls.", self.duration, "outcome"
+            )
+            lines += _histogram_lines(
+                "llm_time_to_first_token_seconds", "Time to first streamed token.", self.ttft
+            )
+            lines += _metric_lines("counter", self.counters)
+            lines += _metric_lines("gauge", self.gauges)
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key, extra=None, le=None):
+    names = LABELS + ((extra,) if extra else ())
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, key)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(name, help_text, histograms, extra=None):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for key, hist in sorted(histograms.items()):
+        for bound, count in zip(hist.buckets, hist.counts):
+            lines.append(f"{name}_bucket{_labels(key, extra, le=bound)} {count}")
+        lines.append(f"{name}_bucket{_labels(key, extra, le='+Inf')} {hist.count}")
+        lines.append(f"{name}_sum{_labels(key, extra)} {hist.sum:.6f}")
+        lines.append(f"{name}_count{_labels(key, extra)} {hist.count}")
+    return lines
+
+
+def _metric_lines(kind, values):
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(values.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} {kind}")
+            typed.add(name)
+        pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+        lines.append(f"{name}{{{pairs}}} {value:g}" if pairs else f"{name} {value:g}")
+    return lines
+
+
+telemetry = Telemetry()
+
+
+def start_call(agent, method, model, stage=None):
+    """Starts timing an LLM call on the process-wide telemetry."""
+    return telemetry.start(agent, method, model, stage)
+
+
+def make_metrics_server(port, host="0.0.0.0", source=None):
+    source = source or telemetry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = source.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    return server
+
+
+def start_metrics_server(port=METRICS_PORT, host="0.0.0.0"):
+    """Serves /metrics on a daemon thread. Returns the server, or None when disabled."""
+    if not port:
+        return None
+    try:
+        server = make_metrics_server(port, host)
+    except OSError as e:
+        print(f"Metrics Server Error: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM call telemetry")
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay = sub.add_parser("replay", help="rebuild metrics from a JSONL trace")
+    replay.add_argument("path")
+    replay.add_argument("--port", type=int, default=0,
+                        help="serve the replayed metrics on /metrics instead of printing them")
+    args = parser.parse_args()
+
+    replayed = Telemetry(trace_path="")
+    count = replayed.replay(args.path)
+    if not args.port:
+        print(replayed.prometheus_text(), end="")
+        return
+    print(f"Replayed {count} calls, serving http://0.0.0.0:{args.port}/metrics")
+    try:
+        make_metrics_server(args.port, source=replayed).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
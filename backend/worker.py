@@ -0,0 +1,369 @@
+"""
+Agent worker: serves an AgentService over HTTP so the Streamlit frontends
+stay stateless and the LLM work can scale out separately.
+
+    GET  /health
+    GET  /metrics                    telemetry of this worker process
+    GET  /sessions/<id>              replayed session state
+    POST /sessions/<id>/prefetch     {"topic", "pre_survey"}, answered at once
+    POST /sessions/<id>/start        {"topic", "pre_survey", "stream"}
+    POST /sessions/<id>/turn         {"message", "target_stance", "stream"}
+    POST /sessions/<id>/finish       {"post_survey"}
+
+With "stream": true the response is server-sent events: {"type": "token"}
+for each streamed piece of text, {"type": "reset"} when the reply is
+regenerated and streaming starts over, then {"type": "result"} or
+{"type": "error"}.
+
+Workers share session state through the SessionLog directory (data/live),
+so any worker can serve any request. Run N workers on one machine with:
+
+    python -m backend.worker --port 8100 --processes 4
+
+and point each frontend at them with
+AGENT_WORKER_URLS=http://127.0.0.1:8100,http://127.0.0.1:8101,...
+WorkerClient sends every request of a session to the same worker (so its
+deferred profiling is picked up in-process) and fails over to the next one
+when that worker cannot be reached.
+
+Each worker process serves its requests on one asyncio event loop through
+AgentService's async methods, so sessions waiting on the LLM hold no
+threads; LLM_MAX_IN_FLIGHT and the HTTP pool bound the calls it makes.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import socket
+import threading
+from http import HTTPStatus
+
+import httpx
+
+from backend.service import AgentService, SessionNotFound
+from backend.telemetry import telemetry
+
+# Seconds a frontend waits for a worker response (a whole turn, retries included)
+AGENT_WORKER_TIMEOUT = float(os.getenv("AGENT_WORKER_TIMEOUT", "120"))
+
+SESSION_PATH = re.compile(r"^/sessions/([A-Za-z0-9_-]+)(?:/(prefetch|start|turn|finish))?$")
+
+
+class WorkerError(Exception):
+    """Raised by WorkerClient when no worker could serve a request."""
+
+
+class _Response:
+    """Writes one HTTP response; every connection serves a single request."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    async def _head(self, status, headers):
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", *headers, "Connection: close", "", ""]
+        self.writer.write("\r\n".join(lines).encode("latin-1"))
+        await self.writer.drain()
+
+    async def send(self, status, body, content_type="application/json"):
+        await self._head(status, [f"Content-Type: {content_type}", f"Content-Length: {len(body)}"])
+        self.writer.write(body)
+        await self.writer.drain()
+
+    async def send_json(self, status, payload):
+        await self.send(status, json.dumps(payload).encode("utf-8"))
+
+    async def start_events(self):
+        await self._head(200, ["Content-Type: text/event-stream", "Cache-Control: no-cache"])
+
+    async def send_event(self, payload):
+        try:
+            self.writer.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            await self.writer.drain()
+        except OSError:
+            # The frontend went away; finish the request so the log stays complete
+            pass
+
+
+class AgentWorker:
+    """
+    Serves an AgentService on an asyncio event loop. Start, turn and finish
+    await the service's async methods, so a session waiting on the LLM holds
+    no thread and one worker process can serve many concurrent sessions.
+    """
+
+    def __init__(self, sock, service):
+        self.socket = sock
+        self.server_address = sock.getsockname()[:2]
+        self.service = service
+        self._loop = None
+        self._stop = None
+        self._started = threading.Event()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = await asyncio.start_server(self._handle, sock=self.socket)
+        self._started.set()
+        async with server:
+            await self._stop.wait()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        """Stops serve_forever from another thread."""
+        self._started.wait()
+        self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _handle(self, reader, writer):
+        response = _Response(writer)
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        try:
+            if method == "GET":
+                await self._get(target.rstrip("/"), response)
+            elif method == "POST":
+                await self._post(target.rstrip("/"), body, response)
+            else:
+                await response.send_json(405, {"error": "method not allowed"})
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _get(self, path, response):
+        if path == "/health":
+            await response.send_json(200, {"status": "ok"})
+            return
+        if path == "/metrics":
+            await response.send(200, telemetry.prometheus_text().encode("utf-8"),
+                                content_type="text/plain; version=0.0.4")
+            return
+        match = SESSION_PATH.match(path)
+        if not match or match.group(2):
+            await response.send_json(404, {"error": "not found"})
+            return
+        state = await asyncio.to_thread(self.service.state, match.group(1))
+        if state is None:
+            await response.send_json(404, {"error": "unknown session"})
+            return
+        await response.send_json(200, state)
+
+    async def _post(self, path, body, response):
+        match = SESSION_PATH.match(path)
+        if not match or not match.group(2):
+            await response.send_json(404, {"error": "not found"})
+            return
+        session_id, action = match.groups()
+        request = json.loads(body or b"{}")
+        telemetry.count("agent_worker_requests_total", action=action)
+
+        if action == "prefetch":
+            self.service.prefetch(session_id, request["topic"], request["pre_survey"])
+            await response.send_json(202, {"scheduled": True})
+            return
+        if action == "finish":
+            if await self.service.afinish(session_id, request.get("post_survey", {})):
+                await response.send_json(200, {"saved": True})
+            else:
+                await response.send_json(404, {"error": "unknown session"})
+            return
+        if action == "turn" and not self.service.log.exists(session_id):
+            await response.send_json(404, {"error": "unknown session"})
+            return
+
+        async def run(render=None):
+            if action == "start":
+                return await self.service.astart(session_id, request["topic"], request["pre_survey"],
+                                                 render=render)
+            return await self.service.aturn(session_id, request["message"], render=render,
+                                            target_stance=request.get("target_stance", "pro"))
+
+        if not request.get("stream"):
+            try:
+                result = await run()
+            except Exception as e:
+                print(f"Agent Worker Error ({action}): {e}")
+                telemetry.count("agent_worker_errors_total", action=action)
+                await response.send_json(500, {"error": str(e)})
+                return
+            await response.send_json(200, result)
+            return
+
+        await response.start_events()
+        attempts = []
+
+        async def render(stream):
+            if attempts:
+                await response.send_event({"type": "reset"})
+            attempts.append(stream)
+            parts = []
+            async for text in stream:
+                parts.append(text)
+                await response.send_event({"type": "token", "text": text})
+            return "".join(parts)
+
+        try:
+            await response.send_event({"type": "result", "result": await run(render)})
+        except Exception as e:
+            print(f"Agent Worker Error ({action}): {e}")
+            telemetry.count("agent_worker_errors_total", action=action)
+            await response.send_event({"type": "error", "error": str(e)})
+
+
+def make_server(host="127.0.0.1", port=8100, service=None):
+    """Binds a worker around its own AgentService; serve_forever() runs it."""
+    return AgentWorker(socket.create_server((host, port)), service or AgentService())
+
+
+def start_in_background(**kwargs):
+    """Starts a worker on a daemon thread and returns it."""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="agent-worker", daemon=True).start()
+    return server
+
+
+def _events(lines):
+    for line in lines:
+        if line.startswith("data: "):
+            yield json.loads(line[len("data: "):])
+
+
+def _render_events(events, render):
+    """
+    Replays a worker's event stream through `render`, once per streamed
+    attempt like stream_turn does, and returns the final result.
+    """
+    outcome = {}
+
+    def attempt():
+        for event in events:
+            if event["type"] == "token":
+                yield event["text"]
+            elif event["type"] == "reset":
+                return
+            else:
+                outcome.update(event)
+                return
+        outcome.update({"type": "error", "error": "stream ended without a result"})
+
+    while not outcome:
+        render(attempt())
+    if outcome["type"] == "error":
+        raise WorkerError(outcome["error"])
+    return outcome["result"]
+
+
+class WorkerClient:
+    """Same interface as AgentService, served by remote agent workers."""
+
+    def __init__(self, urls, timeout=AGENT_WORKER_TIMEOUT):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.http = httpx.Client(timeout=timeout)
+
+    def _workers(self, session_id):
+        """Every worker, starting with the session's own."""
+        first = int(hashlib.sha256(session_id.encode("utf-8")).hexdigest(), 16) % len(self.urls)
+        return self.urls[first:] + self.urls[:first]
+
+    def _request(self, method, session_id, path, payload=None, render=None):
+        """Returns (status, body). Only unreachable workers are failed over."""
+        for url in self._workers(session_id):
+            try:
+                if render is None:
+                    response = self.http.request(method, f"{url}/sessions/{session_id}{path}", json=payload)
+                    if response.status_code >= 500:
+                        raise WorkerError(response.json().get("error", response.text))
+                    return response.status_code, response.json()
+                with self.http.stream(method, f"{url}/sessions/{session_id}{path}",
+                                      json={**payload, "stream": True}) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        return response.status_code, response.json()
+                    return 200, _render_events(_events(response.iter_lines()), render)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                print(f"Agent Worker Error ({url}): {e}")
+            except httpx.HTTPError as e:
+                raise WorkerError(f"{url}: {e}") from e
+        raise WorkerError("no agent worker reachable")
+
+    def state(self, session_id):
+        status, body = self._request("GET", session_id, "")
+        return body if status == 200 else None
+
+    def prefetch(self, session_id, topic, pre_survey):
+        # Only a hint; never worth holding up the survey page
+        try:
+            self._request("POST", session_id, "/prefetch", {"topic": topic, "pre_survey": pre_survey})
+        except WorkerError as e:
+            print(f"Start Prefetch Error: {e}")
+
+    def start(self, session_id, topic, pre_survey, render=None):
+        _, body = self._request("POST", session_id, "/start",
+                                {"topic": topic, "pre_survey": pre_survey}, render=render)
+        return body
+
+    def turn(self, session_id, message, render=None, target_stance="pro"):
+        status, body = self._request("POST", session_id, "/turn",
+                                     {"message": message, "target_stance": target_stance},
+                                     render=render)
+        if status == 404:
+            raise SessionNotFound(session_id)
+        return body
+
+    def finish(self, session_id, post_survey):
+        status, _ = self._request("POST", session_id, "/finish", {"post_survey": post_survey})
+        return status == 200
+
+
+def serve(host, port):
+    server = make_server(host=host, port=port)
+    print(f"Agent worker listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent worker service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes, listening on consecutive ports")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        serve(args.host, args.port)
+        return
+    ports = range(args.port, args.port + args.processes)
+    urls = ",".join(f"http://{args.host}:{port}" for port in ports)
+    print(f"AGENT_WORKER_URLS={urls}")
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=serve, args=(args.host, port)) for port in ports]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Load harness: drives N concurrent simulated sessions through AgentService,
+the same start/turn/finish requests the app makes, and reports throughput,
+latency percentiles and fallback/error rates per request and per LLM call
+(analyze_survey, generate_opening, analyze, generate_reply, fused_turn).
+
+Runs against the local mock server by default, so no API money is spent:
+
+    python load_test.py --sessions 50 --concurrency 10 --turns 6 --start-mock
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Add root to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+USER_MESSAGES = [
+    "ok",
+    "idk, it depends",
+    "I think it matters a lot for regular people.",
+    "Honestly I have never thought about it that much.",
+    "My family has always done it this way and it works for us.",
+    "That sounds expensive and unrealistic to me.",
+    "Maybe, but I would need to see it work first.",
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class Recorder:
+    """
+    Thread-safe latency and outcome counters. Requests are timed with
+    timed(); LLM calls arrive through observe() as telemetry events.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.calls = defaultdict(int)
+        self.fallbacks = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.profiler_paths = defaultdict(int)
+
+    def timed(self, label, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.errors[label] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies[label].append(elapsed)
+                self.calls[label] += 1
+
+    def observe(self, event):
+        """Telemetry listener: an LLM call, labelled by its method."""
+        label = event["method"]
+        with self.lock:
+            self.latencies[label].append(event.get("duration", 0.0))
+            self.calls[label] += 1
+            if event.get("outcome") in ("fallback", "error"):
+                # The agent answered with its local fallback
+                self.fallbacks[label] += 1
+
+
+def run_session(recorder, service, topic, turns):
+    """One session as the app runs it: Start Chat, `turns` messages, then the post-chat survey."""
+    session_id = f"loadtest_{random.getrandbits(32):08x}"
+    answers = {q: random.randint(1, 10) for q in topic["questions"]}
+    recorder.timed("start", service.start, session_id, topic, answers)
+    for _ in range(turns):
+        recorder.timed("turn", service.turn, session_id, random.choice(USER_MESSAGES))
+
+    state = service.state(session_id)
+    with recorder.lock:
+        for path, count in state["profiler_paths"].items():
+            recorder.profiler_paths[path] += count
+    recorder.timed("finish", service.finish, session_id, answers)
+
+
+def report(recorder, sessions, elapsed):
+    print(f"\n{sessions} sessions in {elapsed:.2f}s ({sessions / elapsed:.2f} sessions/s, "
+          f"{recorder.calls['turn'] / elapsed:.2f} turns/s)\n")
+    print(f"{'stage':<18}{'calls':>7}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'fallback':>10}{'error':>8}")
+    for stage in ["analyze_survey", "generate_opening", "analyze", "generate_reply", "fused_turn",
+                  "start", "turn", "finish"]:
+        values = recorder.latencies.get(stage, [])
+        calls = recorder.calls.get(stage, 0)
+        if not calls:
+            continue
+        fallback_rate = recorder.fallbacks.get(stage, 0) / calls
+        error_rate = recorder.errors.get(stage, 0) / calls
+        print(f"{stage:<18}{calls:>7}"
+              f"{percentile(values, 50) * 1000:>7.0f}ms{percentile(values, 90) * 1000:>7.0f}ms"
+              f"{percentile(values, 95) * 1000:>7.0f}ms{percentile(values, 99) * 1000:>7.0f}ms"
+              f"{fallback_rate:>10.1%}{error_rate:>8.1%}")
+    if recorder.profiler_paths:
+        paths = ", ".join(f"{k}={v}" for k, v in sorted(recorder.profiler_paths.items()))
+        print(f"\nProfiler paths: {paths}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session load test for the agent flow")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8008/v1")
+    parser.add_argument("--start-mock", action="store_true",
+                        help="start the mock server in-process on the base URL's port")
+    parser.add_argument("--latency", default="lognormal:-1.0,0.5",
+                        help="mock latency distribution (with --start-mock)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="mock error rate (with --start-mock)")
+    parser.add_argument("--keep-sessions", action="store_true",
+                        help="save the sessions to the configured store in data/ "
+                             "instead of a temporary one")
+    args = parser.parse_args()
+
+    # Every provider, so no route leaves the mock. Read when
+    # backend.providers creates the clients.
+    for provider in ("OPENAI", "GEMINI", "LOCAL_LLM"):
+        os.environ[f"{provider}_BASE_URL"] = args.base_url
+        os.environ.setdefault(f"{provider}_API_KEY", "load-test")
+
+    if args.start_mock:
+        from urllib.parse import urlparse
+        from backend.mock_server import start_in_background
+        url = urlparse(args.base_url)
+        start_in_background(host=url.hostname, port=url.port, latency=args.latency,
+                            error_rate=args.error_rate)
+
+    from backend.cache import ResponseCache
+    from backend.config import load_topics
+    from backend.service import AgentService
+    from backend.storage import SESSION_STORE, STORES, SessionLog, SessionWriter, get_writer
+    from backend.telemetry import telemetry
+    topics = load_topics()
+
+    # Live logs and the Start Chat cache are always scratch; finished sessions
+    # go to the same kind of store as the app's, but only to data/ on request
+    scratch = tempfile.TemporaryDirectory()
+    if args.keep_sessions:
+        writer = get_writer()
+    else:
+        writer = SessionWriter(STORES[SESSION_STORE](os.path.join(scratch.name, "sessions")))
+    service = AgentService(log=SessionLog(os.path.join(scratch.name, "live"), writer=writer),
+                           cache=ResponseCache(os.path.join(scratch.name, "cache.db")))
+
+    recorder = Recorder()
+    telemetry.add_listener(recorder.observe)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(run_session, recorder, service, random.choice(topics), args.turns)
+            for _ in range(args.sessions)
+        ]
+        failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Session failed: {e}")
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    if not args.keep_sessions:
+        writer.close()
+        writer.store.close()
+    scratch.cleanup()
+
+    report(recorder, args.sessions, elapsed)
+    if failed:
+        print(f"\n{failed} sessions failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,31 @@
+import asyncio
 import os
 import json
+import stat
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 # Add root to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from backend.config import load_topics, get_topic_by_id
-from backend.storage import save_session
-from backend.agents import ProfilerAgent, PersuaderAgent
+from backend.config import TopicRegistry, load_topics, get_topic_by_id
+from backend import storage
+from backend.storage import save_session, JsonFileStore, SessionLog, SessionWriter
+from backend.agents import FUSED_INSTRUCTIONS, FusedAgent, ProfilerAgent, PersuaderAgent, validate_profile, provisional_profile
+from backend.compaction import HistoryCompactor, estimate_tokens
+from backend.jsonstream import JsonFieldParser
+from backend.heuristics import FastPathProfilerAgent, estimate_profile
+from backend.telemetry import Telemetry
+from backend.providers import AdaptiveRouter, Provider, Router
+from backend.resilience import CallPolicy, CircuitOpenError
+from backend.admission import AdmissionController, AdmissionTimeout, arelease_after, release_after
+from backend.scheduler import ProfilingScheduler, stage_depends_on_profile
+from backend.cache import ResponseCache, cache_key
+from backend.service import AgentService, SessionNotFound
+from backend.analytics import SurveyFrame, bootstrap_ci, load_frame, summarize
 
 def test_config():
     print("Testing Config...")
@@ -17,22 +35,989 @@ def test_config():
     
     t = get_topic_by_id(topics[0]["id"])
     assert t is not None, "Could not get topic by ID"
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "topics.json")
+        with open(path, "w") as f:
+            json.dump([{"id": "a"}], f)
+        os.chmod(path, 0o640)
+        fresh = TopicRegistry(path, check_interval=0)
+        cached = TopicRegistry(path, check_interval=60)
+        assert fresh.get("a") and cached.get("a"), "Topics file not loaded"
+        
+        # Another process edits the file
+        subprocess.run([sys.executable, "-c",
+                        f"import json; json.dump([{{'id': 'a'}}, {{'id': 'b'}}], open({path!r}, 'w'))"],
+                       check=True)
+        assert fresh.get("b") is not None, "Edit by another process not picked up"
+        assert cached.get("b") is None, "Registry re-read the file before TOPICS_CHECK_INTERVAL"
+        cached.check_interval = 0
+        assert cached.get("b") is not None, "Edit not picked up once the interval passed"
+        
+        version = cached.version
+        cached.save([{"id": "c"}])
+        assert cached.version == version + 1 and cached.get("c"), "save() did not refresh the index"
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o640, f"save() changed the mode: {oct(os.stat(path).st_mode)}"
+        try:
+            cached.save([{"id": object()}])
+            assert False, "Unserializable topics should fail"
+        except TypeError:
+            pass
+        assert fresh.topics() == [{"id": "c"}], "A failed save must leave the file intact"
+        assert os.listdir(directory) == ["topics.json"], f"Temp files left: {os.listdir(directory)}"
     print("Config Test Passed.")
 
+def _save_jsonl_sessions(directory, worker, count):
+    # Runs in a separate process, like one of `backend.worker --processes N`
+    store = storage.JsonlStore(directory, batch_size=1, flush_interval=60)
+    for i in range(count):
+        store.save({"session_id": f"w{worker}_{i}", "topic": "t", "history": ["x" * (i % 50)]})
+    store.close()
+
 def test_storage():
     print("Testing Storage...")
     data = {"test": "data", "session_id": "test_123"}
-    filepath = save_session(data)
-    assert os.path.exists(filepath), "File not created"
-    
-    with open(filepath, "r") as f:
-        loaded = json.load(f)
+    with tempfile.TemporaryDirectory() as directory:
+        store, storage._store = storage._store, JsonFileStore(directory)
+        try:
+            session_id = save_session(data)
+            assert session_id == "test_123", "save_session must return the session id"
+            loaded = storage._store.get_session(session_id)
+        finally:
+            storage._store = store
     assert loaded["test"] == "data", "Data mismatch"
     
-    # Clean up
-    os.remove(filepath)
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "session_20240101_120000_unknown.json"), "w") as f:
+            json.dump({"session_id": "unknown", "topic": "t"}, f)
+        storage.migrate("jsonl", directory)
+        storage.migrate("jsonl", directory)
+        migrated = list(storage.JsonlStore(directory).iter_sessions())
+    assert len(migrated) == 1, f"Re-running migrate duplicated sessions: {len(migrated)}"
+
+    # A watermark skips older files by name, without parsing them
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "session_20240101_120000_old.json"), "w") as f:
+            f.write("not json")
+        new_id = JsonFileStore(directory).save({"session_id": "new", "topic": "t"})
+        recent = list(JsonFileStore(directory).iter_sessions(since="2025-01-01T00:00:00"))
+    assert [r["session_id"] for r in recent] == [new_id], "Watermark did not skip older files"
+
+    # Processes sharing one JSONL store must not corrupt each other's offsets
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        processes = [context.Process(target=_save_jsonl_sessions, args=(directory, w, 100)) for w in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(os.path.join(directory, "sessions.idx.jsonl"), "a") as f:
+            f.write('{"session_id": "torn", "off')
+        store = storage.JsonlStore(directory)
+        entries = store._index()
+        with open(store.path, "rb") as f:
+            misplaced = [e for e in entries if store._read_at(f, e["offset"])["session_id"] != e["session_id"]]
+        store.close()
+    assert len(entries) == 400, f"Lost index entries: {len(entries)}"
+    assert not misplaced, f"{len(misplaced)} index entries point at another record"
     print("Storage Test Passed.")
 
+def _survey_session(session_id, post, stance="pro", saved_at=None):
+    record = {
+        "session_id": session_id,
+        "topic": {"id": "t"},
+        "pre_survey": {"q1": 5, "q2": 5},
+        "post_survey": {"q1": post, "q2": 5},
+        "final_profile": {"stance": stance, "style": "brief"},
+    }
+    if saved_at is not None:
+        record["saved_at"] = saved_at
+    return record
+
+def test_analytics():
+    print("Testing Analytics...")
+    import numpy as np
+    values = np.array([1.0, 1.0, 1.0, 2.0, 4.0, 6.0, 3.0])
+    groups = np.array([0, 0, 0, 1, 1, 1, 2])
+    low, high = bootstrap_ci(values, groups, 3, n_boot=500)
+    assert low[0] == high[0] == 1.0, "Constant group should have a zero-width CI"
+    assert low[1] < 4.0 < high[1], "CI should contain the group mean"
+    assert np.isnan(low[2]) and np.isnan(high[2]), "Single-row groups have no CI"
+    
+    frame = SurveyFrame()
+    frame.add_session(_survey_session("a", 7, stance="pro"))
+    frame.add_session(_survey_session("b", 9, stance="anti"))
+    summary = summarize(frame, n_boot=100)
+    q1 = next(q for q in summary["questions"] if q["question"] == "q1")
+    assert q1["n"] == 2 and q1["mean_delta"] == 3.0, f"Wrong per-question stats: {q1}"
+    by_stance = {row["group"]: row["mean_delta"] for row in summary["by_stance"]}
+    assert by_stance == {"pro": 1.0, "anti": 2.0}, f"Wrong stance breakdown: {by_stance}"
+    
+    for kind in ["json", "jsonl", "sqlite"]:
+        with tempfile.TemporaryDirectory() as directory:
+            store = storage.STORES[kind](directory)
+            cache_path = os.path.join(directory, "analytics_cache.npz")
+            store.save(_survey_session("a", 7, saved_at="2026-01-01T12:00:00"))
+            frame, added = load_frame(store, cache_path)
+            assert added == 1, f"{kind}: first load added {added}"
+            
+            # Lands after the cache was written but carries an older saved_at
+            store.save(_survey_session("late", 8, saved_at="2026-01-01T11:00:00"))
+            # Saved again with a different answer
+            time.sleep(0.01)
+            store.save(_survey_session("a", 3, saved_at="2026-01-01T12:00:00"))
+            frame, added = load_frame(store, cache_path)
+            assert added == 2, f"{kind}: reload added {added}"
+            assert sorted(frame.vocabs["sessions"]) == ["a", "late"], f"{kind}: {frame.vocabs['sessions']}"
+            assert len(frame.columns["pre"]) == 4, f"{kind}: re-save kept the old rows"
+            q1 = next(q for q in summarize(frame, n_boot=10)["questions"] if q["question"] == "q1")
+            assert q1["mean_delta"] == 0.5, f"{kind}: re-save not applied: {q1['mean_delta']}"
+            
+            _, added = load_frame(store, cache_path)
+            assert added == 0, f"{kind}: unchanged store re-added {added}"
+            store.close()
+    print("Analytics Test Passed.")
+
+def test_compaction():
+    print("Testing History Compaction...")
+    history = []
+    for i in range(20):
+        history.append({"role": "assistant", "content": f"Question {i}. Why do you think that?"})
+        history.append({"role": "user", "content": f"Answer {i}. Because it matters to me."})
+    
+    compactor = HistoryCompactor(budget=300, keep_turns=2)
+    summary, recent, stats = compactor.compact(history)
+    assert stats["tokens_after"] <= 300, "Budget not enforced"
+    assert stats["saved"] > 0, "Nothing saved"
+    assert "Answer 19" in recent, "Newest exchange dropped"
+    assert "Answer 0" in summary, "Older turns not summarized"
+    
+    # A reused compactor must not serve one conversation's excerpts to another
+    other = [{"role": m["role"], "content": m["content"].replace("Answer", "Reply")} for m in history]
+    summary, _, _ = compactor.compact(other)
+    assert "Answer" not in summary and "Reply 0" in summary, f"Stale summary: {summary[:80]}"
+    summary, _, _ = compactor.compact(other + history[:4])
+    assert "Answer" not in summary, "Stale summary after the conversation grew"
+    
+    # The fused prompt is longer than the reply prompt; both must fit the budget
+    fused = FusedAgent()
+    fused.compactor = HistoryCompactor(budget=1000, keep_turns=2)
+    messages = fused._fused_messages("ok", history * 3, {"stance": "pro"}, "Test Topic", "explore", "pro")
+    assert messages[0]["content"] == FUSED_INSTRUCTIONS, "Fused prompt not sent"
+    tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    assert tokens <= 1000, f"Fused prompt over budget: {tokens} tokens"
+    print("Compaction Test Passed.")
+
+def test_heuristics():
+    print("Testing Fast-Path Profiler Heuristics...")
+    previous = {"stance": "anti", "change_readiness": 5, "confidence_in_stance": 0.5}
+    
+    profile, confidence = estimate_profile("ok", previous)
+    assert confidence >= 0.6, "Trivial agreement should be confident"
+    assert profile["style"] == "brief" and profile["stance"] == "anti", "Unexpected estimate"
+    assert profile["change_readiness"] == 6, "Agreement should raise readiness"
+    
+    _, confidence = estimate_profile("yeah right", previous)
+    assert confidence < 0.6, "Sarcasm should escalate to the LLM"
+    for message in ("ok but", "sure /s", "why", "fine!", "really?"):
+        assert estimate_profile(message, previous)[1] < 0.6, f"{message!r} should escalate"
+    # Cues inside other words are not cues
+    for message in ("buttons", "lollipop", "whys", "a/sb"):
+        assert estimate_profile(message, previous)[1] >= 0.3, f"{message!r} escalated on a substring"
+    print("Heuristics Test Passed.")
+
+def test_telemetry():
+    print("Testing LLM Telemetry...")
+    metrics = Telemetry(trace_path="")
+    metrics.start("persuader", "generate_reply", "test-model", "explore").ok()
+    metrics.start("profiler", "analyze", "test-model").fail(ValueError("boom"))
+    
+    text = metrics.prometheus_text()
+    assert 'outcome="ok"} 1' in text, "Successful call not counted"
+    assert 'method="analyze",stage="",model="test-model",outcome="error"} 1' in text, "Failed call not counted"
+    assert "llm_call_duration_seconds_bucket" in text, "Missing latency histogram"
+    print("Telemetry Test Passed.")
+
+def test_resilience():
+    print("Testing Call Policy...")
+    class Unavailable(Exception):
+        status_code = 503
+    
+    attempts = []
+    def flaky(timeout):
+        attempts.append(timeout)
+        if len(attempts) < 3:
+            raise Unavailable("try again")
+        return "ok"
+    
+    policy = CallPolicy(retries=2, backoff_base=0.01)
+    assert policy.call("analyze", "test-model", flaky) == "ok", "Retries should recover"
+    assert len(attempts) == 3, "Expected two retries"
+    
+    def down(timeout):
+        raise Unavailable("down")
+    policy = CallPolicy(retries=0)
+    breaker = policy.breaker("test-model")
+    for _ in range(breaker.failure_threshold):
+        try:
+            policy.call("analyze", "test-model", down)
+        except Unavailable:
+            pass
+    try:
+        policy.call("analyze", "test-model", down)
+        assert False, "Open circuit should fail fast"
+    except CircuitOpenError:
+        pass
+    
+    # A 4xx probe is the request's fault: it must not close a half-open breaker
+    class BadRequest(Exception):
+        status_code = 400
+    def bad(timeout):
+        raise BadRequest("invalid")
+    breaker.reset_timeout = 0
+    try:
+        policy.call("analyze", "test-model", bad)
+    except BadRequest:
+        pass
+    assert breaker.state == "open", f"Non-retryable error changed the breaker: {breaker.state}"
+    
+    # Streamed attempts return at their headers; they must not set the hedge delay
+    policy = CallPolicy(hedge_min_samples=10)
+    for _ in range(10):
+        policy.call("analyze", "test-model", lambda timeout: time.sleep(0.05) or "stream", hedge=False)
+    sent = []
+    def slow(timeout):
+        sent.append(timeout)
+        time.sleep(0.5)
+        return "ok"
+    assert policy.call("analyze", "test-model", slow) == "ok"
+    assert len(sent) == 1, f"Non-streamed call was hedged on stream latencies: {len(sent)} requests"
+    
+    # acall hedges on the loop: the slow first attempt loses and is cancelled
+    policy = CallPolicy(hedge_min_samples=1)
+    policy.latency.observe("analyze", 0.05)
+    cancelled = []
+    async def request(timeout):
+        n = len(sent)
+        sent.append(timeout)
+        try:
+            await asyncio.sleep(0.5 if n == 1 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(n)
+            raise
+        return n
+    assert asyncio.run(policy.acall("analyze", "test-model", request)) == 2, "The hedge should win"
+    assert cancelled == [1], f"Losing attempt not cancelled: {cancelled}"
+    print("Call Policy Test Passed.")
+
+def test_admission():
+    print("Testing Admission Control...")
+    controller = AdmissionController(max_in_flight=1)
+    ticket = controller.acquire("analyze", 100, timeout=1)
+    try:
+        controller.acquire("generate_reply", 100, timeout=0.05)
+        assert False, "Second request should wait for the in-flight slot"
+    except AdmissionTimeout:
+        pass
+    ticket.release()
+    ticket = controller.acquire("generate_reply", 100, timeout=0.05)
+    ticket.waited = 0.05
+    try:
+        ticket.remaining(0.05)
+        assert False, "An attempt whose timeout went to admission must not be sent"
+    except AdmissionTimeout:
+        pass
+    ticket.release()
+    assert controller.in_flight == 0, "Ticket not released"
+    
+    async def cancelled_waiters():
+        # Cancelled while queued: leaves the queue
+        ticket = await controller.aacquire("analyze", 100, timeout=1)
+        waiter = asyncio.ensure_future(controller.aacquire("generate_reply", 100, timeout=5))
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert not controller._queue, "Cancelled waiter still queued"
+        # Cancelled right after its ticket was granted: gives the slot back
+        waiter = asyncio.ensure_future(controller.aacquire("generate_reply", 100, timeout=5))
+        await asyncio.sleep(0.05)
+        ticket.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+    asyncio.run(cancelled_waiters())
+    assert controller.in_flight == 0, f"Cancelled aacquire leaked a slot: {controller.in_flight}"
+    
+    # A stream holds its ticket until it is read, closed or dropped
+    endings = {
+        "read": list,
+        "closed": lambda stream: next(stream) and stream.close(),
+        "dropped": lambda stream: None,
+    }
+    for ending, finish in endings.items():
+        finish(release_after(iter(["a", "b"]), controller.acquire("generate_reply", 100, timeout=1)))
+        assert controller.in_flight == 0, f"A {ending} stream kept its ticket"
+    async def chunks():
+        yield "a"
+        yield "b"
+    async def closed_stream():
+        stream = arelease_after(chunks(), await controller.aacquire("generate_reply", 100, timeout=1))
+        await stream.__anext__()
+        await stream.aclose()
+        arelease_after(chunks(), await controller.aacquire("generate_reply", 100, timeout=1))
+    asyncio.run(closed_stream())
+    assert controller.in_flight == 0, "Async stream kept its ticket"
+    print("Admission Test Passed.")
+
+def _stub_completion(content, prompt_tokens=100, cached_tokens=0, completion_tokens=20):
+    from types import SimpleNamespace
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+def test_incremental_profiling():
+    print("Testing Incremental Profiling...")
+    import backend.agents
+    from backend.agents import PROFILER_UPDATE_INSTRUCTIONS
+    
+    sent = []
+    replies = []
+    def stub_complete(route, call, **kwargs):
+        sent.append(kwargs["messages"])
+        return _stub_completion(replies.pop(0))
+    
+    full = {**ProfilerAgent()._analyze_fallback(), "stance": "anti", "summary": "They doubt it."}
+    history = []
+    for i in range(5):
+        history += [{"role": "assistant", "content": f"Question {i}"}, {"role": "user", "content": f"Answer {i}"}]
+    profiler = ProfilerAgent(incremental=True, full_refresh_every=5)
+    complete, backend.agents.complete = backend.agents.complete, stub_complete
+    try:
+        # Turn 4: only the changed fields come back and are merged in
+        replies.append('{"stance": "mixed", "summary": "They doubt it less."}')
+        profile = profiler.analyze("Answer 3", history[:8], "Test Topic", previous_profile=full)
+        system, prompt = sent[-1][0]["content"], sent[-1][1]["content"]
+        assert system == PROFILER_UPDATE_INSTRUCTIONS, "Turn 4 should be an incremental update"
+        assert "Answer 3" in prompt and "Question 3" in prompt, "Newest exchange not sent"
+        assert "Answer 1" not in prompt and "They doubt it." in prompt, "Incremental prompt resent the history"
+        assert profile["stance"] == "mixed" and profile["tone"] == full["tone"], f"Partial update not merged: {profile}"
+        
+        # Turn 5 is a multiple of full_refresh_every: the whole history is re-read
+        replies.append(json.dumps({**full, "stance": "pro"}))
+        profile = profiler.analyze("Answer 4", history, "Test Topic", previous_profile=profile)
+        system, prompt = sent[-1][0]["content"], sent[-1][1]["content"]
+        assert system != PROFILER_UPDATE_INSTRUCTIONS and "summary" in system, "Turn 5 should be a full refresh"
+        assert "Answer 0" in prompt and "Answer 4" in prompt, "Full refresh did not send the history"
+        assert profile["stance"] == "pro", "Full refresh profile not used"
+        
+        # A bad incremental update keeps the previous profile instead of the generic fallback
+        replies.append("not json")
+        assert profiler.analyze("Answer 3", history[:8], "Test Topic", previous_profile=full) == full, \
+            "Failed incremental update lost the profile"
+        # Without a rolling summary there is nothing to update from
+        replies.append(json.dumps(full))
+        profiler.analyze("Answer 3", history[:8], "Test Topic", previous_profile={"stance": "anti"})
+        assert sent[-1][0]["content"] != PROFILER_UPDATE_INSTRUCTIONS, "Updated a profile without a summary"
+    finally:
+        backend.agents.complete = complete
+    print("Incremental Profiling Test Passed.")
+
+def test_prompt_layout():
+    print("Testing Prompt Layout...")
+    import backend.agents
+    from backend.telemetry import telemetry
+    
+    history = []
+    for i in range(3):
+        history += [{"role": "assistant", "content": f"Question {i}"}, {"role": "user", "content": f"Answer {i}"}]
+    persuader = PersuaderAgent()
+    first = persuader._reply_messages("Answer 2", history[:6], {"stance": "anti", "change_readiness": 5},
+                                      "Test Topic", "explore", "pro")
+    history += [{"role": "assistant", "content": "Question 3"}, {"role": "user", "content": "Answer 3"}]
+    second = persuader._reply_messages("Answer 3", history, {"stance": "mixed", "change_readiness": 7},
+                                       "Test Topic", "challenge", "pro")
+    # Static instructions first, then topic and the growing history, per-turn fields last
+    assert first[0] == second[0], "System prompt must be byte-identical across turns"
+    prompt = first[1]["content"]
+    shared = prompt[:prompt.index("User profile:")].rstrip()[:-1]
+    assert second[1]["content"].startswith(shared), "Next turn's prompt does not extend the cached prefix"
+    assert prompt.index("Latest user message") > prompt.index("User profile:") > prompt.index("Answer 1"), \
+        "Per-turn fields must come after the history"
+    profiler = ProfilerAgent()
+    assert profiler._analyze_messages("a", history, "Topic A")[0] == profiler._analyze_messages("b", [], "Topic B")[0], \
+        "Profiler instructions must not vary per call"
+    
+    # Cached and uncached prompt tokens are recorded from the response usage
+    events = []
+    telemetry.add_listener(events.append)
+    complete = backend.agents.complete
+    backend.agents.complete = lambda route, call, **kwargs: _stub_completion(
+        "What would change your mind?", prompt_tokens=1000, cached_tokens=768, completion_tokens=12)
+    try:
+        persuader.generate_reply("Answer 3", history, {"stance": "mixed"}, "Test Topic", "challenge")
+    finally:
+        backend.agents.complete = complete
+        telemetry.listeners.remove(events.append)
+    assert persuader.usage == {"calls": 1, "prompt_tokens": 1000, "cached_tokens": 768,
+                               "uncached_tokens": 232, "completion_tokens": 12}, f"Usage: {persuader.usage}"
+    assert events[-1]["cached_tokens"] == 768 and events[-1]["prompt_tokens"] == 1000, "Usage not in telemetry"
+    print("Prompt Layout Test Passed.")
+
+def test_profile_schema():
+    print("Testing Profile Schema...")
+    profile = ProfilerAgent()._analyze_fallback()
+    assert validate_profile(profile) is profile, "Fallback profile should be valid"
+    for bad in [{**profile, "stance": "neutral"}, {**profile, "change_readiness": 11},
+                {k: v for k, v in profile.items() if k != "tone"}]:
+        try:
+            validate_profile(bad)
+            assert False, f"Invalid profile accepted: {bad}"
+        except ValueError:
+            pass
+    for survey in [{"q1": 1, "q2": 10}, {"q1": 10, "q2": 10}, {}]:
+        validate_profile(provisional_profile(survey))
+    print("Profile Schema Test Passed.")
+
+def test_scheduler():
+    print("Testing Adaptive Profiling Scheduler...")
+    assert not stage_depends_on_profile(1), "Rapport turns ignore the profile"
+    assert stage_depends_on_profile(5), "Later turns depend on the profile"
+    
+    profile = {"stance": "anti", "change_readiness": 5, "confidence_in_stance": 0.5}
+    scheduler = ProfilingScheduler(max_skips=1)
+    assert scheduler.plan(1, profile, "ok")[0] == "skip", "Trivial early turn should skip"
+    assert scheduler.plan(2, profile, "ok")[0] == "defer", "Skips are capped"
+    assert scheduler.plan(5, profile, "I really think this changes everything for me.")[0] == "inline", \
+        "Substantive late turn should profile inline"
+    print("Scheduler Test Passed.")
+
+def test_turn_regeneration():
+    print("Testing Turn Regeneration...")
+    import backend.pipeline
+    from backend.pipeline import arun_turn, run_turn
+    
+    class StubProfiler:
+        def __init__(self, profile):
+            self.profile = profile
+        def analyze(self, user_message, history, topic_description, previous_profile=None, on_fields=None):
+            time.sleep(0.05)
+            return self.profile
+        async def aanalyze(self, *args, **kwargs):
+            return self.analyze(*args, **kwargs)
+    
+    class StubPersuader:
+        def __init__(self):
+            self.stages = []
+        def generate_reply(self, user_message, history, profile, topic_description, stage, target_stance="pro"):
+            self.stages.append(stage)
+            return f"{stage} reply"
+        async def agenerate_reply(self, *args, **kwargs):
+            return self.generate_reply(*args, **kwargs)
+    
+    history = []
+    for i in range(4):
+        history += [{"role": "assistant", "content": f"Q{i}"}, {"role": "user", "content": f"A{i}"}]
+    previous = {"stance": "anti", "change_readiness": 5}
+    # Drafts from the previous profile, so only regeneration can use the fresh one
+    streaming, backend.pipeline.PROFILE_STREAMING = backend.pipeline.PROFILE_STREAMING, False
+    try:
+        persuader = StubPersuader()
+        result = run_turn(StubProfiler({"stance": "pro", "change_readiness": 5}), persuader,
+                          "A3", history, previous, "Test Topic")
+        assert result["regenerated"] and result["stage"] == "wrap_up", f"Draft not regenerated: {result}"
+        assert result["reply"] == "wrap_up reply" and persuader.stages == ["challenge", "wrap_up"], \
+            f"Reply not rewritten for the fresh stage: {persuader.stages}"
+        
+        persuader = StubPersuader()
+        result = run_turn(StubProfiler(dict(previous)), persuader, "A3", history, previous, "Test Topic")
+        assert not result["regenerated"] and persuader.stages == ["challenge"], "Regenerated an unchanged draft"
+        
+        persuader = StubPersuader()
+        result = asyncio.run(arun_turn(StubProfiler({"stance": "pro", "change_readiness": 5}), persuader,
+                                       "A3", history, previous, "Test Topic"))
+        assert result["regenerated"] and persuader.stages == ["challenge", "wrap_up"], \
+            f"Async turn not regenerated: {persuader.stages}"
+    finally:
+        backend.pipeline.PROFILE_STREAMING = streaming
+    print("Turn Regeneration Test Passed.")
+
+def test_session_log_replay():
+    print("Testing Session Log Replay...")
+    log = SessionLog(tempfile.mkdtemp())
+    log.append("s1", "start", topic={"id": "t"}, pre_survey={"q": 5})
+    log.append("s1", "profile", profile={"stance": "anti"}, turn=1)
+    log.append("s1", "profile", profile={"stance": "pro"}, turn=2)
+    # Deferred profile of turn 1 landing after turn 2's
+    log.append("s1", "profile", profile={"stance": "mixed"}, turn=1)
+    log.append("s1", "stats", usage={"persuader": {"calls": 1}}, timings=[{"total": 1.0}])
+    log.append("s1", "stats", usage={"persuader": {"calls": 2}}, timings=[{"total": 2.0}])
+    log.append("s1", "scheduler", state=ProfilingScheduler().to_dict())
+    
+    state = log.replay("s1")
+    assert state["final_profile"] == {"stance": "pro"}, "Older turn's profile replaced a newer one"
+    assert state["usage"]["persuader"]["calls"] == 3, "Usage not summed across requests"
+    assert len(state["timings"]) == 2, "Timings not collected"
+    scheduler = ProfilingScheduler.from_dict(state["scheduler"])
+    assert scheduler.counters == {"inline": 0, "defer": 0, "skip": 0}, "Scheduler state not restored"
+    print("Session Log Replay Test Passed.")
+
+def test_start_cache():
+    print("Testing Start Chat Cache...")
+    import backend.cache
+    import backend.service
+    topic = {"id": "t", "description": "Test Topic", "questions": ["q1"]}
+    answers = {"q1": 5}
+    key = cache_key(topic, answers, "m")
+    version, backend.cache.START_PROMPT_VERSION = backend.cache.START_PROMPT_VERSION, "edited"
+    try:
+        assert cache_key(topic, answers, "m") != key, "Prompt edits must change the cache key"
+    finally:
+        backend.cache.START_PROMPT_VERSION = version
+    
+    directory = tempfile.mkdtemp()
+    service = AgentService(log=SessionLog(os.path.join(directory, "live")),
+                           cache=ResponseCache(os.path.join(directory, "cache.db"), variants=2))
+    generated = []
+    generate_start = backend.service.generate_start
+    backend.service.generate_start = lambda *args: generated.append(1) or ({"stance": "pro"}, f"Opening {len(generated)}")
+    try:
+        for _ in range(3):
+            service._top_up(topic, answers)
+    finally:
+        backend.service.generate_start = generate_start
+    assert len(generated) == 2, f"Live traffic must top keys up to the variant count: {len(generated)}"
+    openings = {service.cache.get(topic, answers, backend.service.START_MODEL)[1] for _ in range(2)}
+    assert openings == {"Opening 1", "Opening 2"}, f"Variants not served in rotation: {openings}"
+    print("Start Chat Cache Test Passed.")
+
+def test_pipelined_start():
+    print("Testing Pipelined Start...")
+    import backend.service
+    topic = {"id": "t", "description": "Test Topic", "questions": ["q1", "q2"]}
+    answers = {"q1": 8, "q2": 9}
+
+    class StubProfiler(FastPathProfilerAgent):
+        def __init__(self, survey_profile):
+            super().__init__(incremental=True)
+            self.survey_profile = survey_profile
+            self.release = threading.Event()
+
+        def analyze_survey(self, survey_answers, topic_description):
+            self.release.wait(5)
+            return self.survey_profile or self._survey_fallback(survey_answers)
+
+    class StubPersuader(PersuaderAgent):
+        def __init__(self, fallback):
+            super().__init__()
+            self.fallback = fallback
+
+        def stream_opening(self, profile, topic_description, survey_answers):
+            self.timings.append({"method": "generate_opening", "fallback": self.fallback})
+            yield "Hello"
+            yield " there"
+
+    def start(survey_profile, opening_fallback):
+        directory = tempfile.mkdtemp()
+        service = AgentService(log=SessionLog(os.path.join(directory, "live")),
+                               cache=ResponseCache(os.path.join(directory, "cache.db")))
+        agents = StubProfiler(survey_profile), StubPersuader(opening_fallback), FusedAgent()
+        service._agents = lambda: agents
+        result = service.start("s1", topic, answers)
+        # The opening does not wait for the survey profile
+        assert result["source"] == "pipelined", f"Expected a pipelined start: {result}"
+        assert result["opening"] == "Hello there", f"Streamed opening not joined: {result}"
+        state = service.state("s1")
+        assert state["final_profile"] == provisional_profile(answers), \
+            f"Provisional profile not logged first: {state['final_profile']}"
+        agents[0].release.set()
+        service._wait_deferred("s1")
+        return service, service.state("s1")
+
+    llm_profile = {"stance": "pro", "style": "analytical", "key_values": ["data"]}
+    service, state = start(llm_profile, False)
+    assert state["final_profile"] == {**provisional_profile(answers), **llm_profile}, \
+        f"Survey profile did not replace the provisional one: {state['final_profile']}"
+    assert [m["content"] for m in state["history"]] == ["Hello there"], f"Opening not logged: {state['history']}"
+    assert service.cache.get(topic, answers, backend.service.START_MODEL) == (state["final_profile"], "Hello there"), \
+        "A clean start should be cached"
+
+    # Canned fallbacks from either agent are kept out of the cache
+    service, state = start(None, False)
+    assert state["final_profile"]["confidence_in_stance"] == 0.5, f"Fallback profile not logged: {state['final_profile']}"
+    assert not service.cache.count(topic, answers, backend.service.START_MODEL), "Profiler fallback was cached"
+    service, state = start(llm_profile, True)
+    assert state["final_profile"]["style"] == "analytical", f"Survey profile not logged: {state['final_profile']}"
+    assert not service.cache.count(topic, answers, backend.service.START_MODEL), "Opening fallback was cached"
+    print("Pipelined Start Test Passed.")
+
+def test_failed_turn():
+    print("Testing Failed Turn...")
+    import backend.service
+    directory = tempfile.mkdtemp()
+    service = AgentService(log=SessionLog(os.path.join(directory, "live")),
+                           cache=ResponseCache(os.path.join(directory, "cache.db")))
+    try:
+        service.turn("missing", "hello")
+        assert False, "Unknown sessions must raise SessionNotFound"
+    except SessionNotFound:
+        pass
+    
+    service.log.append("s1", "start", topic={"id": "t", "description": "Test Topic"}, pre_survey={"q": 5})
+    service.log.append("s1", "message", role="assistant", content="Opening")
+    
+    def fail(*args, **kwargs):
+        raise RuntimeError("provider down")
+    
+    run_turn = backend.service.run_turn
+    backend.service.run_turn = fail
+    try:
+        service.turn("s1", "hello")
+        assert False, "The turn should have failed"
+    except RuntimeError:
+        pass
+    finally:
+        backend.service.run_turn = run_turn
+    history = service.log.replay("s1")["history"]
+    assert [m["role"] for m in history] == ["assistant"], f"Failed turn left a user message: {history}"
+    print("Failed Turn Test Passed.")
+
+def test_session_locking():
+    print("Testing Session Locking...")
+    import backend.service
+    directory = tempfile.mkdtemp()
+    writer = SessionWriter(store=JsonFileStore(os.path.join(directory, "sessions")))
+    service = AgentService(log=SessionLog(os.path.join(directory, "live"), writer=writer),
+                           cache=ResponseCache(os.path.join(directory, "cache.db")))
+    service.log.append("s1", "start", topic={"id": "t", "description": "Test Topic"}, pre_survey={"q": 5})
+    service.log.append("s1", "message", role="assistant", content="Opening")
+    
+    def slow_turn(profiler, persuader, message, history, profile, *args, **kwargs):
+        time.sleep(0.1)
+        return {"reply": f"re: {message}", "profile": profile, "stage": "explore",
+                "regenerated": False, "profiling": "inline"}
+    
+    # Concurrent turns, as on two workers, must not interleave their records
+    run_turn = backend.service.run_turn
+    backend.service.run_turn = slow_turn
+    try:
+        threads = [threading.Thread(target=service.turn, args=("s1", f"m{i}")) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        backend.service.run_turn = run_turn
+    history = service.log.replay("s1")["history"]
+    assert len(history) == 7, f"Turns lost: {history}"
+    for message, reply in zip(history[1::2], history[2::2]):
+        assert message["role"] == "user" and reply["content"] == f"re: {message['content']}", \
+            f"Interleaved turns: {history}"
+    
+    # A double submit, or two workers finishing at once, queues one write
+    threads = [threading.Thread(target=service.finish, args=("s1", {"q": 5})) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.flush()
+    saved = list(writer.store.iter_sessions())
+    assert len(saved) == 1, f"Session saved {len(saved)} times"
+    assert saved[0]["post_survey"] == {"q": 5} and "finalized" not in saved[0], "Unexpected saved record"
+    writer.close()
+    print("Session Locking Test Passed.")
+
+def test_session_writer():
+    print("Testing Session Writer...")
+    release = threading.Event()
+    
+    class SlowStore:
+        def __init__(self):
+            self.saved = []
+        def save(self, record):
+            release.wait(5)
+            self.saved.append(record)
+            return record["session_id"]
+        def flush(self):
+            pass
+    
+    store = SlowStore()
+    writer = SessionWriter(store=store, max_pending=10)
+    first = writer.submit({"session_id": "a", "n": 1})
+    # "a" is being written; these queue behind it and coalesce
+    second = writer.submit({"session_id": "b", "n": 1})
+    third = writer.submit({"session_id": "b", "n": 2})
+    assert second is third, "Queued saves for one session should share a future"
+    assert writer.backlog() == 2, "Backlog should count queued and in-progress writes"
+    release.set()
+    writer.flush()
+    assert first.result() == "a" and third.result() == "b"
+    assert [r["n"] for r in store.saved if r["session_id"] == "b"] == [2], "Only the latest save is written"
+    writer.close()
+    print("Session Writer Test Passed.")
+
+def test_persuader_stream():
+    print("Testing Persuader Streaming...")
+    import backend.agents
+    from types import SimpleNamespace
+    from backend.telemetry import telemetry
+    
+    def chunk(text):
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+    closed = []
+    class Broken:
+        # Drops the connection after the first token
+        def __iter__(self):
+            yield chunk("Partial")
+            raise ConnectionError("connection reset")
+        def close(self):
+            closed.append(1)
+        async def __aiter__(self):
+            for item in self.__iter__():
+                yield item
+        async def aclose(self):
+            closed.append(1)
+    async def abroken(route, call, **kwargs):
+        return Broken()
+    
+    events = []
+    messages = [{"role": "user", "content": "hi"}]
+    telemetry.add_listener(events.append)
+    complete, backend.agents.complete = backend.agents.complete, lambda route, call, **kwargs: Broken()
+    acomplete, backend.agents.acomplete = backend.agents.acomplete, abroken
+    try:
+        persuader = PersuaderAgent()
+        text = "".join(persuader._stream("generate_reply", messages, "What do you think?"))
+        assert text == "Partial\n\nWhat do you think?", f"No fallback after partial text: {text!r}"
+        assert persuader.timings[-1]["fallback"] and events[-1]["outcome"] == "fallback", \
+            "Partial stream not recorded as a fallback"
+        
+        # The consumer stops after the first token
+        stream = persuader._stream("generate_reply", messages, "What do you think?")
+        next(stream)
+        stream.close()
+        assert events[-1]["outcome"] == "cancelled", f"Abandoned call not finished: {events[-1]}"
+        assert len(persuader.timings) == 2 and len(closed) == 2, "Abandoned stream not closed"
+        
+        async def abandon():
+            stream = persuader._astream("generate_reply", messages, "What do you think?")
+            await stream.__anext__()
+            await stream.aclose()
+        asyncio.run(abandon())
+        assert events[-1]["outcome"] == "cancelled" and len(closed) == 3, "Abandoned async stream not finished"
+    finally:
+        backend.agents.complete = complete
+        backend.agents.acomplete = acomplete
+        telemetry.listeners.remove(events.append)
+    print("Persuader Streaming Test Passed.")
+
+def test_json_field_parser():
+    print("Testing Streamed JSON Fields...")
+    text = json.dumps({
+        "stance": "anti",
+        "change_readiness": 4,
+        "key_values": ["cost, mostly", "health {and} \"taste\""],
+        "good_moves": "Be brief.",
+    })
+    parser = JsonFieldParser()
+    seen = []
+    for i in range(0, len(text), 7):
+        completed = parser.feed(text[i:i + 7])
+        seen += list(completed)
+    assert seen == ["stance", "change_readiness", "key_values", "good_moves"], f"Fields out of order: {seen}"
+    assert parser.fields == json.loads(text), "Streamed fields differ from the full parse"
+    
+    parser = JsonFieldParser()
+    assert parser.feed('{"stance": "pro", "change_readiness": 7') == {"stance": "pro"}, \
+        "A number is only complete after its delimiter"
+    print("Streamed JSON Fields Test Passed.")
+
+def test_llm_routing():
+    print("Testing LLM Routing...")
+    router = Router(
+        "profiler=gpt-5.1-mini;*.analyze_survey=gemini:gemini-2.5-flash;"
+        "persuader.generate_reply.challenge=gpt-5.1;persuader=local:llama3.1",
+        default="gpt-5.1",
+    )
+    assert router.route("profiler", "analyze").name == "gpt-5.1-mini", "Short pattern not padded"
+    assert router.route("profiler", "analyze_survey").name == "gpt-5.1-mini", "First matching rule must win"
+    survey = router.route("fused", "analyze_survey")
+    assert (survey.provider.name, survey.model) == ("gemini", "gemini-2.5-flash"), "Provider not parsed"
+    assert router.route("persuader", "generate_reply", "challenge").name == "gpt-5.1"
+    assert router.route("persuader", "generate_reply", "rapport").name == "local:llama3.1"
+    assert router.route("synthetic_user", "simulate_user").name == "gpt-5.1", "Unmatched call not on the default"
+    provider = Provider("test", "http://127.0.0.1:1/v1", "key")
+    assert provider.client is provider.client, "Sessions must share one pooled client per provider"
+    
+    metrics = Telemetry(trace_path="", prices="gpt-5.1-mini=1/4/0.5")
+    call = metrics.start("profiler", "analyze", "gpt-5.1-mini")
+    call.event.update(prompt_tokens=1000, cached_tokens=400, completion_tokens=100)
+    call.ok()
+    assert abs(call.event["cost"] - 0.0012) < 1e-9, f"Wrong cost: {call.event['cost']}"
+    assert "llm_cost_usd_total" in metrics.prometheus_text(), "Missing cost counter"
+    print("LLM Routing Test Passed.")
+
+def test_adaptive_routing():
+    print("Testing Adaptive Routing...")
+    now = [0.0]
+    router = AdaptiveRouter(rules="", default="gpt-5.1", fallbacks="gpt-5.1=gpt-5.1-mini",
+                            slos="rapport=2;analyze_survey=10", enabled=True, clock=lambda: now[0])
+
+    def calls(model, method, stage, latency, n=10):
+        for _ in range(n):
+            router.observe({"model": model, "method": method, "stage": stage,
+                            "ttft": latency, "duration": latency + 1, "outcome": "ok"})
+            now[0] += 0.1
+
+    calls("gpt-5.1", "generate_reply", "rapport", 4.0)
+    calls("gpt-5.1", "analyze_survey", "", 4.0)
+    assert router.route("persuader", "generate_reply", "rapport").name == "gpt-5.1-mini", \
+        "Rapport replies over their SLO must move to the fallback"
+    assert router.route("profiler", "analyze_survey").name == "gpt-5.1", \
+        "analyze_survey is within its looser SLO"
+
+    now[0] += 10
+    assert router.route("persuader", "generate_reply", "rapport").name == "gpt-5.1", "No probe of the primary"
+    assert router.route("persuader", "generate_reply", "rapport").name == "gpt-5.1-mini", "Probes are rate-limited"
+    calls("gpt-5.1", "generate_reply", "rapport", 0.5, n=5)
+    assert router.route("persuader", "generate_reply", "rapport").name == "gpt-5.1", \
+        "Traffic must move back once the probes meet the SLO"
+    print("Adaptive Routing Test Passed.")
+
+def test_load_test_smoke():
+    print("Testing Load Harness...")
+    import backend.agents
+    from backend.mock_server import start_in_background
+    from backend.providers import Route
+    from backend.telemetry import telemetry
+    from load_test import Recorder, run_session
+
+    server = start_in_background(port=0)
+    mock = Provider("mock", f"http://127.0.0.1:{server.server_address[1]}/v1", "load-test")
+    mock_router = Router(rules="")
+    mock_router.default = Route(mock, "mock-model")
+    router, backend.agents.router = backend.agents.router, mock_router
+    recorder = Recorder()
+    telemetry.add_listener(recorder.observe)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            writer = SessionWriter(JsonFileStore(os.path.join(directory, "sessions")))
+            service = AgentService(log=SessionLog(os.path.join(directory, "live"), writer=writer),
+                                   cache=ResponseCache(os.path.join(directory, "cache.db")))
+            run_session(recorder, service, load_topics()[0], turns=2)
+            writer.flush()
+            saved = list(writer.store.iter_sessions())
+    finally:
+        telemetry.listeners.remove(recorder.observe)
+        backend.agents.router = router
+        server.shutdown()
+    assert len(saved) == 1, f"Finished session not saved: {saved}"
+    for label in ("analyze_survey", "generate_opening", "generate_reply", "start", "turn", "finish"):
+        assert recorder.calls[label] >= 1, f"No {label} calls recorded"
+        assert not recorder.errors[label], f"{label} raised"
+    assert recorder.calls["turn"] == 2, f"Expected two turns: {recorder.calls['turn']}"
+    print("Load Harness Test Passed.")
+
+def test_agent_worker():
+    print("Testing Agent Worker...")
+    import backend.agents
+    from backend import mock_server, worker
+    from backend.providers import Route
+
+    mock = mock_server.start_in_background(port=0)
+    provider = Provider("mock", f"http://127.0.0.1:{mock.server_address[1]}/v1", "load-test")
+    mock_router = Router(rules="")
+    mock_router.default = Route(provider, "mock-model")
+    router, backend.agents.router = backend.agents.router, mock_router
+    directory = tempfile.mkdtemp()
+    service = AgentService(log=SessionLog(os.path.join(directory, "live")),
+                           cache=ResponseCache(os.path.join(directory, "cache.db")))
+    server = worker.start_in_background(port=0, service=service)
+    client = worker.WorkerClient([f"http://127.0.0.1:{server.server_address[1]}"])
+    store, storage._store = storage._store, JsonFileStore(os.path.join(directory, "sessions"))
+    topic = load_topics()[0]
+    answers = {q: 5 for q in topic["questions"]}
+    tokens = []
+    def render(stream):
+        tokens.append([])
+        for text in stream:
+            tokens[-1].append(text)
+        return "".join(tokens[-1])
+    try:
+        started = client.start("w1", topic, answers, render=render)
+        assert started["source"] == "pipelined", f"Unexpected start: {started}"
+        assert started["opening"] and started["opening"] == "".join(tokens[-1]), "Opening not streamed"
+        
+        streamed = client.turn("w1", "I am not convinced.", render=render)
+        assert streamed["reply"] == "".join(tokens[-1]), "Reply does not match the streamed tokens"
+        plain = client.turn("w1", "Tell me more.")
+        assert plain["reply"] and plain["agent_mode"], f"Unexpected turn result: {plain}"
+        
+        # Concurrent sessions share the worker's event loop
+        results = {}
+        def session(n):
+            client.start(f"c{n}", topic, answers)
+            results[n] = client.turn(f"c{n}", "Why?")["reply"]
+        threads = [threading.Thread(target=session, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 8 and all(results.values()), f"Concurrent sessions failed: {results}"
+        
+        history = client.state("w1")["history"]
+        assert [m["role"] for m in history] == ["assistant", "user", "assistant", "user", "assistant"], \
+            f"Unexpected history: {history}"
+        try:
+            client.turn("missing", "hello")
+            assert False, "Unknown sessions must raise SessionNotFound"
+        except SessionNotFound:
+            pass
+        assert client.finish("w1", {"q": 5}), "finish failed"
+        storage.get_writer().flush()
+        assert storage._store.get_session("w1")["post_survey"] == {"q": 5}, "Finished session not saved"
+    finally:
+        storage._store = store
+        backend.agents.router = router
+        server.shutdown()
+        mock.shutdown()
+    print("Agent Worker Test Passed.")
+
+def test_simulate():
+    print("Testing Batch Simulation...")
+    import backend.agents
+    import backend.providers
+    from backend.agents import REPLY_FALLBACK
+    from backend.mock_server import start_in_background
+    from backend.providers import Route
+    from backend.simulate import PERSONAS, run_batch
+    
+    server = start_in_background(port=0)
+    mock = Provider("mock", f"http://127.0.0.1:{server.server_address[1]}/v1", "simulation")
+    mock_router = Router(rules="")
+    mock_router.default = Route(mock, "mock-model")
+    routers = backend.agents.router, backend.providers.router
+    backend.agents.router = backend.providers.router = mock_router
+    topic = load_topics()[0]
+    jobs = [(topic, persona, seed) for seed, persona in enumerate(PERSONAS[:3])]
+    try:
+        records = run_batch(jobs, turns=2, concurrency=3, llm_users=True, adaptive=True)
+        fused = run_batch(jobs[:1], turns=2, concurrency=1, agent_mode="fused")
+    finally:
+        backend.agents.router, backend.providers.router = routers
+        server.shutdown()
+    assert len(records) == 3 and len(fused) == 1, f"Sessions lost: {len(records)}, {len(fused)}"
+    for record in records + fused:
+        assert record["simulated"] and record["topic"]["id"] == topic["id"], "Not a simulated session record"
+        assert [m["role"] for m in record["history"]] == ["assistant", "user", "assistant", "user", "assistant"], \
+            f"Unexpected transcript: {record['history']}"
+        assert len(record["stages"]) == 2 and set(record["post_survey"]) == set(record["pre_survey"])
+    assert all(m["content"] != REPLY_FALLBACK for r in records for m in r["history"]), "Mock replies fell back"
+    assert all(r["usage"]["persuader"]["calls"] >= 3 for r in records), "Persuader calls not counted"
+    assert sum(r["profiling_plan"]["inline"] + r["profiling_plan"]["defer"] + r["profiling_plan"]["skip"]
+               for r in records) == 6, "Adaptive profiling plan not recorded"
+    assert fused[0]["agent_mode"] == "fused" and fused[0]["usage"]["fused"]["calls"] == 2, "Fused turns not run"
+    print("Batch Simulation Test Passed.")
+
 def test_agents_instantiation():
     print("Testing Agents Instantiation...")
     # We won't call the API, just check if classes load
@@ -76,6 +1061,30 @@ if __name__ == "__main__":
     try:
         test_config()
         test_storage()
+        test_analytics()
+        test_compaction()
+        test_heuristics()
+        test_telemetry()
+        test_resilience()
+        test_admission()
+        test_incremental_profiling()
+        test_prompt_layout()
+        test_profile_schema()
+        test_scheduler()
+        test_turn_regeneration()
+        test_session_log_replay()
+        test_start_cache()
+        test_pipelined_start()
+        test_failed_turn()
+        test_session_locking()
+        test_session_writer()
+        test_persuader_stream()
+        test_json_field_parser()
+        test_llm_routing()
+        test_adaptive_routing()
+        test_load_test_smoke()
+        test_agent_worker()
+        test_simulate()
         test_agents_instantiation()
         print("\nALL BACKEND TESTS PASSED")
     except Exception as e: